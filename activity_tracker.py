@@ -0,0 +1,112 @@
+# activity_tracker.py
+# Счетчики активности чатов в памяти: кольцевой буфер минутных корзин на чат.
+# Заменяет COUNT(*) по messages на каждом текстовом сообщении при проверке вмешательств.
+# Все функции вызываются из event loop (handle_message, post_init), блокировки не нужны.
+import logging
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from config import INTERVENTION_MAX_TIMESPAN_MIN, ACTIVITY_MAX_CHATS, ACTIVITY_SWEEP_INTERVAL_SEC, PURGE_QUIET_HOURS
+
+logger = logging.getLogger(__name__)
+
+WINDOW_MINUTES = INTERVENTION_MAX_TIMESPAN_MIN # Окно покрывает максимальный timespan вмешательств
+
+class _ChatWindow:
+    """Кольцо из WINDOW_MINUTES корзин: minutes[i] - абсолютная минута корзины, counts[i] - число сообщений в ней."""
+    __slots__ = ("minutes", "counts", "last_minute")
+
+    def __init__(self):
+        self.minutes = [-1] * WINDOW_MINUTES
+        self.counts = [0] * WINDOW_MINUTES
+        self.last_minute = -1
+
+    def add(self, minute: int, count: int = 1):
+        idx = minute % WINDOW_MINUTES
+        if self.minutes[idx] != minute: self.minutes[idx] = minute; self.counts[idx] = 0 # Корзина устарела - переиспользуем
+        self.counts[idx] += count
+        if minute > self.last_minute: self.last_minute = minute
+
+    def count_since(self, min_minute: int) -> int:
+        return sum(c for m, c in zip(self.minutes, self.counts) if m >= min_minute)
+
+_windows: "OrderedDict[int, _ChatWindow]" = OrderedDict()
+_last_sweep_ts = 0.0
+
+# Суточный профиль нагрузки (все чаты): EWMA числа сообщений для каждого часа UTC.
+# По нему фоновые задачи (очистка) выбирают тихие окна.
+_HOURLY_ALPHA = 0.3
+_hourly_ewma: List[Optional[float]] = [None] * 24
+_current_hour = -1
+_current_hour_count = 0
+
+def _current_minute(now_ts: Optional[float] = None) -> int:
+    return int((now_ts if now_ts is not None else time.time()) // 60)
+
+def record_message(chat_id: int, ts: Optional[float] = None, count: int = 1, profile: bool = True):
+    """Учитывает сообщение чата (ts - unix-время сообщения, по умолчанию сейчас).
+    profile=False - не учитывать в суточном профиле нагрузки (загрузка истории при старте)."""
+    global _current_hour_count
+    now_minute = _current_minute()
+    minute = _current_minute(ts) if ts is not None else now_minute
+    if minute <= now_minute - WINDOW_MINUTES: return # Старше окна - не интересно
+    window = _windows.get(chat_id)
+    if window is None:
+        window = _windows[chat_id] = _ChatWindow()
+        while len(_windows) > ACTIVITY_MAX_CHATS: _windows.popitem(last=False) # LRU: самый давно активный чат
+    else: _windows.move_to_end(chat_id)
+    window.add(minute, count)
+    if profile: _roll_hours(now_minute // 60); _current_hour_count += count
+    _maybe_sweep()
+
+def count_recent(chat_id: int, timespan_minutes: int) -> int:
+    """Число сообщений чата за последние timespan_minutes (с точностью до минуты, текущая минута включена)."""
+    window = _windows.get(chat_id)
+    if window is None: return 0
+    span = max(1, min(timespan_minutes, WINDOW_MINUTES))
+    return window.count_since(_current_minute() - span + 1)
+
+def seed(buckets: Iterable[Tuple[int, int, int]]) -> int:
+    """Заполняет счетчики из БД при старте: (chat_id, unix_minute, count). Возвращает число корзин."""
+    seeded = 0
+    for chat_id, minute, count in buckets:
+        record_message(chat_id, minute * 60, count, profile=False); seeded += 1
+    logger.info(f"Activity tracker: загружено {seeded} минутных корзин для {len(_windows)} чатов.")
+    return seeded
+
+def _roll_hours(hour: int):
+    """Закрывает прошедшие часы в профиле (часы без сообщений учитываются как 0)."""
+    global _current_hour, _current_hour_count
+    if _current_hour < 0: _current_hour = hour; return
+    if hour <= _current_hour: return
+    closed = [_current_hour_count] + [0] * min(hour - _current_hour - 1, 24)
+    for offset, value in enumerate(closed):
+        h = (_current_hour + offset) % 24; prev = _hourly_ewma[h]
+        _hourly_ewma[h] = value if prev is None else prev + _HOURLY_ALPHA * (value - prev)
+    _current_hour = hour; _current_hour_count = 0
+
+def is_quiet_hour(now_ts: Optional[float] = None, quiet_hours: int = PURGE_QUIET_HOURS) -> bool:
+    """True, если текущий час UTC входит в quiet_hours самых тихих по профилю. Пока час не изучен - True."""
+    hour = _current_minute(now_ts) // 60
+    _roll_hours(hour)
+    current = _hourly_ewma[hour % 24]
+    if current is None: return True
+    return sum(1 for v in _hourly_ewma if v is not None and v < current) < quiet_hours
+
+def get_hourly_profile() -> List[Optional[float]]:
+    return list(_hourly_ewma)
+
+def _maybe_sweep():
+    """Периодически выбрасывает чаты без сообщений в пределах окна, чтобы память не росла."""
+    global _last_sweep_ts
+    now = time.monotonic()
+    if now - _last_sweep_ts < ACTIVITY_SWEEP_INTERVAL_SEC: return
+    _last_sweep_ts = now
+    min_minute = _current_minute() - WINDOW_MINUTES + 1
+    idle = [chat_id for chat_id, w in _windows.items() if w.last_minute < min_minute]
+    for chat_id in idle: del _windows[chat_id]
+    if idle: logger.debug(f"Activity tracker: выброшено {len(idle)} неактивных чатов, осталось {len(_windows)}.")
+
+def tracked_chats() -> int:
+    return len(_windows)
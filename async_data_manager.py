@@ -0,0 +1,170 @@
+# async_data_manager.py
+# Асинхронный фасад над data_manager: все обращения к SQLite выполняются
+# в выделенном пуле потоков, чтобы event loop никогда не ждал диск.
+# Соединения берутся из менеджера data_manager: читатели из пула, изменения - через единственного писателя.
+import asyncio
+import functools
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple, Union, Set, Callable, Iterable, TypeVar
+
+import data_manager as dm
+from config import DB_THREAD_POOL_SIZE, STORAGE_BACKEND
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+_db_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Лениво создает пул потоков БД."""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_THREAD_POOL_SIZE, thread_name_prefix="db-pool")
+        logger.info(f"Пул потоков БД создан (workers={DB_THREAD_POOL_SIZE}).")
+    return _db_executor
+
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    """Выполняет синхронную функцию data_manager в пуле потоков БД."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+def shutdown_db_executor(wait: bool = True):
+    """Останавливает пул потоков БД (вызывается при остановке бота)."""
+    global _db_executor
+    if _db_executor is None: return
+    logger.info("Остановка пула потоков БД...")
+    _db_executor.shutdown(wait=wait, cancel_futures=not wait)
+    _db_executor = None
+
+# --- Сообщения ---
+async def get_messages_for_chat(chat_id: int) -> List[Dict[str, Any]]:
+    return await run_db(dm.get_messages_for_chat, chat_id)
+
+async def get_messages_for_chat_since(chat_id: int, since: Union[datetime.datetime, int], until: Optional[Union[datetime.datetime, int]] = None) -> List[Dict[str, Any]]:
+    return await run_db(dm.get_messages_for_chat_since, chat_id, since, until)
+
+async def reduce_messages_for_chat_since(chat_id: int, since: Union[datetime.datetime, int], reducer: Callable[[Iterable[Dict[str, Any]]], T],
+                                         until: Optional[Union[datetime.datetime, int]] = None) -> Tuple[T, Tuple[int, int, int]]:
+    """reducer над потоком сообщений периода в потоке БД (см. data_manager.reduce_messages_for_chat_since)."""
+    return await run_db(dm.reduce_messages_for_chat_since, chat_id, since, reducer, until)
+
+async def get_messages_for_chat_last_n(chat_id: int, limit: int, only_text: bool = False) -> List[Dict[str, Any]]:
+    return await run_db(dm.get_messages_for_chat_last_n, chat_id, limit, only_text)
+
+async def count_messages_since(chat_id: int, since: Union[datetime.datetime, int]) -> int:
+    return await run_db(dm.count_messages_since, chat_id, since)
+
+async def get_referenced_photo_ids() -> Set[str]:
+    return await run_db(dm.get_referenced_photo_ids)
+
+async def get_recent_activity_buckets(since: Union[datetime.datetime, int]) -> List[Tuple[int, int, int]]:
+    return await run_db(dm.get_recent_activity_buckets, since)
+
+async def clear_messages_for_chat(chat_id: int):
+    return await run_db(dm.clear_messages_for_chat, chat_id)
+
+async def delete_messages_older_than(chat_id: int, days: int) -> int:
+    return await run_db(dm.delete_messages_older_than, chat_id, days)
+
+async def purge_expired_messages(policies: Optional[List[Tuple[int, int]]] = None) -> Dict[str, Any]:
+    return await run_db(dm.purge_expired_messages, policies)
+
+async def get_purge_stats() -> Dict[str, Any]:
+    return await run_db(dm.get_purge_stats)
+
+async def archive_old_messages() -> Dict[str, Any]:
+    return await run_db(dm.archive_old_messages)
+
+async def flush_message_buffer() -> int:
+    return await run_db(dm.flush_message_buffer)
+
+# --- Полнотекстовый поиск ---
+async def search_messages(chat_id: int, query: str, since: Optional[Union[datetime.datetime, int]] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    if limit is None: return await run_db(dm.search_messages, chat_id, query, since)
+    return await run_db(dm.search_messages, chat_id, query, since, limit)
+
+async def fts_maintenance(budget_sec: float, full: bool = False) -> Dict[str, Any]:
+    return await run_db(dm.fts_maintenance, budget_sec, full)
+
+# --- Сохраненные результаты генерации ---
+async def get_latest_generated_output(chat_id: int, fingerprint: str, first_message_ms: int) -> Optional[Dict[str, Any]]:
+    return await run_db(dm.get_latest_generated_output, chat_id, fingerprint, first_message_ms)
+
+async def save_generated_output(chat_id: int, fingerprint: str, period_start_ms: int, period_end_ms: int, message_count: int,
+                                output_text: str, note: Optional[str] = None, photo_count: int = 0):
+    return await run_db(dm.save_generated_output, chat_id, fingerprint, period_start_ms, period_end_ms, message_count, output_text, note, photo_count)
+
+async def purge_generated_outputs(days: Optional[int] = None) -> int:
+    if days is None: return await run_db(dm.purge_generated_outputs)
+    return await run_db(dm.purge_generated_outputs, days)
+
+# --- Промежуточные конспекты дня ---
+async def get_partial_digest_candidates() -> List[Tuple[int, int, int]]:
+    return await run_db(dm.get_partial_digest_candidates)
+
+async def get_partial_digests(chat_id: int, since_ms: int) -> List[Dict[str, Any]]:
+    return await run_db(dm.get_partial_digests, chat_id, since_ms)
+
+async def save_partial_digest(chat_id: int, period_start_ms: int, period_end_ms: int, notes: str, message_count: int, image_count: int = 0):
+    return await run_db(dm.save_partial_digest, chat_id, period_start_ms, period_end_ms, notes, message_count, image_count)
+
+async def purge_partial_digests(before_ms: int) -> int:
+    return await run_db(dm.purge_partial_digests, before_ms)
+
+# --- Настройки чата ---
+async def get_chat_settings(chat_id: int) -> Dict[str, Any]:
+    cached = dm.peek_chat_settings(chat_id) # Горячий путь: из кэша, без пула потоков
+    if cached is not None: return cached
+    return await run_db(dm.get_chat_settings, chat_id)
+
+async def update_chat_setting(chat_id: int, setting_key: str, setting_value: Optional[Union[str, bool, int]]) -> bool:
+    return await run_db(dm.update_chat_setting, chat_id, setting_key, setting_value)
+
+async def get_chat_language(chat_id: int) -> str:
+    return await run_db(dm.get_chat_language, chat_id)
+
+async def get_enabled_chats() -> List[int]:
+    return await run_db(dm.get_enabled_chats)
+
+async def get_chat_timezone(chat_id: int) -> str:
+    return await run_db(dm.get_chat_timezone, chat_id)
+
+async def get_chat_genre(chat_id: int) -> str:
+    return await run_db(dm.get_chat_genre, chat_id)
+
+async def get_chat_output_format(chat_id: int) -> str:
+    return await run_db(dm.get_chat_output_format, chat_id)
+
+async def get_chat_personality(chat_id: int) -> str:
+    return await run_db(dm.get_chat_personality, chat_id)
+
+async def get_chat_retention_days(chat_id: int) -> Optional[int]:
+    return await run_db(dm.get_chat_retention_days, chat_id)
+
+async def get_chats_with_retention() -> List[Tuple[int, int]]:
+    return await run_db(dm.get_chats_with_retention)
+
+async def get_intervention_settings(chat_id: int) -> Dict[str, Any]:
+    return dm.intervention_settings_from(await get_chat_settings(chat_id))
+
+# --- Расписание ---
+async def claim_due_chats(now_ts: Optional[float] = None) -> List[Tuple[int, int]]:
+    return await run_db(dm.claim_due_chats, now_ts)
+
+# --- Статистика и отзывы ---
+async def get_chat_stats(chat_id: int, since: Union[datetime.datetime, int]) -> Optional[Dict[str, Any]]:
+    return await run_db(dm.get_chat_stats, chat_id, since)
+
+async def add_feedback(message_id: int, chat_id: int, user_id: int, rating: int):
+    return await run_db(dm.add_feedback, message_id, chat_id, user_id, rating)
+
+# --- Выбор хранилища ---
+# При STORAGE_BACKEND=postgres функции API (storage_backend.API_FUNCTIONS) заменяются реализациями
+# из postgres_storage; вызывающий код по-прежнему обращается к adm.<функция>.
+if STORAGE_BACKEND == "postgres":
+    import postgres_storage
+    import storage_backend
+    for _name in storage_backend.API_FUNCTIONS: globals()[_name] = getattr(postgres_storage, _name)
+    logger.info("Хранилище: PostgreSQL (postgres_storage).")
@@ -0,0 +1,94 @@
+# benchmarks/content_compression.py
+# Сравнение хранения messages.content без сжатия и с zstd-словарем (CONTENT_COMPRESSION=zstd):
+# размер файла БД после VACUUM, объем content, скорость записи через ingest и чтения геттерами data_manager.
+#
+#   python benchmarks/content_compression.py                      # синтетические сообщения
+#   python benchmarks/content_compression.py --source bot_data.db # тексты из реальной БД бота
+#
+# Каждый режим выполняется в отдельном процессе: config читает переменные окружения при импорте.
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ("off", "zstd")
+
+_WORDS = ("привет как дела сегодня завтра вчера встреча созвон проект релиз баг тест сервер база данных "
+          "ок да нет спасибо пожалуйста кажется думаю надо можно смотри ссылка фото видео кто где когда "
+          "почему потому что вообще кстати короче ладно хорошо отлично блин ага угу лол").split()
+
+def _synthetic_texts(count: int, seed: int = 42) -> list:
+    """Похожие на чат тексты: в основном короткие реплики, изредка длинные сообщения."""
+    rnd = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        words = int(rnd.lognormvariate(1.8, 0.9)) + 1
+        if rnd.random() < 0.03: words = rnd.randint(150, 600) # Длинные тексты, пересланные статьи
+        text = " ".join(rnd.choice(_WORDS) for _ in range(words))
+        if rnd.random() < 0.1: text += f" https://example.com/{rnd.randint(1, 10**6)}"
+        texts.append(text.capitalize())
+    return texts
+
+def _source_texts(path: str, count: int) -> list:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try: rows = conn.execute("SELECT content FROM messages WHERE typeof(content) = 'text' AND content <> '' LIMIT ?", (count,)).fetchall()
+    finally: conn.close()
+    return [r[0] for r in rows]
+
+def _worker(mode: str, args) -> dict:
+    sys.path.insert(0, REPO_ROOT)
+    import data_manager as dm
+    texts = _source_texts(args.source, args.messages) if args.source else _synthetic_texts(args.messages)
+    dm.load_data(); dm.start_ingest_writer()
+    now_ms = int(time.time() * 1000)
+    started = time.perf_counter()
+    for i, text in enumerate(texts):
+        dm.add_message(-(1000 + i % args.chats), {'message_id': i, 'user_id': i % 97, 'username': f"user{i % 97}", 'timestamp': now_ms - (len(texts) - i) * 1000, 'type': 'text', 'content': text})
+    dm.stop_ingest_writer()
+    write_s = time.perf_counter() - started
+    if mode == "zstd": # Как в работе бота: словарь на накопленных сообщениях, затем однократное пережатие
+        dm.train_content_dictionary(); dm.compress_existing_content()
+    with dm._write_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)"); conn.execute("VACUUM")
+        content_bytes = conn.execute("SELECT COALESCE(SUM(length(CAST(content AS BLOB))), 0) FROM messages").fetchone()[0]
+    db_bytes = os.path.getsize(dm.DATA_FILE)
+    rows_read = 0
+    started = time.perf_counter()
+    for _ in range(args.reads):
+        for chat in range(args.chats): rows_read += len(dm.get_messages_for_chat(-(1000 + chat)))
+    read_s = time.perf_counter() - started
+    dm.close_all_connections()
+    return {'mode': mode, 'messages': len(texts), 'db_mb': db_bytes / 1048576, 'content_mb': content_bytes / 1048576,
+            'write_msgs_per_s': len(texts) / write_s, 'read_rows_per_s': rows_read / read_s}
+
+def main():
+    parser = argparse.ArgumentParser(description="Размер БД и скорость чтения messages.content без сжатия и с zstd.")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--reads", type=int, default=3, help="Проходов чтения всех чатов")
+    parser.add_argument("--source", help="БД бота, из которой взять реальные тексты (открывается только на чтение)")
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker: print(json.dumps(_worker(args.worker, args))); return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in MODES:
+            env = dict(os.environ, DATA_FILE_PATH=os.path.join(tmp, f"{mode}.db"), CONTENT_COMPRESSION=mode, LOG_LEVEL="WARNING")
+            cmd = [sys.executable, os.path.abspath(__file__), "--worker", mode, "--messages", str(args.messages), "--chats", str(args.chats), "--reads", str(args.reads)]
+            if args.source: cmd += ["--source", os.path.abspath(args.source)]
+            out = subprocess.run(cmd, env=env, cwd=tmp, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+    print(f"{'mode':<6} {'messages':>9} {'db MB':>8} {'content MB':>11} {'write msg/s':>12} {'read rows/s':>12}")
+    for r in results: print(f"{r['mode']:<6} {r['messages']:>9} {r['db_mb']:>8.2f} {r['content_mb']:>11.2f} {r['write_msgs_per_s']:>12.0f} {r['read_rows_per_s']:>12.0f}")
+    base, packed = results
+    print(f"DB size: x{base['db_mb'] / packed['db_mb']:.2f} smaller, content: x{base['content_mb'] / packed['content_mb']:.2f} smaller, read throughput: {packed['read_rows_per_s'] / base['read_rows_per_s'] * 100:.0f}% of uncompressed.")
+
+if __name__ == "__main__":
+    main()
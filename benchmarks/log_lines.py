@@ -0,0 +1,93 @@
+# benchmarks/log_lines.py
+# Сборка лога промпта за день: строки, отрисованные заново для каждого сообщения, против строк,
+# сохраненных в messages.log_line (отрисованы один раз при записи).
+#
+#   python benchmarks/log_lines.py                       # 10k и 100k сообщений
+#   python benchmarks/log_lines.py --messages 10000 50000
+#
+# Колонки:
+#   legacy   - прежний format_log_entry: datetime + pytz.timezone('Europe/Moscow') на каждое сообщение
+#   render   - текущий format_log_entry без сохраненной строки (часовой пояс и метки минут закэшированы)
+#   stored   - строки из log_line
+#   e2e cold - геттер + build_content на сообщениях без log_line (первое чтение, строки дорисовываются и сохраняются)
+#   e2e warm - геттер + build_content, строки из БД
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pytz
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_WORDS = ("привет как дела сегодня завтра встреча созвон проект релиз баг тест сервер база данных "
+          "спасибо пожалуйста кажется думаю надо можно смотри ссылка кто где когда почему вообще кстати").split()
+
+def _legacy_format_log_entry(msg, describe) -> str:
+    dt_utc = datetime.datetime.fromtimestamp(msg['timestamp'] / 1000, tz=pytz.utc)
+    ts_str = dt_utc.astimezone(pytz.timezone('Europe/Moscow')).strftime('%H:%M MSK')
+    return f"[{ts_str}] *{msg.get('username', 'Неизвестный')}*: {describe(msg)}\n"
+
+def _timed(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter(); func(); best = min(best, time.perf_counter() - started)
+    return best
+
+def _run(count: int, repeat: int) -> dict:
+    import data_manager as dm
+    import prompt_builder as pb
+    chat_id = -count
+    rnd = random.Random(count)
+    now_ms = int(time.time() * 1000)
+    step_ms = max(1, 86_400_000 // count) # Все сообщения укладываются в сутки
+    dm.start_ingest_writer()
+    for i in range(count):
+        kind = 'sticker' if rnd.random() < 0.1 else 'text'
+        content = "😂" if kind == 'sticker' else " ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(2, 25))).capitalize()
+        dm.add_message(chat_id, {'message_id': i, 'user_id': rnd.randint(1, 40), 'username': f"user{rnd.randint(1, 40)}",
+                                 'timestamp': now_ms - 86_400_000 + i * step_ms, 'type': kind, 'content': content})
+    dm.stop_ingest_writer()
+    messages = dm.get_messages_for_chat(chat_id)
+    bare = [{k: v for k, v in m.items() if k not in ('log_line', 'log_line_v')} for m in messages]
+
+    def _cold():
+        with dm._write_connection() as conn, conn: conn.execute("UPDATE messages SET log_line = NULL, log_line_v = NULL WHERE chat_id = ?", (chat_id,))
+        started = time.perf_counter(); pb.build_content(dm.get_messages_for_chat(chat_id), {}, token_budget=0)
+        return time.perf_counter() - started
+
+    result = {
+        'messages': count,
+        'legacy': _timed(lambda: "".join(_legacy_format_log_entry(m, pb._describe_message) for m in bare), repeat),
+        'render': _timed(lambda: "".join(pb.format_log_entry(m) for m in bare), repeat),
+        'stored': _timed(lambda: "".join(pb.format_log_entry(m) for m in messages), repeat),
+        'e2e_cold': min(_cold() for _ in range(repeat)),
+        'e2e_warm': _timed(lambda: pb.build_content(dm.get_messages_for_chat(chat_id), {}, token_budget=0), repeat),
+    }
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость сборки лога промпта: отрисовка строк против сохраненных log_line.")
+    parser.add_argument("--messages", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов каждого замера (берется лучший)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(DATA_FILE_PATH=os.path.join(tmp, "bench.db"), LOG_LEVEL="WARNING")
+        sys.path.insert(0, REPO_ROOT)
+        import data_manager as dm
+        import prompt_builder as pb
+        dm.set_log_line_renderer(pb.format_log_entry, pb.LOG_LINE_VERSION)
+        dm.load_data()
+        try: results = [_run(count, args.repeat) for count in args.messages]
+        finally: dm.close_all_connections()
+    print(f"{'messages':>9} {'legacy s':>9} {'render s':>9} {'stored s':>9} {'e2e cold s':>11} {'e2e warm s':>11}")
+    for r in results:
+        print(f"{r['messages']:>9} {r['legacy']:>9.3f} {r['render']:>9.3f} {r['stored']:>9.3f} {r['e2e_cold']:>11.3f} {r['e2e_warm']:>11.3f}")
+    for r in results:
+        print(f"{r['messages']}: lines x{r['legacy'] / r['stored']:.1f} faster than legacy rendering, end-to-end x{r['e2e_cold'] / r['e2e_warm']:.2f} warm vs cold.")
+
+if __name__ == "__main__":
+    main()
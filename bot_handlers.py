@@ -16,7 +16,10 @@ from typing import Optional, Dict, Any, Tuple, List
 
 # Импорты проекта
 import data_manager as dm
+import async_data_manager as adm
+import activity_tracker
 import gemini_client as gc
+import singleflight
 from config import (
     
     SCHEDULE_HOUR, SCHEDULE_MINUTE, DEFAULT_LANGUAGE, COMMON_TIMEZONES,
@@ -27,15 +30,15 @@ from config import (
     INTERVENTION_MIN_COOLDOWN_MIN, INTERVENTION_MAX_COOLDOWN_MIN, INTERVENTION_DEFAULT_COOLDOWN_MIN,
     INTERVENTION_MIN_MIN_MSGS, INTERVENTION_MAX_MIN_MSGS, INTERVENTION_DEFAULT_MIN_MSGS,
     INTERVENTION_MIN_TIMESPAN_MIN, INTERVENTION_MAX_TIMESPAN_MIN, INTERVENTION_DEFAULT_TIMESPAN_MIN, INTERVENTION_PROMPT_MESSAGE_COUNT,
-     INTERVENTION_CONTEXT_HOURS
+     INTERVENTION_CONTEXT_HOURS, GENERATE_NOW_PERIOD_HOURS
 )
 from localization import (
-    get_intervention_value_limits, get_text, get_chat_lang, update_chat_lang_cache, get_genre_name,
+    get_intervention_value_limits, get_text, get_chat_lang, get_genre_name,
     get_personality_name, get_output_format_name, format_retention_days,
     get_user_friendly_proxy_error, get_stats_period_name, LOCALIZED_TEXTS
 )
 from utils import (
-    download_images, MAX_PHOTOS_TO_ANALYZE, notify_owner, is_user_admin
+    download_images, MAX_PHOTOS_TO_ANALYZE, notify_owner, is_user_admin, ThrottledMessageEditor, ProgressFanout
 )
 
 # Импорты Telegram
@@ -94,14 +97,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     chat_id = chat.id
     chat_lang, chat_title_safe = await get_chat_info(chat_id, context)
-    settings = dm.get_chat_settings(chat_id)
+    settings = await adm.get_chat_settings(chat_id)
     status_text = get_text("enabled_status" if settings.get('enabled', True) else "disabled_status", chat_lang)
     personality_key = settings.get('story_personality', 'neutral')
     personality_name = get_personality_name(personality_key, chat_lang)
     format_key = settings.get('output_format', 'story')
     format_desc = get_text(f"start_format_desc_{format_key}", chat_lang)
 
-    chat_tz = dm.get_chat_timezone(chat_id)
+    chat_tz = await adm.get_chat_timezone(chat_id)
     custom_time = settings.get('custom_schedule_time')
     schedule_h, schedule_m = (int(t) for t in custom_time.split(':')) if custom_time else (SCHEDULE_HOUR, SCHEDULE_MINUTE)
     schedule_local_time, schedule_tz_short = format_time_for_chat(schedule_h, schedule_m, chat_tz)
@@ -119,7 +122,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not chat: return
 
     chat_lang, _ = await get_chat_info(chat.id, context)
-    settings = dm.get_chat_settings(chat.id)
+    settings = await adm.get_chat_settings(chat.id)
     personality_name = get_personality_name(settings.get('story_personality', 'neutral'), chat_lang)
     output_format = settings.get('output_format', 'story')
     format_action_now = get_text(f"help_format_{output_format}_now", chat_lang)
@@ -131,6 +134,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                  current_format_action_regen=format_action_regen)
     )
 
+def _on_demand_period_start() -> datetime.datetime:
+    """Начало периода /generate_now и /regenerate_story (последние GENERATE_NOW_PERIOD_HOURS часов)."""
+    return datetime.datetime.now(pytz.utc) - datetime.timedelta(hours=GENERATE_NOW_PERIOD_HOURS)
+
 async def generate_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Генерирует историю/дайджест по запросу."""
     user = update.effective_user; chat = update.effective_chat
@@ -138,8 +145,8 @@ async def generate_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     chat_id = chat.id; chat_lang, _ = await get_chat_info(chat_id, context)
     logger.info(f"User {user.id} /generate_now chat={chat_id}")
 
-    messages_current = dm.get_messages_for_chat(chat_id)
-    settings = dm.get_chat_settings(chat_id)
+    messages_current = await adm.get_messages_for_chat_since(chat_id, _on_demand_period_start())
+    settings = await adm.get_chat_settings(chat_id)
     output_format = settings.get('output_format', 'story')
     output_format_name = get_output_format_name(output_format, chat_lang)
     output_format_name_capital = get_output_format_name(output_format, chat_lang, capital=True)
@@ -152,27 +159,41 @@ async def generate_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     output_text, error_msg_friendly = None, None
 
     try:
-        downloaded_images = {}
-        if output_format == 'story':
-            # Status update for downloading (optional but nice)
-            photo_count = sum(1 for m in messages_current if m.get('type') == 'photo')
-            limit = MAX_PHOTOS_TO_ANALYZE
-            if photo_count > 0 and status_msg_id:
-                try: await context.bot.edit_message_text(chat_id, status_msg_id, get_text("generating_status_downloading", chat_lang, count=0, total=min(photo_count,limit)), parse_mode=ParseMode.HTML)
-                except Exception: pass
-            downloaded_images = await download_images(context, messages_current, chat_id, limit)
-
-        # Status update for AI call
         chat_genre = settings.get('story_genre', 'default')
         personality_key = settings.get('story_personality', 'neutral')
-        logger.info(f"[Chat {chat_id}] Gen on demand: Format={output_format}, Genre={chat_genre}, Personality={personality_key}")
-        if status_msg_id:
-            try: await context.bot.edit_message_text(chat_id, status_msg_id, get_text("generating_status_contacting_ai", chat_lang), parse_mode=ParseMode.HTML)
-            except Exception: pass
+        fingerprint = dm.output_fingerprint(output_format, chat_genre, personality_key, chat_lang)
+        window = dm.output_window(messages_current)
+        generate_key = ("generate", chat_id, fingerprint, window)
+        # Стриминг: статус показывает текст по мере генерации (правки с троттлингом) - у каждого, кто ждет эту генерацию
+        editor = ThrottledMessageEditor(context.bot, chat_id, status_msg_id) if status_msg_id else None
+
+        async def produce() -> Tuple[Optional[str], Optional[str], int]:
+            # Новых сообщений с прошлой генерации (рассылки или /generate_now) нет - отдаем сохраненный текст без фото и прокси
+            stored = await adm.get_latest_generated_output(chat_id, fingerprint, window[0])
+            if stored:
+                logger.info(f"[Chat {chat_id}] Gen on demand: reusing stored {output_format} ({stored['message_count']} msgs, fp={fingerprint})")
+                return stored['output_text'], stored['note'], stored['photo_count']
+            downloaded_images = {}
+            if output_format == 'story':
+                # Status update for downloading (optional but nice)
+                photo_count = sum(1 for m in messages_current if m.get('type') == 'photo')
+                limit = MAX_PHOTOS_TO_ANALYZE
+                if photo_count > 0: await progress.show(get_text("generating_status_downloading", chat_lang, count=0, total=min(photo_count,limit)))
+                downloaded_images = await download_images(context, messages_current, chat_id, limit)
+
+            # Status update for AI call
+            logger.info(f"[Chat {chat_id}] Gen on demand: Format={output_format}, Genre={chat_genre}, Personality={personality_key}")
+            await progress.show(get_text("generating_status_contacting_ai", chat_lang))
+            text, note = await gc.safe_generate_output(
+                messages_current, downloaded_images, output_format, chat_genre, personality_key, chat_lang,
+                on_progress=progress.update
+            )
+            if text: await adm.save_generated_output(chat_id, fingerprint, *window, text, note, len(downloaded_images))
+            return text, note, len(downloaded_images)
 
-        output_text, error_msg_friendly = await gc.safe_generate_output(
-            messages_current, downloaded_images, output_format, chat_genre, personality_key, chat_lang
-        )
+        # Несколько участников нажали /generate_now одновременно - одна генерация на всех
+        with ProgressFanout.attach(generate_key, editor) as progress:
+            (output_text, error_msg_friendly, photos_used), _ = await singleflight.run(generate_key, produce, cache_if=lambda r: bool(r[0]))
 
         # Status update for formatting
         if output_text and status_msg_id:
@@ -181,7 +202,7 @@ async def generate_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         # Sending result
         if output_text:
-            photo_note = get_text("photo_info_text", chat_lang, count=len(downloaded_images)) if downloaded_images else ""
+            photo_note = get_text("photo_info_text", chat_lang, count=photos_used) if photos_used else ""
             header_key = "story_ready_header" # Generic key for on-demand header
             final_header = get_text(header_key, chat_lang, output_format_name_capital=output_format_name_capital, photo_info=photo_note)
             # Try editing status first, fallback to deleting and sending new
@@ -235,8 +256,8 @@ async def regenerate_story(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     chat_id = chat.id; chat_lang, _ = await get_chat_info(chat_id, context)
     logger.info(f"User {user.id} /regenerate_story chat={chat_id}")
 
-    messages_current = dm.get_messages_for_chat(chat_id)
-    settings = dm.get_chat_settings(chat_id)
+    messages_current = await adm.get_messages_for_chat_since(chat_id, _on_demand_period_start())
+    settings = await adm.get_chat_settings(chat_id)
     output_format = settings.get('output_format', 'story')
     output_format_name = get_output_format_name(output_format, chat_lang)
     output_format_name_capital = get_output_format_name(output_format, chat_lang, capital=True)
@@ -247,23 +268,31 @@ async def regenerate_story(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     status_msg = await update.message.reply_html(get_text("regenerating", chat_lang, output_format_name=output_format_name))
     output_text, error_msg_friendly = None, None
     try:
-        downloaded_images = {}
-        if output_format == 'story':
-            downloaded_images = await download_images(context, messages_current, chat_id)
-
         chat_genre = settings.get('story_genre', 'default')
         personality_key = settings.get('story_personality', 'neutral')
-        logger.info(f"[Chat {chat_id}] Regen: Format={output_format}, Genre={chat_genre}, Personality={personality_key}")
+        fingerprint = dm.output_fingerprint(output_format, chat_genre, personality_key, chat_lang)
+        window = dm.output_window(messages_current)
+
+        async def produce() -> Tuple[Optional[str], Optional[str], int]:
+            downloaded_images = {}
+            if output_format == 'story':
+                downloaded_images = await download_images(context, messages_current, chat_id)
+            logger.info(f"[Chat {chat_id}] Regen: Format={output_format}, Genre={chat_genre}, Personality={personality_key}")
+            text, note = await gc.safe_generate_output(
+                messages_current, downloaded_images, output_format, chat_genre, personality_key, chat_lang
+            )
+            if text: # Новый текст заменяет сохраненный: следующий /generate_now отдаст его
+                await adm.save_generated_output(chat_id, fingerprint, *window, text, note, len(downloaded_images))
+            return text, note, len(downloaded_images)
 
-        output_text, error_msg_friendly = await gc.safe_generate_output(
-            messages_current, downloaded_images, output_format, chat_genre, personality_key, chat_lang
-        )
+        # Всегда свежая генерация (ttl=0), но одновременные /regenerate_story делят одну
+        (output_text, error_msg_friendly, photos_used), _ = await singleflight.run(("regenerate", chat_id, fingerprint, window), produce, ttl=0)
         try: await status_msg.delete()
         except Exception: pass # Delete "Regenerating..." message
 
         if output_text:
              # Send header as a new reply to the command
-             photo_note = get_text("photo_info_text", chat_lang, count=len(downloaded_images)) if downloaded_images else ""
+             photo_note = get_text("photo_info_text", chat_lang, count=photos_used) if photos_used else ""
              final_header = get_text("story_ready_header", chat_lang, output_format_name_capital=output_format_name_capital, photo_info=photo_note)
              await update.message.reply_html(final_header)
              # Send body parts
@@ -306,7 +335,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Расчет uptime
     uptime_str = str(datetime.timedelta(seconds=int(time.time() - start_time))) # <-- Правильное имя uptime_str
-    enabled_chats = dm.get_enabled_chats()
+    enabled_chats = await adm.get_enabled_chats()
 
     # Форматирование дат
     ljr_str = last_job_dt.strftime("%Y-%m-%d %H:%M:%S UTC") if last_job_dt else "Ни разу"
@@ -322,6 +351,9 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif last_prg_e: lpe_safe = html.escape(str(last_prg_e)[:500] + '...')
 
     from telegram import __version__ as ptb_version # Получаем версию библиотеки
+    ingest = dm.get_ingest_stats() # Глубина очереди и задержки пакетной записи
+    proxy = gc.get_proxy_stats() # Латентность запросов к прокси Gemini
+    purge = await adm.get_purge_stats() # Итоги последней авто-очистки
 
     # --- ИСПРАВЛЕНО: Используем uptime=uptime_str ---
     status_text = get_text(
@@ -332,6 +364,21 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         last_job_error=lje_safe,
         last_purge_run=lpr_str,
         last_purge_error=lpe_safe,
+        ingest_queue=ingest['queue_depth'],
+        ingest_last_ms=f"{ingest['last_flush_ms']:.1f}",
+        ingest_avg_ms=f"{ingest['avg_flush_ms']:.1f}",
+        ingest_max_ms=f"{ingest['max_flush_ms']:.1f}",
+        proxy_requests=proxy['requests'],
+        proxy_last_ms=f"{proxy['last_ms']:.0f}",
+        proxy_avg_ms=f"{proxy['avg_ms']:.0f}",
+        proxy_startup_ms=f"{proxy['startup_ms']:.0f}" if proxy['startup_ms'] is not None else "n/a",
+        proxy_http_version=proxy['http_version'] or "n/a",
+        proxy_ttft_ms=f"{proxy['avg_ttft_ms']:.0f}",
+        proxy_stream_fallbacks=proxy['stream_fallbacks'],
+        purge_rows=purge['last_rows'],
+        purge_freed_mb=f"{purge['last_bytes_freed'] / 1048576:.1f}",
+        purge_duration_s=f"{purge['last_duration_s']:.1f}",
+        db_free_mb=f"{purge['freelist_bytes'] / 1048576:.1f}" if purge['freelist_bytes'] is not None else "n/a",
         ptb_version=ptb_version
     )
     # -----------------------------------------------
@@ -363,6 +410,45 @@ async def chat_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         [InlineKeyboardButton(get_text("button_close", chat_lang), callback_data="stats_period_cancel")]])
     await update.message.reply_html(text=get_text("stats_prompt_period", chat_lang), reply_markup=kbd)
 
+_SEARCH_PERIOD_RE = re.compile(r"^(\d{1,4})([dдhч])$", re.IGNORECASE) # 7d / 7д - последние N дней, 12h / 12ч - последние N часов
+
+def _message_link(chat: Chat, message_id: int) -> Optional[str]:
+    """Ссылка на сообщение: публичный чат - по username, супергруппа - t.me/c/<id>; для обычных групп ссылок нет."""
+    if chat.username: return f"https://t.me/{chat.username}/{message_id}"
+    if str(chat.id).startswith("-100"): return f"https://t.me/c/{str(chat.id)[4:]}/{message_id}"
+    return None
+
+def _parse_search_args(args: List[str], now: datetime.datetime) -> Tuple[Optional[datetime.datetime], str]:
+    """Первый аргумент может задать период: '7d' (последние N дней), '12h' (последние N часов) или 'YYYY-MM-DD' (начиная с даты, UTC)."""
+    if len(args) > 1:
+        if m := _SEARCH_PERIOD_RE.match(args[0]):
+            unit = 'hours' if m.group(2).lower() in ('h', 'ч') else 'days'
+            return now - datetime.timedelta(**{unit: int(m.group(1))}), " ".join(args[1:])
+        try: return pytz.utc.localize(datetime.datetime.strptime(args[0], "%Y-%m-%d")), " ".join(args[1:])
+        except ValueError: pass
+    return None, " ".join(args)
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /search [7d|12h|YYYY-MM-DD] <запрос> - полнотекстовый поиск по истории чата."""
+    user = update.effective_user; chat = update.effective_chat
+    if not user or not chat or not update.message or chat.type == ChatType.PRIVATE: return
+    chat_lang = await get_chat_lang(chat.id)
+    since, query = _parse_search_args(context.args or [], datetime.datetime.now(pytz.utc))
+    if not dm.build_fts_query(query): await update.message.reply_html(get_text("search_usage", chat_lang)); return
+    try: results = await adm.search_messages(chat.id, query, since)
+    except Exception as e:
+        logger.exception(f"Ошибка /search в чате {chat.id}: {e}")
+        await update.message.reply_html(get_text("search_error", chat_lang)); return
+    if not results: await update.message.reply_html(get_text("search_no_results", chat_lang, query=html.escape(query))); return
+    chat_tz = pytz.timezone(await adm.get_chat_timezone(chat.id))
+    lines = [get_text("search_title_since" if since else "search_title", chat_lang, query=html.escape(query), since=since.strftime("%d.%m.%Y") if since else "")]
+    for i, r in enumerate(results, start=1):
+        when = datetime.datetime.fromtimestamp(r['timestamp'] / 1000, tz=chat_tz).strftime("%d.%m.%Y %H:%M")
+        link = _message_link(chat, r['message_id'])
+        when_html = f'<a href="{link}">{when}</a>' if link else when
+        lines.append(get_text("search_entry", chat_lang, index=i, when=when_html, username=html.escape(r.get('username') or f"User_{r['user_id']}"), snippet=r['snippet']))
+    await update.message.reply_html("\n".join(lines), disable_web_page_preview=True)
+
 async def purge_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """НОВАЯ: Команда /purge_history (админы)."""
     user = update.effective_user; chat = update.effective_chat
@@ -443,8 +529,8 @@ async def settings_callback_handler(update: Update, context: ContextTypes.DEFAUL
             except (BadRequest, TelegramError) as e:
                  logger.warning(f"Failed to delete settings message on close: {e}")
         elif data == 'settings_toggle_status': 
-             settings=dm.get_chat_settings(chat_id)
-             success=dm.update_chat_setting(chat_id,'enabled', not settings.get('enabled',True))
+             settings=await adm.get_chat_settings(chat_id)
+             success=await adm.update_chat_setting(chat_id,'enabled', not settings.get('enabled',True))
              if success:
                  await _display_settings_main(update,context,chat_id,user_id)
                  await query.answer(get_text("settings_saved_popup",chat_lang))
@@ -461,9 +547,9 @@ async def settings_callback_handler(update: Update, context: ContextTypes.DEFAUL
         
         # Вмешательства
         elif data == 'settings_toggle_interventions':
-             settings=dm.get_chat_settings(chat_id)
+             settings=await adm.get_chat_settings(chat_id)
              new_state = not settings.get('allow_interventions',False)
-             success=dm.update_chat_setting(chat_id,'allow_interventions', new_state)
+             success=await adm.update_chat_setting(chat_id,'allow_interventions', new_state)
              if success:
                  # Если отключаем вмешательства, то и настройки вмешательств не показываем, а идем в главное меню
                  await _display_settings_main(update,context,chat_id,user_id)
@@ -584,12 +670,11 @@ async def settings_callback_handler(update: Update, context: ContextTypes.DEFAUL
 
             # Сохранение в БД
             if db_key: 
-                success = dm.update_chat_setting(chat_id, db_key, db_value)
+                success = await adm.update_chat_setting(chat_id, db_key, db_value)
                 if success:
-                    if db_key == 'lang' and isinstance(db_value, str):
-                        update_chat_lang_cache(chat_id, db_value)
-                        # Здесь можно обновить команды бота, если они зависят от языка
-                        # await _update_bot_commands_for_chat(context.bot, chat_id, db_value)
+                    # Кэш языка обновляется write-through внутри update_chat_setting
+                    # Здесь можно обновить команды бота, если они зависят от языка
+                    # await _update_bot_commands_for_chat(context.bot, chat_id, db_value)
 
                     # Перерисовываем меню и показываем уведомление
                     if needs_display_main:
@@ -650,7 +735,7 @@ async def feedback_button_handler(update: Update, context: ContextTypes.DEFAULT_
         except ValueError: logger.warning(f"Invalid feedback mid: {mid_str}"); return
 
         if rating != 0:
-            dm.add_feedback(mid, chat.id, user.id, rating)
+            await adm.add_feedback(mid, chat.id, user.id, rating)
             try: await query.edit_message_reply_markup(reply_markup=None); await query.answer(get_text("feedback_thanks", chat_lang));
             except Exception: pass # Ignore errors removing buttons
         else: await query.answer("Invalid feedback type.", show_alert=True)
@@ -666,16 +751,12 @@ async def summary_period_button_handler(update: Update, context: ContextTypes.DE
     period_key = data.removeprefix("summary_period_")
     logger.info(f"User {user.id} summary period='{period_key}' chat={chat.id}")
 
-    messages = []; now = datetime.datetime.now(pytz.utc); start_dt = None
-    try:
-        if period_key == "today": start_dt = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period_key == "last_1h": start_dt = now - datetime.timedelta(hours=1)
-        elif period_key == "last_3h": start_dt = now - datetime.timedelta(hours=3)
-        elif period_key == "last_24h": start_dt = now - datetime.timedelta(hours=24)
-        else: logger.error(f"Unknown summary key: {period_key}"); return
-        messages = dm.get_messages_for_chat_since(chat.id, start_dt)
-    except Exception as db_err: logger.exception("DB err sum get msgs"); await query.edit_message_text(get_text("error_db_generic", chat_lang), reply_markup=None); return
-    if not messages: await query.edit_message_text(get_text("summarize_no_messages", chat_lang), reply_markup=None); return
+    now = datetime.datetime.now(pytz.utc); start_dt = None
+    if period_key == "today": start_dt = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif period_key == "last_1h": start_dt = now - datetime.timedelta(hours=1)
+    elif period_key == "last_3h": start_dt = now - datetime.timedelta(hours=3)
+    elif period_key == "last_24h": start_dt = now - datetime.timedelta(hours=24)
+    else: logger.error(f"Unknown summary key: {period_key}"); return
 
     status_msg = None; 
     try: await query.edit_message_text(get_text("summarize_generating", chat_lang), reply_markup=None); status_msg=query.message; 
@@ -684,7 +765,21 @@ async def summary_period_button_handler(update: Update, context: ContextTypes.DE
         try: await context.bot.send_chat_action(chat.id, ChatAction.TYPING); 
         except Exception: pass
 
-    summary, err_msg = await gc.safe_generate_summary(messages, chat_lang)
+    async def produce() -> Tuple[Optional[str], Optional[str], int]:
+        # Промпт собирается в потоке БД прямо из курсора: период не собирается в список сообщений
+        prepared_content, window = await adm.reduce_messages_for_chat_since(chat.id, start_dt, pb.build_summary_content)
+        if not window[2]: return None, None, 0
+        summary_text, note = await gc.safe_generate_summary_from_content(prepared_content, chat_lang, on_progress=progress.update)
+        return summary_text, note, window[2]
+
+    editor = ThrottledMessageEditor(context.bot, chat.id, status_msg.message_id) if status_msg else None
+    # Одна и та же кнопка от нескольких участников: одна выборка и одна сводка на всех
+    summary_key = ("summary", chat.id, period_key, chat_lang)
+    try:
+        with ProgressFanout.attach(summary_key, editor) as progress:
+            (summary, err_msg, message_count), _ = await singleflight.run(summary_key, produce, cache_if=lambda r: bool(r[0]))
+    except Exception: logger.exception("DB err sum get msgs"); await query.edit_message_text(get_text("error_db_generic", chat_lang), reply_markup=None); return
+    if not message_count: await query.edit_message_text(get_text("summarize_no_messages", chat_lang), reply_markup=None); return
     try: # Send result
         if status_msg: 
             try: await status_msg.delete(); 
@@ -724,7 +819,7 @@ async def stats_period_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
     stats_data = None; error_msg = None
     try:
-        stats_data = dm.get_chat_stats(chat_id, start_dt) # Используем сохраненный chat_id
+        stats_data = await adm.get_chat_stats(chat_id, start_dt) # Используем сохраненный chat_id
     except Exception as e:
         # Ловим ошибки уровня выше, если get_chat_stats не обработал
         logger.exception(f"Failed get stats c={chat_id} p={period_key}")
@@ -776,8 +871,8 @@ async def purge_confirm_callback(update: Update, context: ContextTypes.DEFAULT_T
     if data.startswith("purge_confirm_"):
         param = data.removeprefix("purge_confirm_"); period_text = ""
         try:
-            if param == "all": dm.clear_messages_for_chat(chat_id); period_text = get_text("purge_period_all", chat_lang)
-            elif param.startswith("days_") and (days := int(param.split('_')[-1])) > 0: dm.delete_messages_older_than(chat_id, days); period_text = get_text("purge_period_days", chat_lang, days=days)
+            if param == "all": await adm.clear_messages_for_chat(chat_id); period_text = get_text("purge_period_all", chat_lang)
+            elif param.startswith("days_") and (days := int(param.split('_')[-1])) > 0: await adm.delete_messages_older_than(chat_id, days); period_text = get_text("purge_period_days", chat_lang, days=days)
             else: raise ValueError("Invalid purge param")
             await query.edit_message_text(get_text("purge_success", chat_lang, period_text=period_text), reply_markup=None)
             await notify_owner(context=context, message=f"Очистка истории ({param})", chat_id=chat_id, user_id=user_id, important=True)
@@ -838,7 +933,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
         timestamp = message.date or datetime.datetime.now(pytz.utc)
         username = user.username or user.first_name or f"User_{user_id}"
-        m_data = {'message_id': message.message_id, 'user_id': user_id, 'username': username, 'timestamp': timestamp.isoformat(), 'type': 'unknown', 'content': None,'file_id': None, 'file_unique_id': None, 'file_name': None }
+        m_data = {'message_id': message.message_id, 'user_id': user_id, 'username': username, 'timestamp': round(timestamp.timestamp() * 1000), 'type': 'unknown', 'content': None,'file_id': None, 'file_unique_id': None, 'file_name': None }
         f_info=None; m_type='unknown'
         if message.text: m_type='text'; m_data['content']=message.text
         elif message.sticker: m_type='sticker'; m_data['content']=message.sticker.emoji; f_info=message.sticker
@@ -856,6 +951,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         if m_data['type'] != 'unknown': 
             dm.add_message(chat_id, m_data)
+            activity_tracker.record_message(chat_id, timestamp.timestamp())
 
         # --- 5. Проверка на ОБЫЧНОЕ Вмешательство ---
         if m_data['type'] == 'text' and m_data['content']:
@@ -875,7 +971,7 @@ async def _handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
     context.user_data.pop(PENDING_TIME_INPUT_KEY, None) # Снимаем флаг ожидания
 
     chat_lang, _ = await get_chat_info(chat_id, context)
-    chat_tz_str = dm.get_chat_timezone(chat_id)
+    chat_tz_str = await adm.get_chat_timezone(chat_id)
     input_time_str = user_message.text.strip()
     back_button_kbd = InlineKeyboardMarkup([[InlineKeyboardButton(get_text("button_back", chat_lang), callback_data="settings_main")]])
 
@@ -920,7 +1016,7 @@ async def _handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
          return
 
     # 4. Сохранение UTC времени в БД
-    success = dm.update_chat_setting(chat_id, 'custom_schedule_time', utc_time_save)
+    success = await adm.update_chat_setting(chat_id, 'custom_schedule_time', utc_time_save)
 
     # 5. Формирование ответного сообщения
     if success:
@@ -962,15 +1058,14 @@ async def _handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 async def _check_and_trigger_intervention(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
      """Внутр: Проверяет условия и запускает фоновую задачу вмешательства."""
-     inter_settings = dm.get_intervention_settings(chat_id)
+     inter_settings = await adm.get_intervention_settings(chat_id)
      if not inter_settings.get('allow_interventions'): return
 
      now_ts = int(time.time()); last_ts = inter_settings.get('last_intervention_ts', 0); cooldown_sec = inter_settings.get('cooldown_minutes', INTERVENTION_DEFAULT_COOLDOWN_MIN) * 60
      if now_ts < last_ts + cooldown_sec: logger.debug(f"Chat {chat_id}: Intervention cooldown."); return
 
      timespan_min = inter_settings.get('timespan_minutes', INTERVENTION_DEFAULT_TIMESPAN_MIN); min_msgs_req = inter_settings.get('min_msgs', INTERVENTION_DEFAULT_MIN_MSGS)
-     since_dt = datetime.datetime.now(pytz.utc) - datetime.timedelta(minutes=timespan_min)
-     recent_msg_count = dm.count_messages_since(chat_id, since_dt)
+     recent_msg_count = activity_tracker.count_recent(chat_id, timespan_min) # Из памяти, без запроса к БД
      if recent_msg_count < min_msgs_req: logger.debug(f"Chat {chat_id}: Interv skip - only {recent_msg_count}/{min_msgs_req} msgs in {timespan_min}m."); return
 
      logger.info(f"Chat {chat_id}: Intervention conditions met. Creating task...")
@@ -991,7 +1086,7 @@ async def _try_send_intervention(chat_id: int, context: ContextTypes.DEFAULT_TYP
 
     try:
         # 1. Получаем настройки
-        settings = dm.get_chat_settings(chat_id) # Получаем все настройки один раз
+        settings = await adm.get_chat_settings(chat_id) # Получаем все настройки один раз
         if not settings.get('allow_interventions', False):
             logger.debug(f"{log_prefix} Interventions disabled during processing.")
             return
@@ -1004,7 +1099,7 @@ async def _try_send_intervention(chat_id: int, context: ContextTypes.DEFAULT_TYP
         try:
             limit_msgs = INTERVENTION_PROMPT_MESSAGE_COUNT
             # Получаем сообщения, включая разные типы, чтобы корректно извлечь username
-            last_n_messages = dm.get_messages_for_chat_last_n(
+            last_n_messages = await adm.get_messages_for_chat_last_n(
                 chat_id,
                 limit=limit_msgs,
                 only_text=False # Нам нужны имена и типы для формирования context_log_entries
@@ -1077,7 +1172,7 @@ async def _try_send_intervention(chat_id: int, context: ContextTypes.DEFAULT_TYP
         if intervention_text:
             # Повторно проверяем кулдаун на случай, если генерация была долгой
             # Используем свежие настройки вмешательств, т.к. они могли измениться
-            inter_settings_recheck = dm.get_intervention_settings(chat_id) 
+            inter_settings_recheck = await adm.get_intervention_settings(chat_id) 
             # И проверяем, что вмешательства все еще разрешены
             if not inter_settings_recheck.get('allow_interventions', False):
                 logger.info(f"{log_prefix} Interventions were disabled while AI was generating. Skipped sending.")
@@ -1093,7 +1188,7 @@ async def _try_send_intervention(chat_id: int, context: ContextTypes.DEFAULT_TYP
                 try:
                     sent_intervention_msg = await context.bot.send_message(chat_id=chat_id, text=intervention_text)
                     # Обновляем время последнего *успешного* вмешательства
-                    dm.update_chat_setting(chat_id, 'last_intervention_ts', now_ts_for_send)
+                    await adm.update_chat_setting(chat_id, 'last_intervention_ts', now_ts_for_send)
                     logger.info(f"{log_prefix} Last intervention timestamp updated to {now_ts_for_send} in DB.")
                     
                     # Сохраняем ID этого вмешательства как начало/продолжение активной цепочки
@@ -1129,7 +1224,7 @@ async def _try_send_intervention(chat_id: int, context: ContextTypes.DEFAULT_TYP
 async def _display_settings_main(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Отображает ГЛАВНОЕ меню настроек."""
     chat_lang, chat_title_safe = await get_chat_info(chat_id, context)
-    settings = dm.get_chat_settings(chat_id)
+    settings = await adm.get_chat_settings(chat_id)
 
     # --- БОЛЕЕ БЕЗОПАСНОЕ ПОЛУЧЕНИЕ ЧАСОВОГО ПОЯСА ---
     # 1. Получаем строку таймзоны из настроек
@@ -1140,7 +1235,7 @@ async def _display_settings_main(update: Update, context: ContextTypes.DEFAULT_T
         chat_tz_str = 'UTC'
         # Опционально: можно попытаться исправить это в БД для будущих вызовов
         # try:
-        #     dm.update_chat_setting(chat_id, 'timezone', 'UTC')
+        #     await adm.update_chat_setting(chat_id, 'timezone', 'UTC')
         # except Exception as db_fix_e:
         #     logger.error(f"Failed to fix missing timezone in DB for chat {chat_id}: {db_fix_e}")
 
@@ -1272,7 +1367,7 @@ async def _display_settings_main(update: Update, context: ContextTypes.DEFAULT_T
 # --- ПОДМЕНЮ ЯЗЫКА ---
 async def _display_settings_language(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Подменю выбора языка."""
-    chat_lang = await get_chat_lang(chat_id); current_lang = dm.get_chat_settings(chat_id).get('lang')
+    chat_lang = await get_chat_lang(chat_id); current_lang = (await adm.get_chat_settings(chat_id)).get('lang')
     text = get_text("settings_select_language_title", chat_lang); btns = []
     for code in SUPPORTED_LANGUAGES: pre = "✅ " if code == current_lang else ""; name = LOCALIZED_TEXTS.get(code, {}).get("lang_name", code); btns.append([InlineKeyboardButton(f"{pre}{name}", callback_data=f"settings_set_lang_{code}")])
     btns.append([InlineKeyboardButton(get_text("button_back", chat_lang), callback_data="settings_main")])
@@ -1281,7 +1376,7 @@ async def _display_settings_language(update: Update, context: ContextTypes.DEFAU
 # --- ПОДМЕНЮ ВРЕМЕНИ ---
 async def _display_settings_time(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
      """Подменю настройки времени."""
-     chat_lang, _ = await get_chat_info(chat_id, context); settings=dm.get_chat_settings(chat_id); tz=settings['timezone']
+     chat_lang, _ = await get_chat_info(chat_id, context); settings=await adm.get_chat_settings(chat_id); tz=settings['timezone']
      custom_time=settings.get('custom_schedule_time'); sch_h,sch_m=(int(t) for t in custom_time.split(':')) if custom_time else (SCHEDULE_HOUR,SCHEDULE_MINUTE)
      local_t,tz_s=format_time_for_chat(sch_h,sch_m,tz); current_display = f"{local_t} {tz_s}"+ (f" ({custom_time} UTC)" if custom_time else "")
      def_local_t, _ = format_time_for_chat(SCHEDULE_HOUR,SCHEDULE_MINUTE,tz)
@@ -1300,7 +1395,7 @@ async def _display_settings_time(update: Update, context: ContextTypes.DEFAULT_T
 async def _display_settings_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Подменю выбора таймзоны."""
     chat_lang = await get_chat_lang(chat_id)
-    current_tz = dm.get_chat_settings(chat_id).get('timezone', 'UTC')
+    current_tz = (await adm.get_chat_settings(chat_id)).get('timezone', 'UTC')
     text = get_text("settings_select_timezone_title", chat_lang)
     rows = []
     btns = [] # Список всех кнопок для клавиатуры
@@ -1344,7 +1439,7 @@ async def _display_settings_timezone(update: Update, context: ContextTypes.DEFAU
 # --- ПОДМЕНЮ ЖАНРА ---
 async def _display_settings_genre(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Подменю выбора жанра."""
-    chat_lang = await get_chat_lang(chat_id); current = dm.get_chat_settings(chat_id).get('story_genre', 'default')
+    chat_lang = await get_chat_lang(chat_id); current = (await adm.get_chat_settings(chat_id)).get('story_genre', 'default')
     text = get_text("settings_select_genre_title", chat_lang); btns = []
     for key in SUPPORTED_GENRES.keys(): pre = "✅ " if key == current else ""; name = get_genre_name(key, chat_lang); btns.append([InlineKeyboardButton(f"{pre}{name}", callback_data=f"settings_set_genre_{key}")])
     btns.append([InlineKeyboardButton(get_text("button_back", chat_lang), callback_data="settings_main")])
@@ -1353,7 +1448,7 @@ async def _display_settings_genre(update: Update, context: ContextTypes.DEFAULT_
 # --- ПОДМЕНЮ ЛИЧНОСТИ ---
 async def _display_settings_personality(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Подменю выбора личности."""
-    chat_lang = await get_chat_lang(chat_id); current = dm.get_chat_settings(chat_id).get('story_personality', DEFAULT_PERSONALITY)
+    chat_lang = await get_chat_lang(chat_id); current = (await adm.get_chat_settings(chat_id)).get('story_personality', DEFAULT_PERSONALITY)
     text = get_text("settings_select_personality_title", chat_lang); btns = []
     for key in SUPPORTED_PERSONALITIES.keys(): pre = "✅ " if key == current else ""; name = get_personality_name(key, chat_lang); btns.append([InlineKeyboardButton(f"{pre}{name}", callback_data=f"settings_set_personality_{key}")])
     btns.append([InlineKeyboardButton(get_text("button_back", chat_lang), callback_data="settings_main")])
@@ -1362,7 +1457,7 @@ async def _display_settings_personality(update: Update, context: ContextTypes.DE
 # --- ПОДМЕНЮ ФОРМАТА ВЫВОДА ---
 async def _display_settings_output_format(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Подменю выбора формата сводки."""
-    chat_lang = await get_chat_lang(chat_id); current = dm.get_chat_settings(chat_id).get('output_format', DEFAULT_OUTPUT_FORMAT)
+    chat_lang = await get_chat_lang(chat_id); current = (await adm.get_chat_settings(chat_id)).get('output_format', DEFAULT_OUTPUT_FORMAT)
     text = get_text("settings_select_output_format_title", chat_lang); btns = []
     for key in SUPPORTED_OUTPUT_FORMATS.keys(): pre = "✅ " if key == current else ""; name = get_output_format_name(key, chat_lang, capital=True); btns.append([InlineKeyboardButton(f"{pre}{name}", callback_data=f"settings_set_format_{key}")])
     btns.append([InlineKeyboardButton(get_text("button_back", chat_lang), callback_data="settings_main")])
@@ -1372,7 +1467,7 @@ async def _display_settings_output_format(update: Update, context: ContextTypes.
 async def _display_settings_retention(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Подменю выбора срока хранения (без опций 0 и 365, добавлены короткие)."""
     chat_lang = await get_chat_lang(chat_id)
-    current = dm.get_chat_settings(chat_id).get('retention_days') # Может быть None
+    current = (await adm.get_chat_settings(chat_id)).get('retention_days') # Может быть None
 
     text = get_text("settings_select_retention_title", chat_lang) # Используем обновленный заголовок
     btns = []
@@ -1415,7 +1510,7 @@ async def _display_settings_interventions(update: Update, context: ContextTypes.
         return
 
     chat_lang = await get_chat_lang(chat_id)
-    inter_settings = dm.get_intervention_settings(chat_id)
+    inter_settings = await adm.get_intervention_settings(chat_id)
     current_cooldown = inter_settings['cooldown_minutes']
     current_min_msgs = inter_settings['min_msgs']
     current_timespan = inter_settings['timespan_minutes']
@@ -1445,7 +1540,7 @@ async def _display_settings_interventions(update: Update, context: ContextTypes.
 
     button_rows = []
     # Кнопка Вкл/Выкл вмешательств
-    interventions_currently_enabled = dm.get_chat_settings(chat_id).get('allow_interventions', False)
+    interventions_currently_enabled = (await adm.get_chat_settings(chat_id)).get('allow_interventions', False)
     toggle_button_text_key = "settings_button_toggle_interventions_on" if interventions_currently_enabled else "settings_button_toggle_interventions_off"
     button_rows.append([InlineKeyboardButton(get_text(toggle_button_text_key, chat_lang), callback_data="settings_toggle_interventions")])
 
@@ -1555,7 +1650,7 @@ async def _handle_intervention_setting_input(
     if not value_is_valid_for_parameter: # Если проверка выше не прошла
         return
 
-    success = dm.update_chat_setting(menu_chat_id, setting_key_to_set, corrected_value)
+    success = await adm.update_chat_setting(menu_chat_id, setting_key_to_set, corrected_value)
 
     if success:
         # Сообщение об успехе без упоминания коррекции по min/max
@@ -1583,7 +1678,7 @@ async def _handle_reply_to_intervention_chain(
     user_reply_message: Message      
 ):
     chat_lang, _ = await get_chat_info(chat_id, context)
-    settings = dm.get_chat_settings(chat_id)
+    settings = await adm.get_chat_settings(chat_id)
     personality_key = settings.get('story_personality', DEFAULT_PERSONALITY)
 
     logger.info(f"Chat {chat_id}: User {user_reply_message.from_user.id} replied to intervention chain message {bot_message_replied_to.message_id}. Bot personality: {personality_key}.")
@@ -0,0 +1,80 @@
+# content_codec.py
+# Прозрачное сжатие messages.content (CONTENT_COMPRESSION=zstd).
+# Сжатое значение хранится как BLOB - кадр zstd (ID словаря записан в заголовке кадра),
+# несжатое - как обычный TEXT. Поэтому старые строки читаются без миграции, а сжатие можно
+# включать и выключать в любой момент: чтение понимает оба формата.
+# Короткие сообщения почти не сжимаются сами по себе, поэтому data_manager один раз обучает
+# словарь на сообщениях этого развертывания и хранит его в БД (таблица content_dicts).
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+from config import CONTENT_COMPRESSION, CONTENT_COMPRESSION_MIN_BYTES, CONTENT_ZSTD_LEVEL, CONTENT_ZSTD_DICT_KB
+
+try: # zstandard опционален: без него новые сообщения пишутся несжатыми
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+_dicts: Dict[int, "zstandard.ZstdCompressionDict"] = {}
+_active_dict_id: Optional[int] = None
+_local = threading.local() # Компрессоры zstandard нельзя использовать из нескольких потоков одновременно
+
+if CONTENT_COMPRESSION == "zstd" and zstandard is None:
+    logger.warning("zstandard не установлен: сжатие сообщений отключено (уже сжатые сообщения прочитать не получится).")
+
+def enabled() -> bool:
+    return CONTENT_COMPRESSION == "zstd" and zstandard is not None
+
+def active_dict_id() -> Optional[int]:
+    return _active_dict_id
+
+def register_dictionary(dict_id: int, data: bytes, active: bool = False):
+    """Регистрирует словарь из БД (все словари нужны для чтения, активный - для записи)."""
+    global _active_dict_id
+    if zstandard is None: return
+    _dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+    if active: _active_dict_id = dict_id
+
+def train_dictionary(samples: List[bytes]) -> Tuple[int, bytes]:
+    """Обучает словарь на образцах сообщений. Возвращает (dict_id, байты словаря)."""
+    trained = zstandard.train_dictionary(CONTENT_ZSTD_DICT_KB * 1024, samples, level=CONTENT_ZSTD_LEVEL)
+    return trained.dict_id(), trained.as_bytes()
+
+def _compressor() -> "zstandard.ZstdCompressor":
+    cached = getattr(_local, 'compressor', None)
+    if cached is None or cached[0] != _active_dict_id:
+        dict_data = _dicts.get(_active_dict_id) if _active_dict_id is not None else None
+        cached = (_active_dict_id, zstandard.ZstdCompressor(level=CONTENT_ZSTD_LEVEL, dict_data=dict_data, write_checksum=False))
+        _local.compressor = cached
+    return cached[1]
+
+def _decompressor(dict_id: int) -> "zstandard.ZstdDecompressor":
+    cache = getattr(_local, 'decompressors', None)
+    if cache is None: cache = _local.decompressors = {}
+    decompressor = cache.get(dict_id)
+    if decompressor is None:
+        if dict_id and dict_id not in _dicts: raise ValueError(f"Словарь zstd {dict_id} не найден в БД")
+        decompressor = cache[dict_id] = zstandard.ZstdDecompressor(dict_data=_dicts.get(dict_id))
+    return decompressor
+
+def dict_id_of(value: Optional[Union[str, bytes]]) -> Optional[int]:
+    """ID словаря сжатого значения (0 - сжато без словаря); None - значение не сжато."""
+    if not isinstance(value, bytes) or zstandard is None: return None
+    return zstandard.get_frame_parameters(value).dict_id
+
+def compress(text: Optional[str]) -> Optional[Union[str, bytes]]:
+    """Текст -> BLOB, если сжатие включено и выгодно; иначе текст без изменений."""
+    if not text or not enabled(): return text
+    raw = text.encode("utf-8")
+    if len(raw) < CONTENT_COMPRESSION_MIN_BYTES: return text
+    packed = _compressor().compress(raw)
+    return packed if len(packed) < len(raw) else text
+
+def decompress(value: Optional[Union[str, bytes]]) -> Optional[str]:
+    """Значение из БД -> текст (TEXT возвращается как есть)."""
+    if not isinstance(value, bytes): return value
+    if zstandard is None: raise RuntimeError("Сообщение сжато zstd, но пакет zstandard не установлен")
+    return _decompressor(zstandard.get_frame_parameters(value).dict_id).decompress(value).decode("utf-8")
@@ -2,11 +2,19 @@
 import logging
 import sqlite3
 import threading
+import queue
 import time
 import datetime
 import pytz
 import re
-from typing import List, Dict, Any, Optional, Tuple, Union
+import html
+import heapq
+import pathlib
+import content_codec
+import message_archive
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple, Union, Set, Iterator, Iterable, Callable, TypeVar
 
 # Импорты из конфига (как раньше)
 from config import (
@@ -17,38 +25,48 @@ from config import (
     INTERVENTION_MIN_MIN_MSGS, INTERVENTION_MAX_MIN_MSGS,
     INTERVENTION_MIN_TIMESPAN_MIN, INTERVENTION_MAX_TIMESPAN_MIN,
     INTERVENTION_DEFAULT_COOLDOWN_MIN, INTERVENTION_DEFAULT_MIN_MSGS,
-    INTERVENTION_DEFAULT_TIMESPAN_MIN, DEFAULT_RETENTION_DAYS
+    INTERVENTION_DEFAULT_TIMESPAN_MIN, DEFAULT_RETENTION_DAYS,
+    INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL_SEC, INGEST_QUEUE_MAX_SIZE, MIGRATION_CHUNK_SIZE,
+    SETTINGS_CACHE_MAX_SIZE, SETTINGS_CACHE_TTL_SEC, CONTENT_ZSTD_TRAIN_SAMPLES, CONTENT_COMPRESSION_MIN_BYTES,
+    SCHEDULE_HOUR, SCHEDULE_MINUTE, SCHEDULE_CATCHUP_MAX_HOURS,
+    PURGE_BATCH_SIZE, PURGE_BATCH_PAUSE_SEC, MESSAGE_ITER_BATCH_SIZE, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, GENERATED_OUTPUT_RETENTION_DAYS, SEARCH_RESULTS_LIMIT, SEARCH_SNIPPET_TOKENS, FTS_MERGE_PAGES,
+    DB_READER_POOL_SIZE, DB_STATEMENT_CACHE_SIZE, DB_CACHE_SIZE_MB, DB_MMAP_SIZE_MB, DB_SYNCHRONOUS
 )
 
 logger = logging.getLogger(__name__)
-local_storage = threading.local()
-
-# --- _get_db_connection, close_db_connection, _execute_query, _init_db ---
-# (Эти функции остаются без изменений, как в последней предоставленной версии)
-# ... (вставить код _get_db_connection, close_db_connection, _execute_query, _init_db) ...
-def _get_db_connection() -> sqlite3.Connection:
-    """Получает или создает соединение с БД SQLite для текущего потока."""
-    connection = getattr(local_storage, 'connection', None)
-    if connection:
-        try:
-            connection.execute("PRAGMA schema_version;")
-            return connection
-        except (sqlite3.ProgrammingError, sqlite3.OperationalError):
-            logger.warning("Обнаружено закрытое соединение SQLite, пересоздаем...")
-            close_db_connection()
+# --- Менеджер соединений ---
+# Одно соединение-писатель (все изменения сериализуются через _writer_lock) и пул
+# read-only соединений для параллельных чтений (WAL позволяет читать во время записи).
+# Все открытые соединения регистрируются, чтобы при остановке закрыть их и сделать checkpoint WAL.
+_writer_lock = threading.RLock() # Реентерабельный: функции записи вызывают друг друга
+_writer_conn: Optional[sqlite3.Connection] = None
+_reader_idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+_reader_slots = threading.BoundedSemaphore(DB_READER_POOL_SIZE)
+_registry: Set[sqlite3.Connection] = set()
+_registry_lock = threading.Lock()
 
+def _open_connection(readonly: bool = False) -> sqlite3.Connection:
+    """Открывает соединение с настроенными PRAGMA и регистрирует его."""
     retry_count = 0
     max_retries = 3
     while retry_count < max_retries:
         try:
-            logger.debug(f"Создание/получение SQLite соединения для потока {threading.current_thread().name} к '{DATA_FILE}'...")
-            conn = sqlite3.connect(DATA_FILE, timeout=15, check_same_thread=False)
-            conn.execute("PRAGMA journal_mode=WAL;")
+            logger.debug(f"Открытие SQLite соединения ({'reader' if readonly else 'writer'}) к '{DATA_FILE}' из потока {threading.current_thread().name}...")
+            if readonly: conn = sqlite3.connect(f"{pathlib.Path(DATA_FILE).resolve().as_uri()}?mode=ro", uri=True, timeout=15, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+            else:
+                conn = sqlite3.connect(DATA_FILE, timeout=15, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+                conn.execute("PRAGMA journal_mode=WAL;")
+                conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS};")
+                conn.execute("PRAGMA foreign_keys = ON;")
+                conn.execute("PRAGMA recursive_triggers = ON;") # INSERT OR REPLACE должен вызывать DELETE-триггер сводок
             conn.execute("PRAGMA busy_timeout = 5000;")
-            conn.execute("PRAGMA foreign_keys = ON;")
+            conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_MB * 1024};") # Отрицательное значение - в КиБ
+            conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE_MB * 1024 * 1024};")
+            conn.create_function("content_text", 1, content_codec.decompress, deterministic=True) # Текст сжатого content (для FTS)
+            conn.create_function("archiving", 0, lambda: _archiving) # Идет перенос в архив: сводки не уменьшаем
+            conn.create_function("iso_to_ms", 1, _iso_to_ms, deterministic=True) # TEXT timestamp строк, еще не прошедших миграцию
             conn.row_factory = sqlite3.Row
-            local_storage.connection = conn
-            logger.debug("SQLite соединение успешно получено/создано.")
+            with _registry_lock: _registry.add(conn)
             return conn
         except sqlite3.OperationalError as e:
             if "database is locked" in str(e).lower() and retry_count < max_retries - 1:
@@ -61,30 +79,43 @@ def _get_db_connection() -> sqlite3.Connection:
         except sqlite3.Error as e: logger.critical(f"Ошибка SQLite при подключении к '{DATA_FILE}': {e}", exc_info=True); raise
     raise sqlite3.Error(f"Не удалось получить соединение к БД после {max_retries} попыток.")
 
-def close_db_connection():
-    """Закрывает соединение с БД для текущего потока, если оно существует."""
-    connection = getattr(local_storage, 'connection', None)
-    if connection:
-        logger.debug(f"Закрытие SQLite соединения для потока {threading.current_thread().name}")
-        try: connection.close()
-        except sqlite3.Error as e: logger.error(f"Ошибка при закрытии SQLite соединения: {e}")
-        finally: local_storage.connection = None
+@contextmanager
+def _write_connection() -> Iterator[sqlite3.Connection]:
+    """Единственное соединение для изменений; держит _writer_lock на время блока."""
+    global _writer_conn
+    with _writer_lock:
+        if _writer_conn is None: _writer_conn = _open_connection()
+        yield _writer_conn
+
+@contextmanager
+def _read_connection() -> Iterator[sqlite3.Connection]:
+    """Берет read-only соединение из пула (не больше DB_READER_POOL_SIZE одновременно)."""
+    with _reader_slots:
+        try: conn = _reader_idle.get_nowait()
+        except queue.Empty: conn = _open_connection(readonly=True)
+        try: yield conn
+        finally:
+            with _registry_lock: alive = conn in _registry
+            if alive: _reader_idle.put(conn)
+            else: conn.close() # Соединение закрыли при остановке, пока оно было выдано
 
 def _execute_query(sql: str, params: tuple = (), fetch_one: bool = False, fetch_all: bool = False) -> Any:
-    """Вспомогательная функция для выполнения SQL запросов с обработкой блокировок."""
-    try:
-        conn = _get_db_connection(); cursor = conn.cursor()
-        cursor.execute(sql, params)
-        if fetch_one: return cursor.fetchone()
-        if fetch_all: return cursor.fetchall()
-        conn.commit()
-        return cursor.rowcount # Для INSERT, UPDATE, DELETE
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка выполнения SQLite запроса:\nSQL: {sql}\nParams: {params}\nError: {e}", exc_info=True) # Добавлено больше инфо в лог
+    """Выполняет SQL: выборки - на соединении из пула читателей, изменения - через писателя."""
+    if fetch_one or fetch_all:
+        try:
+            with _read_connection() as conn:
+                cursor = conn.execute(sql, params)
+                return cursor.fetchone() if fetch_one else cursor.fetchall()
+        except sqlite3.Error as e: logger.error(f"Ошибка выполнения SQLite запроса:\nSQL: {sql}\nParams: {params}\nError: {e}", exc_info=True); raise
+    with _write_connection() as conn:
         try:
-            if hasattr(local_storage, 'connection') and local_storage.connection: local_storage.connection.rollback(); logger.warning("Транзакция SQLite отменена из-за ошибки.")
-        except sqlite3.Error as rollback_e: logger.error(f"Ошибка при откате транзакции SQLite: {rollback_e}")
-        raise # Передаем исходное исключение
+            cursor = conn.execute(sql, params); conn.commit()
+            return cursor.rowcount # Для INSERT, UPDATE, DELETE
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка выполнения SQLite запроса:\nSQL: {sql}\nParams: {params}\nError: {e}", exc_info=True) # Добавлено больше инфо в лог
+            try: conn.rollback(); logger.warning("Транзакция SQLite отменена из-за ошибки.")
+            except sqlite3.Error as rollback_e: logger.error(f"Ошибка при откате транзакции SQLite: {rollback_e}")
+            raise # Передаем исходное исключение
 
 def _init_db():
     """Инициализирует БД: создает/обновляет таблицы и индексы."""
@@ -96,14 +127,49 @@ def _init_db():
                 message_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
                 username TEXT, timestamp TEXT NOT NULL, message_type TEXT NOT NULL,
                 content TEXT, file_id TEXT, file_unique_id TEXT, file_name TEXT,
+                timestamp_ms INTEGER,
                 PRIMARY KEY (chat_id, message_id)
             ) WITHOUT ROWID;
         """) # Добавил WITHOUT ROWID для возможной экономии места
-        _execute_query("CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages (chat_id, timestamp)") # Объединенный индекс
         _execute_query("DROP INDEX IF EXISTS idx_messages_chat_id") # Удаляем старые отдельные индексы, если были
         _execute_query("DROP INDEX IF EXISTS idx_messages_timestamp")
+        # Служебная таблица: версии/состояние миграций схемы
+        _execute_query("CREATE TABLE IF NOT EXISTS schema_meta (key TEXT PRIMARY KEY, value TEXT)")
+        _prepare_timestamp_ms_migration() # Сама миграция - фоновый поток (start_timestamp_ms_backfill)
+        message_columns = [r['name'] for r in _execute_query("PRAGMA table_info(messages)", fetch_all=True)]
+        for col, definition in (("log_line", "BLOB"), ("log_line_v", "INTEGER")): # Отрисованная строка лога промпта и версия ее формата
+            if col not in message_columns: _execute_query(f"ALTER TABLE messages ADD COLUMN {col} {definition}"); logger.info(f"Added column '{col}' to messages.")
         logger.info("Таблица 'messages' проверена/создана.")
 
+        # Сводка активности: чат/день UTC/пользователь/тип -> число сообщений (для /chat_stats)
+        _execute_query("""
+            CREATE TABLE IF NOT EXISTS chat_activity_daily (
+                chat_id INTEGER NOT NULL, day INTEGER NOT NULL, user_id INTEGER NOT NULL, message_type TEXT NOT NULL,
+                cnt INTEGER NOT NULL, username TEXT,
+                PRIMARY KEY (chat_id, day, user_id, message_type)
+            ) WITHOUT ROWID
+        """)
+        _execute_query(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_messages_rollup_ins AFTER INSERT ON messages BEGIN
+                INSERT INTO chat_activity_daily (chat_id, day, user_id, message_type, cnt, username)
+                VALUES (NEW.chat_id, {_ROLLUP_DAY_EXPR.format(row='NEW')}, NEW.user_id, NEW.message_type, 1, NEW.username)
+                ON CONFLICT (chat_id, day, user_id, message_type) DO UPDATE SET cnt = cnt + 1, username = excluded.username;
+            END
+        """)
+        _execute_query("DROP TRIGGER IF EXISTS trg_messages_rollup_del") # Пересоздается: условие менялось между версиями
+        _execute_query(f"""
+            CREATE TRIGGER trg_messages_rollup_del AFTER DELETE ON messages WHEN NOT archiving() BEGIN
+                UPDATE chat_activity_daily SET cnt = cnt - 1
+                WHERE chat_id = OLD.chat_id AND day = {_ROLLUP_DAY_EXPR.format(row='OLD')} AND user_id = OLD.user_id AND message_type = OLD.message_type;
+                DELETE FROM chat_activity_daily
+                WHERE chat_id = OLD.chat_id AND day = {_ROLLUP_DAY_EXPR.format(row='OLD')} AND user_id = OLD.user_id AND message_type = OLD.message_type AND cnt <= 0;
+            END
+        """)
+        logger.info("Таблица 'chat_activity_daily' и триггеры проверены/созданы.")
+        _init_fts()
+        _init_content_compression()
+        _init_archive()
+
         # Таблица chat_settings
         default_retention = "NULL" if DEFAULT_RETENTION_DAYS <= 0 else str(DEFAULT_RETENTION_DAYS)
         intervention_default_enabled_db = 1 if INTERVENTION_ENABLED_DEFAULT else 0
@@ -119,8 +185,7 @@ def _init_db():
             )
         """)
         # Проверка и добавление колонок
-        conn = _get_db_connection(); cursor = conn.cursor()
-        def column_exists(table, column): cursor.execute(f"PRAGMA table_info({table})"); return column in [r['name'] for r in cursor.fetchall()]
+        def column_exists(table, column): return column in [r['name'] for r in _execute_query(f"PRAGMA table_info({table})", fetch_all=True)]
         new_columns = {
             "retention_days": f"INTEGER DEFAULT {default_retention}", "output_format": f"TEXT DEFAULT '{DEFAULT_OUTPUT_FORMAT}'",
             "story_personality": f"TEXT DEFAULT '{DEFAULT_PERSONALITY}'", "allow_interventions": f"BOOLEAN DEFAULT {intervention_default_enabled_db}",
@@ -137,73 +202,463 @@ def _init_db():
         _execute_query(""" CREATE TABLE IF NOT EXISTS feedback (feedback_id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, rating INTEGER NOT NULL, timestamp TEXT NOT NULL) """)
         _execute_query("CREATE INDEX IF NOT EXISTS idx_feedback_message ON feedback (chat_id, message_id)")
         logger.info("Таблица 'feedback' проверена/создана.")
+
+        # Таблица chat_schedule: время следующего запуска сводки (только для включенных чатов)
+        _execute_query("CREATE TABLE IF NOT EXISTS chat_schedule (chat_id INTEGER PRIMARY KEY, slot_minute_utc INTEGER NOT NULL, next_run_ts INTEGER NOT NULL)")
+        _execute_query("CREATE INDEX IF NOT EXISTS idx_chat_schedule_next_run ON chat_schedule (next_run_ts)")
+        _sync_all_chat_schedules()
+        logger.info("Таблица 'chat_schedule' проверена/синхронизирована.")
+
+        # Таблица generated_outputs: готовые истории/дайджесты для повторной выдачи без генерации
+        _execute_query("""
+            CREATE TABLE IF NOT EXISTS generated_outputs (
+                chat_id INTEGER NOT NULL, period_start_ms INTEGER NOT NULL, period_end_ms INTEGER NOT NULL, fingerprint TEXT NOT NULL,
+                message_count INTEGER NOT NULL, output_text TEXT NOT NULL, note TEXT, photo_count INTEGER NOT NULL DEFAULT 0, created_ms INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, period_start_ms, period_end_ms, fingerprint)
+            ) WITHOUT ROWID
+        """)
+        _execute_query("CREATE INDEX IF NOT EXISTS idx_generated_outputs_created ON generated_outputs (created_ms)")
+        logger.info("Таблица 'generated_outputs' проверена/создана.")
+
+        # Таблица partial_digests: промежуточные конспекты дня (partial_digest_job)
+        _execute_query("""
+            CREATE TABLE IF NOT EXISTS partial_digests (
+                chat_id INTEGER NOT NULL, period_start_ms INTEGER NOT NULL, period_end_ms INTEGER NOT NULL,
+                notes TEXT NOT NULL, message_count INTEGER NOT NULL, image_count INTEGER NOT NULL DEFAULT 0, created_ms INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, period_start_ms)
+            ) WITHOUT ROWID
+        """)
+        logger.info("Таблица 'partial_digests' проверена/создана.")
         logger.info(f"База данных '{DATA_FILE}' успешно инициализирована/проверена.")
     except Exception as e: logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА при инициализации БД: {e}", exc_info=True); raise
 
 def load_data(): _init_db()
 
+# --- Служебные метаданные схемы ---
+def _get_meta(key: str) -> Optional[str]:
+    row = _execute_query("SELECT value FROM schema_meta WHERE key = ?", (key,), fetch_one=True)
+    return row['value'] if row else None
+
+def _set_meta(key: str, value: str, conn: Optional[sqlite3.Connection] = None):
+    sql = "INSERT OR REPLACE INTO schema_meta (key, value) VALUES (?, ?)"
+    if conn is not None: conn.execute(sql, (key, value)) # Внутри транзакции вызывающего (под _writer_lock)
+    else: _execute_query(sql, (key, value))
+
+# --- Время сообщений: INTEGER epoch-миллисекунды (UTC) ---
+_DAY_MS = 86400000
+_ROLLUP_DAY_EXPR = "COALESCE({row}.timestamp_ms, 0) / 86400000" # День UTC (номер дня от эпохи)
+
+def to_epoch_ms(value: Union[datetime.datetime, str, int, float]) -> int:
+    """datetime (naive = UTC), ISO-строка или число (уже epoch ms) -> epoch ms."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool): return int(value)
+    if isinstance(value, str): value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None: value = pytz.utc.localize(value)
+    return round(value.timestamp() * 1000)
+
+def _epoch_ms_to_iso(ts_ms: int) -> str:
+    return datetime.datetime.fromtimestamp(ts_ms / 1000, tz=datetime.timezone.utc).isoformat()
+
+def _iso_to_ms(value: Optional[str]) -> Optional[int]:
+    """TEXT timestamp -> epoch ms для SQL (iso_to_ms). Битое значение - 0, как в миграции."""
+    if value is None: return None
+    try: return to_epoch_ms(value)
+    except (ValueError, TypeError): return 0
+
+# Онлайн-миграция messages.timestamp (ISO TEXT) -> timestamp_ms (INTEGER) идет фоновым потоком.
+# Новые строки пишутся сразу с timestamp_ms; пока миграция не закончена, чтения по времени
+# берут время через _ts_ms(): у старых строк - разбор TEXT-колонки (без индекса, но верно).
+# Сводки активности строятся только после миграции: день считается по timestamp_ms.
+_timestamp_ms_ready = False
+_timestamp_ms_thread: Optional[threading.Thread] = None
+
+def _ts_ms(row: str = '') -> str:
+    """SQL-выражение времени сообщения в ms (row - префикс таблицы, например 'm.')."""
+    if _timestamp_ms_ready: return f"{row}timestamp_ms"
+    return f"COALESCE({row}timestamp_ms, iso_to_ms({row}timestamp))"
+
+def _prepare_timestamp_ms_migration():
+    """Добавляет колонку timestamp_ms (быстро, из _init_db). Пустую БД сразу отмечает мигрированной."""
+    global _timestamp_ms_ready
+    _timestamp_ms_ready = _get_meta('messages_timestamp_ms') == 'done'
+    if _timestamp_ms_ready: return
+    if 'timestamp_ms' not in [r['name'] for r in _execute_query("PRAGMA table_info(messages)", fetch_all=True)]:
+        _execute_query("ALTER TABLE messages ADD COLUMN timestamp_ms INTEGER"); logger.info("Added column 'timestamp_ms' to messages.")
+    if not _execute_query("SELECT 1 FROM messages LIMIT 1", fetch_one=True): _finish_timestamp_ms_migration()
+
+def _finish_timestamp_ms_migration():
+    global _timestamp_ms_ready
+    _execute_query("CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages (chat_id, timestamp_ms)")
+    _execute_query("DROP INDEX IF EXISTS idx_messages_chat_time") # Старый индекс по TEXT больше не используется
+    _set_meta('messages_timestamp_ms', 'done'); _timestamp_ms_ready = True
+
+def _timestamp_ms_backfill_loop():
+    """Идет чанками по первичному ключу, каждый чанк - своя короткая транзакция, позиция
+    сохраняется в schema_meta, так что прерванная миграция продолжается с того же места.
+    TEXT-колонку продолжаем заполнять: старая версия бота после отката остается рабочей."""
+    try:
+        cursor_value = _get_meta('messages_timestamp_ms_cursor')
+        last_key = tuple(int(x) for x in cursor_value.split(':')) if cursor_value else (-2**63, -2**63)
+        started = time.perf_counter(); migrated = 0; bad = 0
+        logger.info("Миграция timestamp_ms: заполняю время старых сообщений...")
+        while True:
+            rows = _execute_query("SELECT chat_id, message_id, timestamp, timestamp_ms FROM messages WHERE (chat_id, message_id) > (?, ?) ORDER BY chat_id, message_id LIMIT ?", (*last_key, MIGRATION_CHUNK_SIZE), fetch_all=True)
+            if not rows: break
+            updates = []
+            for r in rows:
+                if r['timestamp_ms'] is not None: continue
+                try: ts_ms = to_epoch_ms(r['timestamp'])
+                except (ValueError, TypeError): ts_ms = 0; bad += 1 # Битое значение: не блокируем миграцию
+                updates.append((ts_ms, r['chat_id'], r['message_id']))
+            last_key = (rows[-1]['chat_id'], rows[-1]['message_id'])
+            with _write_connection() as conn, conn:
+                if updates: conn.executemany("UPDATE messages SET timestamp_ms = ? WHERE chat_id = ? AND message_id = ?", updates)
+                _set_meta('messages_timestamp_ms_cursor', f"{last_key[0]}:{last_key[1]}", conn)
+            migrated += len(updates)
+            if migrated and migrated % (MIGRATION_CHUNK_SIZE * 20) < len(updates): logger.info(f"Миграция timestamp_ms: обработано {migrated} строк...")
+            if updates: time.sleep(PURGE_BATCH_PAUSE_SEC) # Уступаем запись ingest
+        _finish_timestamp_ms_migration()
+        logger.info(f"Миграция timestamp_ms завершена: {migrated} строк ({bad} с некорректным временем) за {time.perf_counter() - started:.1f}s.")
+    except Exception as e: logger.error(f"Миграция timestamp_ms прервана (продолжится при следующем запуске): {e}", exc_info=True)
+
+def start_timestamp_ms_backfill():
+    """Запускает фоновую миграцию timestamp_ms, если она еще не выполнена (вызывается после load_data)."""
+    global _timestamp_ms_thread
+    if _timestamp_ms_ready: return
+    if _timestamp_ms_thread and _timestamp_ms_thread.is_alive(): return
+    _timestamp_ms_thread = threading.Thread(target=_timestamp_ms_backfill_loop, name="timestamp-ms-backfill", daemon=True)
+    _timestamp_ms_thread.start()
+
 # --- Функции для сообщений ---
-# --- add_message (без изменений) ---
+_INSERT_MESSAGE_SQL = "INSERT OR REPLACE INTO messages(chat_id,message_id,user_id,username,timestamp,message_type,content,file_id,file_unique_id,file_name,timestamp_ms,log_line,log_line_v)VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)"
+
+# --- Строки лога промпта ---
+# Строка лога промпта для сообщения без изображения зависит только от самой строки messages,
+# поэтому рисуется один раз при записи и хранится в log_line с версией формата. Строки, записанные
+# до появления log_line или со старой версией, дорисовывает фоновый проход (start_log_line_backfill);
+# чтение их не пишет: недостающую строку рисует сборщик промпта.
+# Формат задает слой промптов: main регистрирует prompt_builder.format_log_entry через set_log_line_renderer.
+_log_line_renderer: Optional[Callable[[Dict[str, Any]], str]] = None
+_log_line_version: Optional[int] = None
+
+def set_log_line_renderer(renderer: Optional[Callable[[Dict[str, Any]], str]], version: Optional[int] = None):
+    """Функция отрисовки строки лога (msg -> str) и версия ее формата. Без нее log_line остается NULL."""
+    global _log_line_renderer, _log_line_version
+    _log_line_renderer = renderer; _log_line_version = version if renderer is not None else None
+
+def _stored_log_line(msg: Dict[str, Any]) -> Tuple[Optional[Union[str, bytes]], Optional[int]]:
+    """(строка лога для log_line, версия формата): сжимается как content. Без renderer - (None, None)."""
+    renderer = _log_line_renderer
+    if renderer is None: return None, None
+    return content_codec.compress(renderer(msg)), _log_line_version
+
+def _fill_log_lines(chat_id: int, messages: List[Dict[str, Any]]) -> int:
+    """Дорисовывает и сохраняет строки лога сообщений без log_line или со старой версией формата. Возвращает число строк."""
+    if _log_line_renderer is None: return 0
+    updates = []
+    for msg in messages:
+        if msg.get('log_line_v') == _log_line_version and msg.get('log_line') is not None: continue
+        msg.pop('log_line', None); msg.pop('log_line_v', None)
+        stored, version = _stored_log_line(msg)
+        updates.append((stored, version, chat_id, msg['message_id']))
+    if updates:
+        with _write_connection() as conn, conn: conn.executemany("UPDATE messages SET log_line = ?, log_line_v = ? WHERE chat_id = ? AND message_id = ?", updates)
+    return len(updates)
+
+_log_line_thread: Optional[threading.Thread] = None
+
+def _log_line_backfill_loop(version: int):
+    try:
+        started = time.perf_counter(); total = 0
+        cursor_value = _get_meta('messages_log_line_cursor') # "версия:chat_id" - смена формата начинает проход заново
+        last_chat = int(cursor_value.split(':')[1]) if cursor_value and cursor_value.split(':')[0] == str(version) else -2**63
+        chat_ids = [r[0] for r in _execute_query("SELECT DISTINCT chat_id FROM messages WHERE chat_id > ? ORDER BY chat_id", (last_chat,), fetch_all=True)]
+        logger.info(f"Log line backfill: проверяю строки лога {len(chat_ids)} чатов (формат v{version})...")
+        for chat_id in chat_ids:
+            last_id = -2**63
+            while True: # Пачки по первичному ключу: каждая - короткая транзакция писателя
+                rows = _execute_query(_SELECT_MESSAGE_COLUMNS.format(ts=_ts_ms()) + " WHERE chat_id = ? AND message_id > ? ORDER BY message_id LIMIT ?", (chat_id, last_id, MIGRATION_CHUNK_SIZE), fetch_all=True)
+                if not rows: break
+                last_id = rows[-1]['message_id']
+                filled = _fill_log_lines(chat_id, [_message_from_row(row) for row in rows])
+                total += filled
+                if filled: time.sleep(PURGE_BATCH_PAUSE_SEC) # Уступаем запись ingest
+            _set_meta('messages_log_line_cursor', f"{version}:{chat_id}")
+        _set_meta('messages_log_line', str(version))
+        logger.info(f"Log line backfill завершен: {total} строк за {time.perf_counter() - started:.1f}s.")
+    except Exception as e: logger.error(f"Log line backfill прерван (продолжится при следующем запуске): {e}", exc_info=True)
+
+def start_log_line_backfill():
+    """Запускает фоновую отрисовку log_line для старых сообщений, если для текущей версии формата она еще не выполнена
+    (вызывается после load_data и set_log_line_renderer)."""
+    global _log_line_thread
+    if _log_line_renderer is None or _get_meta('messages_log_line') == str(_log_line_version): return
+    if _log_line_thread and _log_line_thread.is_alive(): return
+    _log_line_thread = threading.Thread(target=_log_line_backfill_loop, args=(_log_line_version,), name="log-line-backfill", daemon=True)
+    _log_line_thread.start()
+
+# --- Буферизованная запись (ingest) ---
+# handle_message только кладет строку в очередь, фоновый поток пишет пачками
+# через executemany в одной транзакции (по размеру пачки или по таймауту).
+_ingest_queue: "queue.Queue[tuple]" = queue.Queue(maxsize=INGEST_QUEUE_MAX_SIZE)
+_ingest_stop_event = threading.Event()
+_ingest_thread: Optional[threading.Thread] = None
+# Пачка писателя "в полете" (забрана из очереди, еще не закоммичена) - под _ingest_lock.
+# flush_message_buffer берет тот же lock, поэтому после него в очереди и в полете ничего не остается.
+_ingest_lock = threading.Lock()
+_INGEST_WAKEUP: tuple = () # Пустая строка-маркер: писатель сразу пишет недобранную пачку и отпускает lock
+_ingest_flush_cond = threading.Condition() # Пока идут flush, писатель не берет lock снова (Lock не честный)
+_ingest_flushers = 0
+_ingest_stats: Dict[str, Any] = {
+    'enqueued': 0, 'written': 0, 'flushes': 0, 'failed_rows': 0, 'sync_fallbacks': 0,
+    'last_batch_size': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0, 'total_flush_ms': 0.0,
+}
+
+# Внешний приемник пачек (STORAGE_BACKEND=postgres): очередь и фоновый писатель те же, меняется только запись
+_message_batch_sink: Optional[Callable[[List[tuple]], int]] = None
+# Строки, которые нельзя отдать синхронному sink (очередь переполнена или писатель не работает, а вызов - из event loop)
+_message_overflow: Optional[Callable[[List[tuple]], None]] = None
+
+def set_message_batch_sink(sink: Optional[Callable[[List[tuple]], int]], overflow: Optional[Callable[[List[tuple]], None]] = None):
+    """Направляет пачки сообщений в sink(rows) -> written вместо SQLite (None - вернуть SQLite).
+    overflow(rows) - неблокирующая запись строк мимо очереди (без него - синхронно через sink)."""
+    global _message_batch_sink, _message_overflow
+    _message_batch_sink = sink; _message_overflow = overflow if sink is not None else None
+
+def _record_flush_stats(batch_size: int, written: int, started: float):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    _ingest_stats['written'] += written; _ingest_stats['flushes'] += 1
+    _ingest_stats['last_batch_size'] = batch_size; _ingest_stats['last_flush_ms'] = elapsed_ms
+    _ingest_stats['total_flush_ms'] += elapsed_ms; _ingest_stats['max_flush_ms'] = max(_ingest_stats['max_flush_ms'], elapsed_ms)
+    logger.debug(f"Ingest: записано {written}/{batch_size} сообщений за {elapsed_ms:.1f} мс.")
+
+def _write_message_batch(rows: List[tuple]) -> int:
+    """Пишет пачку строк одной транзакцией. При ошибке пачки пишет построчно, чтобы не терять соседей."""
+    if not rows: return 0
+    sink = _message_batch_sink
+    if sink is not None:
+        started = time.perf_counter()
+        try: written = sink(rows)
+        except Exception as e: written = 0; _ingest_stats['failed_rows'] += len(rows); logger.error(f"Ingest: ошибка записи пачки ({len(rows)} строк) во внешнее хранилище: {e}", exc_info=True)
+        _record_flush_stats(len(rows), written, started)
+        return written
+    # Строка лога промпта рисуется один раз, в потоке писателя (content здесь еще не сжат)
+    rows = [r + _stored_log_line({'username': r[3], 'type': r[5], 'content': r[6], 'file_name': r[9], 'timestamp': r[10]}) for r in rows]
+    if content_codec.enabled(): rows = [r[:6] + (content_codec.compress(r[6]),) + r[7:] for r in rows] # Сжимаем в потоке писателя, не в event loop
+    with _write_connection() as conn: # Сериализует записи фонового писателя и ручных flush
+        started = time.perf_counter()
+        written = 0
+        try:
+            with conn: conn.executemany(_INSERT_MESSAGE_SQL, rows)
+            written = len(rows)
+        except sqlite3.Error as e:
+            logger.error(f"Ingest: ошибка пакетной записи ({len(rows)} строк): {e}. Пробую построчно...")
+            for row in rows:
+                try:
+                    with conn: conn.execute(_INSERT_MESSAGE_SQL, row)
+                    written += 1
+                except sqlite3.Error as row_e:
+                    _ingest_stats['failed_rows'] += 1
+                    logger.error(f"Failed add/replace msg {row[1]} chat={row[0]}: {row_e}")
+        _record_flush_stats(len(rows), written, started)
+        return written
+
+def _drain_ingest_queue(limit: int) -> Tuple[List[tuple], bool]:
+    """Забирает из очереди до limit элементов без ожидания. Возвращает (строки без маркеров, было ли что забрать)."""
+    rows = []; taken = 0
+    while taken < limit:
+        try: row = _ingest_queue.get_nowait()
+        except queue.Empty: break
+        taken += 1
+        if row: rows.append(row)
+    return rows, taken > 0
+
+def _wake_ingest_writer():
+    """Просит писателя не добирать пачку до таймаута (перед flush и остановкой)."""
+    if _ingest_thread is None or not _ingest_thread.is_alive() or threading.current_thread() is _ingest_thread: return
+    try: _ingest_queue.put_nowait(_INGEST_WAKEUP)
+    except queue.Full: pass # Очередь полна - писатель не ждет строк
+
+def _ingest_writer_loop():
+    """Цикл фонового писателя: ждет первую строку, добирает пачку до размера или таймаута и пишет."""
+    logger.info(f"Ingest writer запущен (batch={INGEST_BATCH_SIZE}, interval={INGEST_FLUSH_INTERVAL_SEC}s).")
+    try:
+        while not _ingest_stop_event.is_set():
+            with _ingest_flush_cond:
+                if not _ingest_flush_cond.wait_for(lambda: _ingest_flushers == 0, timeout=INGEST_FLUSH_INTERVAL_SEC): continue
+            with _ingest_lock: # От первой строки до коммита пачки
+                try: first_row = _ingest_queue.get(timeout=INGEST_FLUSH_INTERVAL_SEC)
+                except queue.Empty: continue
+                if not first_row: continue # Маркер flush при пустой пачке
+                batch = [first_row]
+                deadline = time.monotonic() + INGEST_FLUSH_INTERVAL_SEC
+                while len(batch) < INGEST_BATCH_SIZE and not _ingest_stop_event.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: break
+                    try: row = _ingest_queue.get(timeout=remaining)
+                    except queue.Empty: break
+                    if not row: break # flush_message_buffer ждет эту пачку
+                    batch.append(row)
+                try: _write_message_batch(batch)
+                except Exception as e: logger.exception(f"Ingest: неожиданная ошибка записи пачки: {e}")
+    finally:
+        logger.info("Ingest writer остановлен.")
+
+def start_ingest_writer():
+    """Запускает фоновый поток записи сообщений (идемпотентно)."""
+    global _ingest_thread
+    if _ingest_thread and _ingest_thread.is_alive(): return
+    _ingest_stop_event.clear()
+    _ingest_thread = threading.Thread(target=_ingest_writer_loop, name="ingest-writer", daemon=True)
+    _ingest_thread.start()
+
+def flush_message_buffer() -> int:
+    """Синхронно записывает все принятые сообщения: дожидается пачки, которую набирает писатель,
+    и дописывает остаток очереди. Возвращает число строк, записанных этим вызовом."""
+    global _ingest_flushers
+    with _ingest_flush_cond: _ingest_flushers += 1
+    try:
+        _wake_ingest_writer()
+        total = 0
+        with _ingest_lock:
+            while True:
+                rows, taken = _drain_ingest_queue(INGEST_BATCH_SIZE)
+                if not taken: return total
+                total += _write_message_batch(rows)
+    finally:
+        with _ingest_flush_cond: _ingest_flushers -= 1; _ingest_flush_cond.notify_all()
+
+def stop_ingest_writer(timeout: float = 10.0):
+    """Останавливает писатель и дописывает остаток очереди (вызывается при остановке бота)."""
+    global _ingest_thread
+    _ingest_stop_event.set(); _wake_ingest_writer()
+    if _ingest_thread:
+        _ingest_thread.join(timeout=timeout)
+        if _ingest_thread.is_alive(): logger.warning("Ingest writer не остановился за отведенное время.")
+        _ingest_thread = None
+    flushed = flush_message_buffer()
+    logger.info(f"Ingest: финальный flush записал {flushed} сообщений.")
+
+def get_ingest_stats() -> Dict[str, Any]:
+    """Метрики буфера записи: глубина очереди и задержки flush (для /status и тюнинга)."""
+    stats = dict(_ingest_stats)
+    stats['queue_depth'] = _ingest_queue.qsize()
+    stats['avg_flush_ms'] = stats['total_flush_ms'] / stats['flushes'] if stats['flushes'] else 0.0
+    stats['writer_alive'] = bool(_ingest_thread and _ingest_thread.is_alive())
+    return stats
+
 def add_message(chat_id: int, message_data: Dict[str, Any]):
+    """Ставит сообщение в очередь записи (timestamp - epoch ms, datetime или ISO-строка).
+    Без запущенного писателя (или при переполнении) пишет сразу."""
     if not isinstance(message_data, dict): logger.warning(f"Bad data type for chat {chat_id}"); return
     req=['message_id','user_id','timestamp','type'];
     if not all(f in message_data for f in req): logger.warning(f"Msg missing req fields chat={chat_id} keys={message_data.keys()}"); return
-    sql="INSERT OR REPLACE INTO messages(chat_id,message_id,user_id,username,timestamp,message_type,content,file_id,file_unique_id,file_name)VALUES(?,?,?,?,?,?,?,?,?,?)"
-    p=(chat_id, message_data.get('message_id'), message_data.get('user_id'), message_data.get('username'), message_data.get('timestamp'), message_data.get('type'), message_data.get('content'), message_data.get('file_id'), message_data.get('file_unique_id'), message_data.get('file_name'))
-    try:_execute_query(sql,p);logger.debug(f"Msg {message_data.get('message_id')} added/replaced chat={chat_id}.")
+    try: ts_ms = to_epoch_ms(message_data['timestamp'])
+    except (ValueError, TypeError, AttributeError): logger.warning(f"Bad timestamp {message_data['timestamp']!r} msg {message_data.get('message_id')} chat={chat_id}"); return
+    p=(chat_id, message_data.get('message_id'), message_data.get('user_id'), message_data.get('username'), _epoch_ms_to_iso(ts_ms), message_data.get('type'), message_data.get('content'), message_data.get('file_id'), message_data.get('file_unique_id'), message_data.get('file_name'), ts_ms)
+    if _ingest_thread and _ingest_thread.is_alive():
+        try:
+            _ingest_queue.put_nowait(p); _ingest_stats['enqueued'] += 1
+            return
+        except queue.Full:
+            _ingest_stats['sync_fallbacks'] += 1
+            logger.warning(f"Ingest: очередь переполнена ({INGEST_QUEUE_MAX_SIZE}), пишу msg {p[1]} chat={chat_id} мимо очереди.")
+    if _message_overflow is not None: _message_overflow([p]); return # Синхронный sink из event loop не вызвать
+    try: _write_message_batch([p]); logger.debug(f"Msg {message_data.get('message_id')} added/replaced chat={chat_id}.")
     except Exception: logger.error(f"Failed add/replace msg {message_data.get('message_id')} chat={chat_id}.")
 
 
-# --- ИСПРАВЛЕНО: Явный SELECT ---
+def _message_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    """Строка messages -> словарь сообщения: message_type -> 'type' (как в add_message), сжатый content распаковывается."""
+    msg_dict = dict(row)
+    msg_dict['type'] = msg_dict.pop('message_type', None)
+    if isinstance(msg_dict.get('content'), bytes):
+        try: msg_dict['content'] = content_codec.decompress(msg_dict['content'])
+        except Exception as e: logger.error(f"Не удалось распаковать content сообщения {msg_dict.get('message_id')}: {e}"); msg_dict['content'] = None
+    if isinstance(msg_dict.get('log_line'), bytes):
+        try: msg_dict['log_line'] = content_codec.decompress(msg_dict['log_line'])
+        except Exception: msg_dict['log_line'] = msg_dict['log_line_v'] = None # Строку нарисует сборщик промпта, сохранит фоновый проход
+    return msg_dict
+
+# --- Потоковое чтение: курсор читателя, пачки по MESSAGE_ITER_BATCH_SIZE строк ---
+_SELECT_MESSAGE_COLUMNS = """
+    SELECT message_id, user_id, username, {ts} AS timestamp, message_type,
+           content, file_id, file_unique_id, file_name, log_line, log_line_v
+    FROM messages
+"""
+
+def _iter_hot_messages(chat_id: int, since_ms: Optional[int], until_ms: Optional[int]) -> Iterator[Dict[str, Any]]:
+    """Сообщения чата из messages по времени. Соединение читателя занято, пока генератор не исчерпан или не закрыт."""
+    where = " WHERE chat_id = ?"; params: List[Any] = [chat_id]
+    ts = _ts_ms()
+    if since_ms is not None: where += f" AND {ts} >= ?"; params.append(since_ms)
+    if until_ms is not None: where += f" AND {ts} < ?"; params.append(until_ms)
+    with _read_connection() as conn:
+        cursor = conn.execute(_SELECT_MESSAGE_COLUMNS.format(ts=ts) + where + f" ORDER BY {ts} ASC", tuple(params))
+        while True:
+            rows = cursor.fetchmany(MESSAGE_ITER_BATCH_SIZE)
+            if not rows: return
+            for row in rows: yield _message_from_row(row)
+
+def iter_messages_for_chat_since(chat_id: int, since: Optional[Union[datetime.datetime, int]] = None,
+                                 until: Optional[Union[datetime.datetime, int]] = None) -> Iterator[Dict[str, Any]]:
+    """Сообщения чата в [since, until) по времени, без материализации всего периода: сначала архивные
+    (архив читается, только если период уходит за горячее окно), затем строки messages пачками."""
+    since_ms = to_epoch_ms(since) if since is not None else None
+    until_ms = to_epoch_ms(until) if until is not None else None
+    segments = [seg for seg in _archive_segments_for(chat_id, since_ms) if until_ms is None or seg['min_ts'] < until_ms]
+    if segments:
+        # Горячая копия важнее архивной (повтор после сбоя архивации, правка): архивные дубликаты отбрасываются,
+        # а если горячие строки попадают во время архива, два упорядоченных потока сливаются по времени
+        archived_until = max(seg['max_ts'] for seg in segments)
+        overlap = {r[0] for r in _execute_query(f"SELECT message_id FROM messages WHERE chat_id = ? AND {_ts_ms()} BETWEEN ? AND ?", (chat_id, since_ms if since_ms is not None else -2**63, archived_until), fetch_all=True) or []}
+        archived = (m for m in _iter_archived_messages(chat_id, since_ms, until_ms, segments) if m['message_id'] not in overlap)
+        if overlap: yield from heapq.merge(archived, _iter_hot_messages(chat_id, since_ms, until_ms), key=lambda m: m['timestamp'] or 0); return
+        yield from archived
+    yield from _iter_hot_messages(chat_id, since_ms, until_ms)
+
 def get_messages_for_chat(chat_id: int) -> List[Dict[str, Any]]:
-    """Возвращает все сообщения для указанного чата."""
-    messages = []
-    # --- ИСПРАВЛЕНО: Явно указываем нужные колонки ---
-    sql = """
-        SELECT message_id, user_id, username, timestamp, message_type,
-               content, file_id, file_unique_id, file_name
-        FROM messages
-        WHERE chat_id = ? ORDER BY timestamp ASC
-    """
-    # -------------------------------------------
+    """Возвращает все сообщения для указанного чата ('timestamp' - epoch ms UTC)."""
     try:
-        rows = _execute_query(sql, (chat_id,), fetch_all=True)
-        if rows:
-            messages = []
-            for row in rows:
-                msg_dict = dict(row)
-                # Переименовываем обратно для консистентности с add_message
-                msg_dict['type'] = msg_dict.pop('message_type', None)
-                messages.append(msg_dict)
+        messages = list(iter_messages_for_chat_since(chat_id))
         logger.debug(f"Извлечено {len(messages)} сообщений для чата {chat_id}.")
+        return messages
     except Exception:
-        logger.error(f"Не удалось получить сообщения для чата {chat_id}.") # Лог ошибки уже есть в _execute_query
-    return messages
+        logger.error(f"Не удалось получить сообщения для чата {chat_id}.", exc_info=True); return []
 
-# --- ИСПРАВЛЕНО: Явный SELECT ---
-def get_messages_for_chat_since(chat_id: int, since_datetime_utc: datetime.datetime) -> List[Dict[str, Any]]:
-    """Возвращает сообщения из чата, начиная с указанной даты/времени UTC."""
-    messages = []
-    if since_datetime_utc.tzinfo is None: since_datetime_utc = pytz.utc.localize(since_datetime_utc)
-    else: since_datetime_utc = since_datetime_utc.astimezone(pytz.utc)
-    since_iso_str = since_datetime_utc.isoformat()
-    # --- ИСПРАВЛЕНО: Явно указываем нужные колонки ---
-    sql = """
-        SELECT message_id, user_id, username, timestamp, message_type,
-               content, file_id, file_unique_id, file_name
-        FROM messages
-        WHERE chat_id = ? AND timestamp >= ? ORDER BY timestamp ASC
-    """
-    # -------------------------------------------
+def get_messages_for_chat_since(chat_id: int, since: Union[datetime.datetime, int], until: Optional[Union[datetime.datetime, int]] = None) -> List[Dict[str, Any]]:
+    """Возвращает сообщения из чата, начиная с указанного момента (datetime или epoch ms), до until (не включая)."""
     try:
-        rows = _execute_query(sql, (chat_id, since_iso_str), fetch_all=True)
-        if rows:
-            messages = []
-            for row in rows: msg_dict = dict(row); msg_dict['type'] = msg_dict.pop('message_type', None); messages.append(msg_dict)
-        logger.debug(f"Извлечено {len(messages)} сообщений чата {chat_id} с {since_iso_str}.")
+        messages = list(iter_messages_for_chat_since(chat_id, since, until))
+        logger.debug(f"Извлечено {len(messages)} сообщений чата {chat_id} с {since}.")
+        return messages
     except Exception:
-        logger.error(f"Не удалось получить сообщения чата {chat_id} с {since_iso_str}.")
-    return messages
+        logger.error(f"Не удалось получить сообщения чата {chat_id} с {since}.", exc_info=True); return []
+
+T = TypeVar("T")
+
+def _counting_window(messages: Iterable[Dict[str, Any]], window: List[Any]) -> Iterator[Dict[str, Any]]:
+    """Пропускает сообщения, накапливая в window [min ts, max ts, count] (как output_window, без списка)."""
+    for m in messages:
+        ts = m.get('timestamp')
+        if ts is not None:
+            ts = to_epoch_ms(ts)
+            window[0] = ts if window[0] is None else min(window[0], ts); window[1] = ts if window[1] is None else max(window[1], ts)
+        window[2] += 1
+        yield m
+
+def reduce_messages(messages: Iterable[Dict[str, Any]], reducer: Callable[[Iterable[Dict[str, Any]]], T]) -> Tuple[T, Tuple[int, int, int]]:
+    """(reducer(messages), output_window прочитанных сообщений). reducer должен пройти поток до конца."""
+    window: List[Any] = [None, None, 0]
+    result = reducer(_counting_window(messages, window))
+    return result, (window[0] or 0, window[1] or 0, window[2])
+
+def reduce_messages_for_chat_since(chat_id: int, since: Union[datetime.datetime, int], reducer: Callable[[Iterable[Dict[str, Any]]], T],
+                                   until: Optional[Union[datetime.datetime, int]] = None) -> Tuple[T, Tuple[int, int, int]]:
+    """Сворачивает сообщения периода потоком (например, сборка промпта /summarize), не собирая их в список.
+    Возвращает (результат reducer, output_window). Курсор читателя освобождается, даже если reducer не дочитал поток."""
+    messages = iter_messages_for_chat_since(chat_id, since, until)
+    try: return reduce_messages(messages, reducer)
+    finally: messages.close()
 
 # --- ИСПРАВЛЕНО: Явный SELECT ---
 def get_messages_for_chat_last_n(chat_id: int, limit: int, only_text: bool = False) -> List[Dict[str, Any]]:
@@ -211,149 +666,420 @@ def get_messages_for_chat_last_n(chat_id: int, limit: int, only_text: bool = Fal
     messages = []
     if limit <= 0: return messages
     # --- ИСПРАВЛЕНО: Явно указываем нужные колонки ---
-    select_cols = """
-        SELECT message_id, user_id, username, timestamp, message_type,
-               content, file_id, file_unique_id, file_name
+    select_cols = f"""
+        SELECT message_id, user_id, username, {_ts_ms()} AS timestamp, message_type,
+               content, file_id, file_unique_id, file_name, log_line, log_line_v
         FROM messages
     """
     # -------------------------------------------
     where_clause = " WHERE chat_id = ?"
     params = [chat_id]
     if only_text: where_clause += " AND message_type = 'text'"
-    where_clause += " ORDER BY timestamp DESC LIMIT ?"
+    where_clause += f" ORDER BY {_ts_ms()} DESC LIMIT ?"
     params.append(limit)
     sql = select_cols + where_clause
 
     try:
         rows = _execute_query(sql, tuple(params), fetch_all=True)
-        if rows:
-            messages = []
-            for row in reversed(rows): msg_dict = dict(row); msg_dict['type'] = msg_dict.pop('message_type', None); messages.append(msg_dict)
+        if rows: messages = [_message_from_row(row) for row in reversed(rows)]
+        if len(messages) < limit: messages = _archived_tail(chat_id, limit - len(messages), only_text, {m['message_id'] for m in messages}) + messages
         logger.debug(f"Извл {len(messages)} посл {'text ' if only_text else ''}сообщ chat={chat_id} limit={limit}.")
     except Exception:
         logger.error(f"Не уд извл посл {limit} {'text ' if only_text else ''}сообщ chat={chat_id}.")
     return messages
 
 # --- count_messages_since (без изменений) ---
-def count_messages_since(chat_id: int, since_datetime_utc: datetime.datetime) -> int:
-    """Считает количество сообщений с указанного времени UTC."""
-    if since_datetime_utc.tzinfo is None: since_datetime_utc = pytz.utc.localize(since_datetime_utc)
-    else: since_datetime_utc = since_datetime_utc.astimezone(pytz.utc)
-    since_iso_str = since_datetime_utc.isoformat()
-    sql = "SELECT COUNT(*) FROM messages WHERE chat_id = ? AND timestamp >= ?"
-    try: row = _execute_query(sql, (chat_id, since_iso_str), fetch_one=True); count = row[0] if row else 0; logger.debug(f"Found {count} msgs chat={chat_id} since {since_iso_str}."); return count
-    except Exception: logger.error(f"Failed count msgs chat={chat_id} since {since_iso_str}."); return 0
+def count_messages_since(chat_id: int, since: Union[datetime.datetime, int]) -> int:
+    """Считает количество сообщений с указанного момента (datetime или epoch ms)."""
+    since_ms = to_epoch_ms(since)
+    sql = f"SELECT COUNT(*) FROM messages WHERE chat_id = ? AND {_ts_ms()} >= ?"
+    try: row = _execute_query(sql, (chat_id, since_ms), fetch_one=True); count = (row[0] if row else 0) + _archived_count(chat_id, since_ms); logger.debug(f"Found {count} msgs chat={chat_id} since {since_ms}."); return count
+    except Exception: logger.error(f"Failed count msgs chat={chat_id} since {since_ms}."); return 0
+
+def get_referenced_photo_ids() -> Set[str]:
+    """file_unique_id всех фото, которые еще хранятся в messages (для очистки кэша изображений)."""
+    flush_message_buffer() # Фото из очереди записи тоже считаются живыми
+    sql = "SELECT DISTINCT file_unique_id FROM messages WHERE message_type = 'photo' AND file_unique_id IS NOT NULL"
+    try: rows = _execute_query(sql, fetch_all=True) or []; return {r[0] for r in rows}
+    except Exception: logger.error("Failed get referenced photo ids."); raise # Пустой набор удалил бы весь кэш
+
+def get_recent_activity_buckets(since: Union[datetime.datetime, int]) -> List[Tuple[int, int, int]]:
+    """Поминутные счетчики сообщений всех чатов с указанного момента: (chat_id, unix_minute, count). Для activity_tracker."""
+    since_ms = to_epoch_ms(since)
+    flush_message_buffer()
+    ts = _ts_ms()
+    sql = f"SELECT chat_id, {ts} / 60000 AS minute, COUNT(*) AS cnt FROM messages WHERE {ts} >= ? GROUP BY chat_id, minute"
+    try: rows = _execute_query(sql, (since_ms,), fetch_all=True) or []; return [(r['chat_id'], r['minute'], r['cnt']) for r in rows]
+    except Exception: logger.error(f"Failed get activity buckets since {since_ms}."); return []
 
 # --- clear_messages_for_chat (без изменений) ---
 def clear_messages_for_chat(chat_id: int):
+    flush_message_buffer() # Иначе сообщения из очереди "воскреснут" после очистки
     sql = "DELETE FROM messages WHERE chat_id = ?"
     try: deleted_rows = _execute_query(sql, (chat_id,)); logger.info(f"Purge ALL: Deleted {deleted_rows or 0} messages chat={chat_id}.")
     except Exception: logger.error(f"Failed purge ALL chat={chat_id}.")
+    try: _execute_query("DELETE FROM chat_activity_daily WHERE chat_id = ?", (chat_id,)) # Архивные дни триггер не уменьшает
+    except Exception: logger.error(f"Failed purge activity rollup chat={chat_id}.")
+    try: # Истории и конспекты пересказывают удаленные сообщения
+        _execute_query("DELETE FROM generated_outputs WHERE chat_id = ?", (chat_id,)); _execute_query("DELETE FROM partial_digests WHERE chat_id = ?", (chat_id,))
+    except Exception: logger.error(f"Failed purge generated outputs chat={chat_id}.")
+    if _archive_has_segments:
+        try: _execute_query("DELETE FROM archive_segments WHERE chat_id = ?", (chat_id,)); freed = message_archive.delete_chat(chat_id)
+        except Exception: logger.error(f"Failed purge archive chat={chat_id}.")
+        else:
+            if freed: logger.info(f"Purge ALL: Deleted archive of chat={chat_id} ({freed} bytes).")
 
-# --- delete_messages_older_than (без изменений) ---
-def delete_messages_older_than(chat_id: int, days: int):
-    if days <= 0: logger.warning(f"Attempt del msgs with invalid period ({days}) chat={chat_id}"); return
-    try: 
-        cutoff_dt = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days); cutoff_iso = cutoff_dt.isoformat(); sql = "DELETE FROM messages WHERE chat_id = ? AND timestamp < ?"; deleted_rows = _execute_query(sql, (chat_id, cutoff_iso))
-        if deleted_rows is not None and deleted_rows > 0: logger.info(f"Auto-Purge: Deleted {deleted_rows} messages older {days}d chat={chat_id}.")
+# --- Авто-очистка пачками ---
+# messages - WITHOUT ROWID, поэтому пачки выбираются по первичному ключу через индекс
+# (chat_id, timestamp_ms). Каждая пачка - короткая транзакция, между ними пауза,
+# чтобы ingest writer не ждал блокировку записи до busy_timeout.
+_purge_stats: Dict[str, Any] = {'runs': 0, 'last_rows': 0, 'last_bytes_freed': 0, 'last_duration_s': 0.0, 'last_run_ts': None, 'total_rows': 0, 'total_bytes_freed': 0}
+
+def _freelist_bytes(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA freelist_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+def _purge_chat_batched(chat_id: int, cutoff_ms: int) -> int:
+    deleted = 0
+    while True:
+        with _write_connection() as conn, conn: cur = conn.execute(f"DELETE FROM messages WHERE chat_id = ? AND message_id IN (SELECT message_id FROM messages WHERE chat_id = ? AND {_ts_ms()} < ? LIMIT ?)", (chat_id, chat_id, cutoff_ms, PURGE_BATCH_SIZE))
+        deleted += cur.rowcount
+        if cur.rowcount < PURGE_BATCH_SIZE: return deleted
+        backlog = _ingest_queue.qsize() > INGEST_BATCH_SIZE # Очередь записи растет - уступаем дольше
+        time.sleep(PURGE_BATCH_PAUSE_SEC * (4 if backlog else 1))
+
+def delete_messages_older_than(chat_id: int, days: int) -> int:
+    """Удаляет сообщения чата старше days дней пачками. Возвращает число удаленных строк."""
+    if days <= 0: logger.warning(f"Attempt del msgs with invalid period ({days}) chat={chat_id}"); return 0
+    try:
+        cutoff_ms = round(time.time() * 1000) - days * _DAY_MS
+        deleted_rows = _purge_chat_batched(chat_id, cutoff_ms) + _drop_archive_older_than(chat_id, cutoff_ms)[0]
+        if deleted_rows > 0: logger.info(f"Auto-Purge: Deleted {deleted_rows} messages older {days}d chat={chat_id}.")
         else: logger.debug(f"Auto-Purge: No old messages ({days}d) found/deleted chat={chat_id}.")
-    except Exception: logger.error(f"Failed Auto-Purge ({days}d) chat={chat_id}.")
+        return deleted_rows
+    except Exception: logger.error(f"Failed Auto-Purge ({days}d) chat={chat_id}.", exc_info=True); raise
+
+def purge_expired_messages(policies: Optional[List[Tuple[int, int]]] = None) -> Dict[str, Any]:
+    """Один проход авто-очистки по всем чатам со сроком хранения (chat_id, days).
+    Возвращает итоги: чаты, удаленные строки, освобожденные байты (рост freelist) и ошибки по чатам."""
+    policies = get_chats_with_retention() if policies is None else policies
+    started = time.perf_counter()
+    with _read_connection() as conn: free_before = _freelist_bytes(conn)
+    now_ms = round(time.time() * 1000)
+    rows_total = 0; chats_purged = 0; archive_freed = 0; errors: List[Tuple[int, int, str]] = []
+    for chat_id, days in policies:
+        if days <= 0: continue
+        try:
+            deleted = _purge_chat_batched(chat_id, now_ms - days * _DAY_MS)
+            archived_rows, freed = _drop_archive_older_than(chat_id, now_ms - days * _DAY_MS); deleted += archived_rows; archive_freed += freed
+        except (sqlite3.Error, OSError) as e: logger.error(f"Auto-Purge failed ({days}d) chat={chat_id}: {e}"); errors.append((chat_id, days, e.__class__.__name__)); continue
+        if deleted: rows_total += deleted; chats_purged += 1; logger.info(f"Auto-Purge: Deleted {deleted} messages older {days}d chat={chat_id}.")
+    with _read_connection() as conn: bytes_freed = max(0, _freelist_bytes(conn) - free_before) + archive_freed
+    duration = time.perf_counter() - started
+    _purge_stats.update(runs=_purge_stats['runs'] + 1, last_rows=rows_total, last_bytes_freed=bytes_freed, last_duration_s=duration, last_run_ts=time.time())
+    _purge_stats['total_rows'] += rows_total; _purge_stats['total_bytes_freed'] += bytes_freed
+    return {'chats': len(policies), 'chats_purged': chats_purged, 'rows': rows_total, 'bytes_freed': bytes_freed, 'duration_s': duration, 'errors': errors}
+
+def get_purge_stats() -> Dict[str, Any]:
+    """Итоги последних проходов очистки и текущий свободный объем файла БД (для /status)."""
+    stats = dict(_purge_stats)
+    try:
+        with _read_connection() as conn: stats['freelist_bytes'] = _freelist_bytes(conn)
+    except sqlite3.Error: stats['freelist_bytes'] = None
+    return stats
+
+# --- Холодный архив (message_archive, ARCHIVE_ENABLED) ---
+# Сообщения старше ARCHIVE_AFTER_DAYS переносятся в сегменты чат/месяц; учет сегментов - в archive_segments.
+# Горячая таблица, ее индексы и FTS остаются размером с окно, сводки chat_activity_daily
+# при переносе не уменьшаются (archiving() в триггере). Геттеры читают архив, только если запрос
+# выходит за горячее окно (есть сегмент с max_ts >= начала диапазона). Срок хранения архива
+# соблюдается удалением целых файлов; граничный месяц переписывается одним файлом.
+_archiving = False # Выставляется писателем на время удаления перенесенных строк
+_archive_has_segments = False # Пока архив пуст, геттеры не обращаются к archive_segments
+_ARCHIVE_SEGMENT_COLS = "month, rows, min_ts, max_ts"
+
+def _init_archive():
+    global _archive_has_segments
+    _execute_query("""
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            chat_id INTEGER NOT NULL, month TEXT NOT NULL, rows INTEGER NOT NULL,
+            min_ts INTEGER NOT NULL, max_ts INTEGER NOT NULL, bytes INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, month)
+        ) WITHOUT ROWID
+    """)
+    _archive_has_segments = _execute_query("SELECT 1 FROM archive_segments LIMIT 1", fetch_one=True) is not None
+
+def _iter_chat_ids() -> Iterator[int]:
+    """chat_id всех чатов с сообщениями: прыжки по первичному ключу вместо полного DISTINCT-скана."""
+    row = _execute_query("SELECT MIN(chat_id) FROM messages", fetch_one=True)
+    while row and row[0] is not None:
+        yield row[0]
+        row = _execute_query("SELECT MIN(chat_id) FROM messages WHERE chat_id > ?", (row[0],), fetch_one=True)
+
+def _archive_chat(chat_id: int, cutoff_ms: int) -> Tuple[int, int]:
+    """Переносит сообщения чата старше cutoff_ms в архив пачками. Возвращает (строк, сегментов затронуто).
+    Порядок: запись сегмента + fsync, затем одной транзакцией учет сегмента и удаление строк.
+    При сбое между ними строки попадут в архив повторно - при чтении дубликаты отбрасываются."""
+    global _archiving, _archive_has_segments
+    moved = 0; touched: Set[str] = set()
+    while True:
+        rows = _execute_query("""
+            SELECT message_id, user_id, username, timestamp_ms AS timestamp, message_type, content, file_id, file_unique_id, file_name
+            FROM messages WHERE chat_id = ? AND timestamp_ms < ? ORDER BY timestamp_ms LIMIT ?
+        """, (chat_id, cutoff_ms, ARCHIVE_BATCH_SIZE), fetch_all=True)
+        if not rows: return moved, len(touched)
+        by_month: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            message = _message_from_row(row)
+            by_month.setdefault(message_archive.month_of(message['timestamp']), []).append(message)
+        sizes = {month: message_archive.append_segment(chat_id, month, batch) for month, batch in by_month.items()}
+        with _write_connection() as conn, conn:
+            for month, batch in by_month.items():
+                conn.execute("""
+                    INSERT INTO archive_segments (chat_id, month, rows, min_ts, max_ts, bytes) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (chat_id, month) DO UPDATE SET rows = rows + excluded.rows, min_ts = MIN(min_ts, excluded.min_ts),
+                        max_ts = MAX(max_ts, excluded.max_ts), bytes = excluded.bytes
+                """, (chat_id, month, len(batch), batch[0]['timestamp'], batch[-1]['timestamp'], sizes[month]))
+            _archiving = True
+            try: conn.executemany("DELETE FROM messages WHERE chat_id = ? AND message_id = ?", [(chat_id, r['message_id']) for r in rows])
+            finally: _archiving = False
+        _archive_has_segments = True
+        moved += len(rows); touched.update(by_month)
+        if len(rows) < ARCHIVE_BATCH_SIZE: return moved, len(touched)
+        time.sleep(PURGE_BATCH_PAUSE_SEC) # Уступаем запись ingest
+
+def archive_old_messages(after_days: int = ARCHIVE_AFTER_DAYS) -> Dict[str, Any]:
+    """Проход архивации по всем чатам. Требует готовых сводок: после переноса сводки уже не пересчитать из messages."""
+    if not _rollups_ready: logger.info("Archive: сводки активности еще строятся, перенос отложен."); return {'chats': 0, 'rows': 0, 'segments': 0, 'duration_s': 0.0}
+    started = time.perf_counter()
+    cutoff_ms = round(time.time() * 1000) - after_days * _DAY_MS
+    flush_message_buffer()
+    chats = 0; rows_total = 0; segments = 0
+    for chat_id in list(_iter_chat_ids()):
+        moved, touched = _archive_chat(chat_id, cutoff_ms)
+        if moved: chats += 1; rows_total += moved; segments += touched; logger.info(f"Archive: {moved} сообщений чата {chat_id} перенесено в архив ({touched} сегм.).")
+    duration = time.perf_counter() - started
+    logger.info(f"Archive: перенесено {rows_total} сообщений из {chats} чатов за {duration:.1f}s.")
+    return {'chats': chats, 'rows': rows_total, 'segments': segments, 'duration_s': duration}
+
+def _archive_segments_for(chat_id: int, since_ms: Optional[int] = None) -> List[sqlite3.Row]:
+    if not _archive_has_segments: return []
+    return _execute_query(f"SELECT {_ARCHIVE_SEGMENT_COLS} FROM archive_segments WHERE chat_id = ? AND max_ts >= ? ORDER BY month", (chat_id, since_ms if since_ms is not None else -2**63), fetch_all=True) or []
+
+def _iter_archived_messages(chat_id: int, since_ms: Optional[int] = None, until_ms: Optional[int] = None, segments: Optional[List[sqlite3.Row]] = None) -> Iterator[Dict[str, Any]]:
+    """Сообщения чата из архива в диапазоне, по времени: в памяти один сегмент (месяц) за раз.
+    Дубликаты (повторный перенос после сбоя) лежат в том же месяце и отбрасываются внутри сегмента."""
+    for seg in (segments if segments is not None else _archive_segments_for(chat_id, since_ms)):
+        if until_ms is not None and seg['min_ts'] >= until_ms: continue
+        unique = {m['message_id']: m for m in message_archive.read_segment(message_archive.segment_path(chat_id, seg['month']), since_ms, until_ms)}
+        yield from sorted(unique.values(), key=lambda m: m['timestamp'])
+
+def _archived_messages(chat_id: int, since_ms: Optional[int] = None, until_ms: Optional[int] = None, segments: Optional[List[sqlite3.Row]] = None) -> List[Dict[str, Any]]:
+    """Сообщения чата из архива в диапазоне (без дубликатов, по времени)."""
+    return list(_iter_archived_messages(chat_id, since_ms, until_ms, segments))
+
+def _archived_tail(chat_id: int, limit: int, only_text: bool, exclude_ids: Set[int]) -> List[Dict[str, Any]]:
+    """Последние limit архивных сообщений (для get_messages_for_chat_last_n): сегменты читаются от новых к старым."""
+    segments = _archive_segments_for(chat_id)
+    tail: List[Dict[str, Any]] = []
+    for seg in reversed(segments):
+        batch = [m for m in _archived_messages(chat_id, segments=[seg]) if m['message_id'] not in exclude_ids and (not only_text or m['type'] == 'text')]
+        tail = batch + tail
+        if len(tail) >= limit: break
+    return tail[-limit:] if tail else []
+
+def _archived_count(chat_id: int, since_ms: int) -> int:
+    total = 0
+    for seg in _archive_segments_for(chat_id, since_ms):
+        if seg['min_ts'] >= since_ms: total += seg['rows'] # Сегмент целиком в диапазоне - без чтения файла
+        else: total += len(_archived_messages(chat_id, since_ms, segments=[seg]))
+    return total
+
+def _drop_archive_older_than(chat_id: int, cutoff_ms: int) -> Tuple[int, int]:
+    """Срок хранения для архива: удаляет целые сегменты старше cutoff_ms, граничный переписывает.
+    Возвращает (строк удалено, байт освобождено)."""
+    if not _archive_has_segments: return 0, 0
+    rows_dropped = 0; freed = 0
+    for seg in _execute_query(f"SELECT {_ARCHIVE_SEGMENT_COLS}, bytes FROM archive_segments WHERE chat_id = ? AND min_ts < ?", (chat_id, cutoff_ms), fetch_all=True) or []:
+        path = message_archive.segment_path(chat_id, seg['month'])
+        if seg['max_ts'] < cutoff_ms:
+            freed += message_archive.delete_segment(path); rows_dropped += seg['rows']
+            _execute_query("DELETE FROM archive_segments WHERE chat_id = ? AND month = ?", (chat_id, seg['month']))
+            continue
+        cutoff_day = cutoff_ms // _DAY_MS # Сводку граничного дня уменьшаем поштучно, более ранние дни удаляются целиком
+        dropped_today = {m['message_id']: m for m in message_archive.read_segment(path, cutoff_day * _DAY_MS, cutoff_ms)}.values()
+        kept, min_ts, size = message_archive.rewrite_segment(path, cutoff_ms)
+        if dropped_today:
+            with _write_connection() as conn, conn:
+                for m in dropped_today:
+                    conn.execute("UPDATE chat_activity_daily SET cnt = cnt - 1 WHERE chat_id = ? AND day = ? AND user_id = ? AND message_type = ?", (chat_id, cutoff_day, m['user_id'], m['type']))
+                conn.execute("DELETE FROM chat_activity_daily WHERE chat_id = ? AND day = ? AND cnt <= 0", (chat_id, cutoff_day))
+        rows_dropped += max(0, seg['rows'] - kept); freed += max(0, seg['bytes'] - size)
+        if kept: _execute_query("UPDATE archive_segments SET rows = ?, min_ts = ?, bytes = ? WHERE chat_id = ? AND month = ?", (kept, min_ts, size, chat_id, seg['month']))
+        else: _execute_query("DELETE FROM archive_segments WHERE chat_id = ? AND month = ?", (chat_id, seg['month']))
+    if rows_dropped: # Сводки по удаленным дням: при переносе они не уменьшались
+        _execute_query("DELETE FROM chat_activity_daily WHERE chat_id = ? AND day < ?", (chat_id, cutoff_ms // _DAY_MS))
+    return rows_dropped, freed
+
+def _archived_stats_rows(chat_id: int, since_ms: int, until_ms: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Строки для aggregate_chat_stats по архивным сообщениям диапазона."""
+    counts: Dict[Tuple[int, str], Dict[str, Any]] = {}
+    for m in _archived_messages(chat_id, since_ms, until_ms):
+        entry = counts.setdefault((m['user_id'], m['type']), {'user_id': m['user_id'], 'message_type': m['type'], 'cnt': 0, 'username': m['username']})
+        entry['cnt'] += 1
+        if m['username']: entry['username'] = m['username']
+    return list(counts.values())
+
+def get_archive_stats() -> Dict[str, Any]:
+    row = _execute_query("SELECT COUNT(*), COALESCE(SUM(rows), 0), COALESCE(SUM(bytes), 0) FROM archive_segments", fetch_one=True)
+    return {'segments': row[0], 'rows': row[1], 'bytes': row[2]}
 
 
 # --- Функции для Настроек Чата ---
-# --- get_chat_settings (без изменений) ---
+# --- Кэш настроек (LRU + TTL, write-through из update_chat_setting) ---
+# Настройки читаются на каждом сообщении/экране, а меняются редко, поэтому держим
+# их в памяти. _settings_cache_version защищает от гонки: если между SELECT и
+# записью в кэш прошел update_chat_setting, прочитанное значение в кэш не кладем.
+_settings_cache: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_settings_cache_lock = threading.Lock()
+_settings_cache_version = 0
+_settings_cache_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def peek_chat_settings(chat_id: int) -> Optional[Dict[str, Any]]:
+    """Возвращает копию настроек из кэша или None (без обращения к БД)."""
+    with _settings_cache_lock:
+        entry = _settings_cache.get(chat_id)
+        if entry is None: return None
+        if time.monotonic() - entry[0] > SETTINGS_CACHE_TTL_SEC: del _settings_cache[chat_id]; return None
+        _settings_cache.move_to_end(chat_id); _settings_cache_stats['hits'] += 1
+        return dict(entry[1])
+
+def settings_cache_put(chat_id: int, settings: Dict[str, Any], version: int):
+    with _settings_cache_lock:
+        if version != _settings_cache_version: return # Настройки менялись во время чтения
+        _settings_cache[chat_id] = (time.monotonic(), dict(settings)); _settings_cache.move_to_end(chat_id)
+        while len(_settings_cache) > SETTINGS_CACHE_MAX_SIZE: _settings_cache.popitem(last=False); _settings_cache_stats['evictions'] += 1
+
+def settings_cache_write_through(chat_id: int, setting_key: str, value: Any):
+    global _settings_cache_version
+    with _settings_cache_lock:
+        _settings_cache_version += 1
+        entry = _settings_cache.get(chat_id)
+        if entry: entry[1][setting_key] = value # TTL не продлеваем: запись все равно перечитается из БД
+
+def settings_cache_version() -> int:
+    """Текущая версия кэша настроек (снимать до чтения из хранилища, передавать в settings_cache_put)."""
+    with _settings_cache_lock: return _settings_cache_version
+
+def invalidate_chat_settings_cache(chat_id: Optional[int] = None):
+    """Сбрасывает кэш настроек одного чата или целиком."""
+    global _settings_cache_version
+    with _settings_cache_lock:
+        _settings_cache_version += 1
+        if chat_id is None: _settings_cache.clear()
+        else: _settings_cache.pop(chat_id, None)
+
+def get_settings_cache_stats() -> Dict[str, int]:
+    with _settings_cache_lock: return dict(_settings_cache_stats, size=len(_settings_cache))
+
+# --- get_chat_settings ---
 def get_chat_settings(chat_id: int) -> Dict[str, Any]:
+    cached = peek_chat_settings(chat_id)
+    if cached is not None: return cached
+    with _settings_cache_lock: version = _settings_cache_version; _settings_cache_stats['misses'] += 1
     fields = "lang, enabled, custom_schedule_time, timezone, story_genre, retention_days, output_format, story_personality, allow_interventions, last_intervention_ts, intervention_cooldown_minutes, intervention_min_msgs, intervention_timespan_minutes"
     sql_select = f"SELECT {fields} FROM chat_settings WHERE chat_id = ?"
     # Дефолты для словаря и для INSERT
-    default_retention_val = None if DEFAULT_RETENTION_DAYS <= 0 else DEFAULT_RETENTION_DAYS
-    default_retention_db = "NULL" if DEFAULT_RETENTION_DAYS <= 0 else str(DEFAULT_RETENTION_DAYS)
-    intervention_enabled_db = 1 if INTERVENTION_ENABLED_DEFAULT else 0
-    default_settings = {'lang': DEFAULT_LANGUAGE, 'enabled': True, 'custom_schedule_time': None, 'timezone': 'UTC', 'story_genre': 'default', 'retention_days': default_retention_val, 'output_format': DEFAULT_OUTPUT_FORMAT, 'story_personality': DEFAULT_PERSONALITY, 'allow_interventions': INTERVENTION_ENABLED_DEFAULT, 'last_intervention_ts': 0, 'intervention_cooldown_minutes': None, 'intervention_min_msgs': None, 'intervention_timespan_minutes': None }
-    sql_insert = f"INSERT OR IGNORE INTO chat_settings({','.join(default_settings.keys())}) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+    default_settings = default_chat_settings()
+    sql_insert = f"INSERT OR IGNORE INTO chat_settings(chat_id,{','.join(default_settings.keys())}) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
     try:
         row = _execute_query(sql_select, (chat_id,), fetch_one=True)
-        if row: s = dict(row); s['enabled'] = bool(s.get('enabled',1)); s['allow_interventions'] = bool(s.get('allow_interventions',INTERVENTION_ENABLED_DEFAULT)); return s
+        if row: s = dict(row); s['enabled'] = bool(s.get('enabled',1)); s['allow_interventions'] = bool(s.get('allow_interventions',INTERVENTION_ENABLED_DEFAULT))
         else: # Create defaults
             logger.info(f"Creating default settings for chat={chat_id}")
-            params = (chat_id, DEFAULT_LANGUAGE, 1, None, 'UTC', 'default', default_retention_db, DEFAULT_OUTPUT_FORMAT, DEFAULT_PERSONALITY, intervention_enabled_db, 0, None, None, None)
+            params = (chat_id, *(int(v) if isinstance(v, bool) else v for v in default_settings.values()))
             _execute_query(sql_insert, params)
-            return default_settings
+            sync_chat_schedule(chat_id) # Новый чат включен по умолчанию - ставим в расписание
+            s = dict(default_settings)
+        settings_cache_put(chat_id, s, version)
+        return s
     except Exception: logger.exception(f"Failed get/create settings chat={chat_id}. Returning defaults."); return default_settings
 
 
-# --- update_chat_setting (без изменений) ---
-def update_chat_setting(chat_id: int, setting_key: str, setting_value: Optional[Union[str, bool, int]]) -> bool:
+# --- Настройки: ключи, дефолты и проверка значений (общие для всех бэкендов хранилища) ---
+CHAT_SETTING_KEYS = (
+    'lang', 'enabled', 'custom_schedule_time', 'timezone', 'story_genre',
+    'retention_days', 'output_format', 'story_personality', 'allow_interventions',
+    'last_intervention_ts',
+    'intervention_cooldown_minutes', 'intervention_min_msgs', 'intervention_timespan_minutes'
+)
+
+def default_chat_settings() -> Dict[str, Any]:
+    """Настройки нового чата (в том же виде, что возвращает get_chat_settings)."""
+    return {'lang': DEFAULT_LANGUAGE, 'enabled': True, 'custom_schedule_time': None, 'timezone': 'UTC', 'story_genre': 'default', 'retention_days': None if DEFAULT_RETENTION_DAYS <= 0 else DEFAULT_RETENTION_DAYS, 'output_format': DEFAULT_OUTPUT_FORMAT, 'story_personality': DEFAULT_PERSONALITY, 'allow_interventions': INTERVENTION_ENABLED_DEFAULT, 'last_intervention_ts': 0, 'intervention_cooldown_minutes': None, 'intervention_min_msgs': None, 'intervention_timespan_minutes': None }
+
+def normalize_setting_value(setting_key: str, setting_value: Optional[Union[str, bool, int]]) -> Optional[Union[str, int]]:
     """
-    Обновляет одну настройку чата. Валидация специфичная для параметров (кроме базовых типов)
-    теперь в основном лежит на вызывающем коде (bot_handlers.py).
-    Возвращает True при успехе, False при ошибке.
+    Проверяет значение настройки и приводит его к виду для хранения. При ошибке бросает ValueError.
+    Валидация, специфичная для параметров (кроме базовых типов), лежит на вызывающем коде (bot_handlers.py).
     """
-    allowed_keys = [
-        'lang', 'enabled', 'custom_schedule_time', 'timezone', 'story_genre',
-        'retention_days', 'output_format', 'story_personality', 'allow_interventions',
-        'last_intervention_ts', 
-        'intervention_cooldown_minutes', 'intervention_min_msgs', 'intervention_timespan_minutes'
-    ]
-    if setting_key not in allowed_keys:
-        logger.error(f"Попытка обновить неверный ключ настройки '{setting_key}' для чата {chat_id}")
-        return False
-
-    value_to_save: Optional[Union[str, int]] = None 
-    
-    # --- Блок Валидации Базовых Типов и Форматов ---
-    try:
-        if setting_key == 'lang':
-            if not isinstance(setting_value, str) or setting_value not in SUPPORTED_LANGUAGES:
-                raise ValueError(f"Недопустимый язык: {setting_value}")
+    value_to_save: Optional[Union[str, int]] = None
+    if setting_key == 'lang':
+        if not isinstance(setting_value, str) or setting_value not in SUPPORTED_LANGUAGES:
+            raise ValueError(f"Недопустимый язык: {setting_value}")
+        value_to_save = setting_value
+    elif setting_key in ['enabled', 'allow_interventions']:
+        value_to_save = 1 if bool(setting_value) else 0
+    elif setting_key == 'custom_schedule_time':
+        if setting_value is None: value_to_save = None
+        elif isinstance(setting_value, str) and re.fullmatch(r"^(?:[01]\d|2[0-3]):[0-5]\d$", setting_value):
             value_to_save = setting_value
-        elif setting_key in ['enabled', 'allow_interventions']:
-            value_to_save = 1 if bool(setting_value) else 0
-        elif setting_key == 'custom_schedule_time':
-            if setting_value is None: value_to_save = None
-            elif isinstance(setting_value, str) and re.fullmatch(r"^(?:[01]\d|2[0-3]):[0-5]\d$", setting_value):
-                value_to_save = setting_value
-            else: raise ValueError(f"Неверный формат времени HH:MM: {setting_value}")
-        elif setting_key == 'timezone':
-            if not isinstance(setting_value, str): raise ValueError(f"Таймзона должна быть строкой: {setting_value}")
-            try: pytz.timezone(setting_value); value_to_save = setting_value
-            except pytz.exceptions.UnknownTimeZoneError: raise ValueError(f"Неизвестная таймзона: {setting_value}")
-        elif setting_key == 'story_genre':
-            if not isinstance(setting_value, str) or setting_value not in SUPPORTED_GENRES:
-                raise ValueError(f"Недопустимый жанр: {setting_value}")
+        else: raise ValueError(f"Неверный формат времени HH:MM: {setting_value}")
+    elif setting_key == 'timezone':
+        if not isinstance(setting_value, str): raise ValueError(f"Таймзона должна быть строкой: {setting_value}")
+        try: pytz.timezone(setting_value); value_to_save = setting_value
+        except pytz.exceptions.UnknownTimeZoneError: raise ValueError(f"Неизвестная таймзона: {setting_value}")
+    elif setting_key == 'story_genre':
+        if not isinstance(setting_value, str) or setting_value not in SUPPORTED_GENRES:
+            raise ValueError(f"Недопустимый жанр: {setting_value}")
+        value_to_save = setting_value
+    elif setting_key == 'output_format':
+         if not isinstance(setting_value, str) or setting_value not in SUPPORTED_OUTPUT_FORMATS:
+             raise ValueError(f"Недопустимый формат вывода: {setting_value}")
+         value_to_save = setting_value
+    elif setting_key == 'story_personality':
+         if not isinstance(setting_value, str) or setting_value not in SUPPORTED_PERSONALITIES:
+             raise ValueError(f"Недопустимая личность: {setting_value}")
+         value_to_save = setting_value
+    elif setting_key == 'retention_days':
+         if setting_value is None: value_to_save = None
+         elif isinstance(setting_value, int) and setting_value >= 0:
+             value_to_save = None if setting_value == 0 else setting_value 
+         else: raise ValueError("Срок хранения должен быть целым неотрицательным числом (0 = вечно)")
+    
+    # Для числовых настроек вмешательств и last_intervention_ts - просто проверяем тип
+    # Сама коррекция (если нужна для кнопок) и валидация (для ручного ввода владельца)
+    # теперь полностью в bot_handlers.py
+    elif setting_key in ['last_intervention_ts', 'intervention_cooldown_minutes', 'intervention_min_msgs', 'intervention_timespan_minutes']:
+        if setting_value is None: # Разрешаем NULL для настроек вмешательств (будут использоваться дефолты из config)
+            value_to_save = None
+        elif isinstance(setting_value, int):
+            # Проверка на > 0 для этих параметров уже сделана в _handle_intervention_setting_input
+            # Для кнопочного ввода значения всегда корректны.
             value_to_save = setting_value
-        elif setting_key == 'output_format':
-             if not isinstance(setting_value, str) or setting_value not in SUPPORTED_OUTPUT_FORMATS:
-                 raise ValueError(f"Недопустимый формат вывода: {setting_value}")
-             value_to_save = setting_value
-        elif setting_key == 'story_personality':
-             if not isinstance(setting_value, str) or setting_value not in SUPPORTED_PERSONALITIES:
-                 raise ValueError(f"Недопустимая личность: {setting_value}")
-             value_to_save = setting_value
-        elif setting_key == 'retention_days':
-             if setting_value is None: value_to_save = None
-             elif isinstance(setting_value, int) and setting_value >= 0:
-                 value_to_save = None if setting_value == 0 else setting_value 
-             else: raise ValueError("Срок хранения должен быть целым неотрицательным числом (0 = вечно)")
-        
-        # Для числовых настроек вмешательств и last_intervention_ts - просто проверяем тип
-        # Сама коррекция (если нужна для кнопок) и валидация (для ручного ввода владельца)
-        # теперь полностью в bot_handlers.py
-        elif setting_key in ['last_intervention_ts', 'intervention_cooldown_minutes', 'intervention_min_msgs', 'intervention_timespan_minutes']:
-            if setting_value is None: # Разрешаем NULL для настроек вмешательств (будут использоваться дефолты из config)
-                value_to_save = None
-            elif isinstance(setting_value, int):
-                # Проверка на > 0 для этих параметров уже сделана в _handle_intervention_setting_input
-                # Для кнопочного ввода значения всегда корректны.
-                value_to_save = setting_value
-            else:
-                raise ValueError(f"Значение для '{setting_key}' должно быть целым числом или None")
         else:
-            # Эта ветка не должна достигаться из-за allowed_keys, но на всякий случай
-            logger.error(f"Необработанный ключ настройки '{setting_key}' в data_manager.update_chat_setting")
-            return False
+            raise ValueError(f"Значение для '{setting_key}' должно быть целым числом или None")
+    else: raise ValueError(f"Неверный ключ настройки '{setting_key}'")
+    return value_to_save
 
-    except ValueError as validation_e: # Ловим только ValueError от проверок выше
+def update_chat_setting(chat_id: int, setting_key: str, setting_value: Optional[Union[str, bool, int]]) -> bool:
+    """
+    Обновляет одну настройку чата. Возвращает True при успехе, False при ошибке.
+    """
+    if setting_key not in CHAT_SETTING_KEYS:
+        logger.error(f"Попытка обновить неверный ключ настройки '{setting_key}' для чата {chat_id}")
+        return False
+    try: value_to_save = normalize_setting_value(setting_key, setting_value)
+    except ValueError as validation_e: # Ловим только ValueError от проверок
         logger.error(f"Ошибка валидации значения в data_manager: ключ='{setting_key}', значение='{setting_value}', чат={chat_id}: {validation_e}")
         return False
 
@@ -369,23 +1095,20 @@ def update_chat_setting(chat_id: int, setting_key: str, setting_value: Optional[
         # Флаг 'was_corrected' больше здесь не актуален, т.к. data_manager не должен корректировать.
         # Логгер в bot_handlers сообщит о коррекции, если она была там.
         logger.info(f"Настройка '{setting_key}' для чата={chat_id} обновлена на '{value_to_save}'.")
-
-        if setting_key == 'lang' and isinstance(value_to_save, str):
-            try:
-                from localization import update_chat_lang_cache
-                update_chat_lang_cache(chat_id, value_to_save)
-            except ImportError: logger.error("Не удалось импортировать localization для обновления кэша языка.")
-            except Exception as cache_e: logger.error(f"Ошибка при обновлении кэша языка для чата {chat_id}: {cache_e}")
+        # Write-through: в кэше храним те же типы, что возвращает get_chat_settings
+        cached_value = bool(value_to_save) if setting_key in ('enabled', 'allow_interventions') else value_to_save
+        settings_cache_write_through(chat_id, setting_key, cached_value)
+        if setting_key in ('enabled', 'custom_schedule_time'): sync_chat_schedule(chat_id)
         return True
     except Exception:
         logger.error(f"Не удалось сохранить настройку '{setting_key}'='{setting_value}' для чата={chat_id} в БД.")
+        invalidate_chat_settings_cache(chat_id) # Состояние БД неизвестно - перечитаем при следующем запросе
         return False
 
 
 # --- Функции Получения Настроек (без изменений) ---
-def get_chat_language(chat_id: int) -> str: # Без изменений логики
-    try: from localization import get_chat_lang as get_cached_lang; return get_cached_lang(chat_id)
-    except ImportError: settings = get_chat_settings(chat_id); return settings.get('lang', DEFAULT_LANGUAGE)
+def get_chat_language(chat_id: int) -> str: # Берется из кэша настроек
+    lang = get_chat_settings(chat_id).get('lang'); return lang if lang in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
 
 def get_enabled_chats() -> List[int]:
     chat_ids = []
@@ -426,61 +1149,478 @@ def get_chat_personality(chat_id: int) -> str: # Без изменений ло
 def get_chat_retention_days(chat_id: int) -> Optional[int]: # Без изменений логики
     settings = get_chat_settings(chat_id); days = settings.get('retention_days'); return days if isinstance(days, int) and days > 0 else None
 
-def get_chats_with_retention() -> List[Tuple[int, int]]: # Без изменений логики
-    chats = []; sql = "SELECT chat_id, retention_days FROM chat_settings WHERE retention_days IS NOT NULL AND retention_days > 0"; 
-    try: 
-        rows = _execute_query(sql, fetch_all=True); 
-        if rows: chats = [(row['chat_id'], row['retention_days']) for row in rows]; 
-    except Exception: logger.error("Failed get chats for purge."); logger.debug(f"Found {len(chats)} chats with retention."); return chats
+def get_chats_with_retention() -> List[Tuple[int, int]]:
+    chats = []; sql = "SELECT chat_id, retention_days FROM chat_settings WHERE retention_days IS NOT NULL AND retention_days > 0"
+    try:
+        rows = _execute_query(sql, fetch_all=True)
+        if rows: chats = [(row['chat_id'], row['retention_days']) for row in rows]
+    except Exception: logger.error("Failed get chats for purge.")
+    logger.debug(f"Found {len(chats)} chats with retention."); return chats
 
 def get_intervention_settings(chat_id: int) -> Dict[str, Any]: # Без изменений логики
-    settings = get_chat_settings(chat_id); return {'allow_interventions': settings.get('allow_interventions', INTERVENTION_ENABLED_DEFAULT), 'last_intervention_ts': settings.get('last_intervention_ts', 0), 'cooldown_minutes': settings.get('intervention_cooldown_minutes') or INTERVENTION_DEFAULT_COOLDOWN_MIN, 'min_msgs': settings.get('intervention_min_msgs') or INTERVENTION_DEFAULT_MIN_MSGS, 'timespan_minutes': settings.get('intervention_timespan_minutes') or INTERVENTION_DEFAULT_TIMESPAN_MIN }
+    return intervention_settings_from(get_chat_settings(chat_id))
+
+def intervention_settings_from(settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Собирает эффективные настройки вмешательств (с дефолтами из config) из словаря настроек чата."""
+    return {'allow_interventions': settings.get('allow_interventions', INTERVENTION_ENABLED_DEFAULT), 'last_intervention_ts': settings.get('last_intervention_ts', 0), 'cooldown_minutes': settings.get('intervention_cooldown_minutes') or INTERVENTION_DEFAULT_COOLDOWN_MIN, 'min_msgs': settings.get('intervention_min_msgs') or INTERVENTION_DEFAULT_MIN_MSGS, 'timespan_minutes': settings.get('intervention_timespan_minutes') or INTERVENTION_DEFAULT_TIMESPAN_MIN }
+
+# --- Расписание генерации (chat_schedule) ---
+# Вместо перебора всех включенных чатов на каждом тике храним для каждого чата
+# нормализованный слот (минута суток UTC) и время следующего запуска (unix ts).
+# daily_story_job одним запросом по индексу забирает чаты с next_run_ts <= now.
+_DEFAULT_SLOT_MINUTE = SCHEDULE_HOUR * 60 + SCHEDULE_MINUTE
+
+def _slot_minute_from(custom_schedule_time: Optional[str]) -> int:
+    """'HH:MM' UTC -> минута суток; при отсутствии/ошибке - время по умолчанию из config."""
+    if not custom_schedule_time: return _DEFAULT_SLOT_MINUTE
+    try: h, m = map(int, custom_schedule_time.split(':')); return (h * 60 + m) % 1440
+    except (ValueError, TypeError): logger.warning(f"Invalid schedule time '{custom_schedule_time}', using default."); return _DEFAULT_SLOT_MINUTE
 
-# --- Функция Статистики (без изменений) ---
-def get_chat_stats(chat_id: int, since_datetime_utc: datetime.datetime) -> Optional[Dict[str, Any]]: # <-- ИЗМЕНЕНО: Возвращаем Optional[Dict]
-    """Собирает статистику чата с указанного времени UTC. Возвращает None при ошибке."""
+def _next_slot_ts(slot_minute: int, after_ts: float) -> int:
+    """Ближайший момент слота строго после after_ts (unix ts, UTC)."""
+    day_start = int(after_ts // 86400) * 86400
+    candidate = day_start + slot_minute * 60
+    return candidate if candidate > after_ts else candidate + 86400
+
+def sync_chat_schedule(chat_id: int):
+    """Приводит строку chat_schedule чата в соответствие с настройками (enabled, custom_schedule_time)."""
+    try:
+        row = _execute_query("SELECT enabled, custom_schedule_time FROM chat_settings WHERE chat_id = ?", (chat_id,), fetch_one=True)
+        if not row or not row['enabled']: _execute_query("DELETE FROM chat_schedule WHERE chat_id = ?", (chat_id,)); return
+        slot = _slot_minute_from(row['custom_schedule_time'])
+        current = _execute_query("SELECT slot_minute_utc FROM chat_schedule WHERE chat_id = ?", (chat_id,), fetch_one=True)
+        if current and current['slot_minute_utc'] == slot: return # Слот не изменился - next_run_ts не трогаем
+        next_ts = _next_slot_ts(slot, time.time())
+        _execute_query("INSERT INTO chat_schedule (chat_id, slot_minute_utc, next_run_ts) VALUES (?, ?, ?) ON CONFLICT(chat_id) DO UPDATE SET slot_minute_utc = excluded.slot_minute_utc, next_run_ts = excluded.next_run_ts", (chat_id, slot, next_ts))
+        logger.debug(f"Schedule chat={chat_id}: slot={slot // 60:02d}:{slot % 60:02d} UTC, next_run_ts={next_ts}.")
+    except Exception: logger.error(f"Failed sync schedule chat={chat_id}.")
+
+def _sync_all_chat_schedules():
+    """Синхронизация при старте: добавляет/обновляет строки включенных чатов, удаляет выключенные."""
+    _execute_query("DELETE FROM chat_schedule WHERE chat_id NOT IN (SELECT chat_id FROM chat_settings WHERE enabled = 1)")
+    rows = _execute_query("""
+        SELECT s.chat_id, s.custom_schedule_time, c.slot_minute_utc FROM chat_settings s
+        LEFT JOIN chat_schedule c ON c.chat_id = s.chat_id WHERE s.enabled = 1
+    """, fetch_all=True) or []
+    now_ts = time.time(); changes = []
+    for r in rows:
+        slot = _slot_minute_from(r['custom_schedule_time'])
+        if r['slot_minute_utc'] != slot: changes.append((r['chat_id'], slot, _next_slot_ts(slot, now_ts)))
+    if changes:
+        with _write_connection() as conn, conn: conn.executemany("INSERT INTO chat_schedule (chat_id, slot_minute_utc, next_run_ts) VALUES (?, ?, ?) ON CONFLICT(chat_id) DO UPDATE SET slot_minute_utc = excluded.slot_minute_utc, next_run_ts = excluded.next_run_ts", changes)
+        logger.info(f"chat_schedule: обновлено {len(changes)} строк расписания.")
+
+def claim_due_chats(now_ts: Optional[float] = None) -> List[Tuple[int, int]]:
+    """
+    Забирает чаты, у которых наступило время сводки: [(chat_id, scheduled_ts)].
+    next_run_ts сразу сдвигается на следующий слот (в той же транзакции), поэтому
+    чат не будет выдан повторно. Пропущенные за время простоя слоты догоняются,
+    если опоздание не больше SCHEDULE_CATCHUP_MAX_HOURS; более старые пропускаются.
+    """
+    now_ts = now_ts if now_ts is not None else time.time()
+    max_lateness = SCHEDULE_CATCHUP_MAX_HOURS * 3600
+    due: List[Tuple[int, int]] = []
+    try:
+        with _write_connection() as conn, conn: # Чтение и сдвиг в одной транзакции писателя
+            rows = conn.execute("SELECT chat_id, slot_minute_utc, next_run_ts FROM chat_schedule WHERE next_run_ts <= ?", (int(now_ts),)).fetchall()
+            updates = []
+            for r in rows:
+                if now_ts - r['next_run_ts'] <= max_lateness: due.append((r['chat_id'], r['next_run_ts']))
+                else: logger.warning(f"Schedule chat={r['chat_id']}: slot {r['next_run_ts']} missed by {(now_ts - r['next_run_ts']) / 3600:.1f}h, skipping.")
+                updates.append((_next_slot_ts(r['slot_minute_utc'], now_ts), r['chat_id']))
+            if updates: conn.executemany("UPDATE chat_schedule SET next_run_ts = ? WHERE chat_id = ?", updates)
+        if due: logger.debug(f"Claimed {len(due)} due chats: {[cid for cid, _ in due]}")
+    except sqlite3.Error as e: logger.error(f"Failed claim due chats: {e}", exc_info=True)
+    return due
+
+# --- Сводки активности (chat_activity_daily) ---
+# Триггеры на messages поддерживают сводку при каждой вставке/удалении (включая очистку
+# и авто-удаление). Для старых БД сводка один раз строится фоновым потоком по чатам;
+# пока он не закончил, статистика считается по сырым сообщениям.
+_rollups_ready = False
+_rollup_thread: Optional[threading.Thread] = None
+
+def _archived_rollup_rows(chat_id: int) -> List[Tuple[int, int, int, str, int, Optional[str]]]:
+    """Строки сводки по архиву чата (сообщения, у которых есть горячая копия, считаются по messages)."""
+    segments = _archive_segments_for(chat_id)
+    if not segments: return []
+    hot_ids = {r[0] for r in _execute_query("SELECT message_id FROM messages WHERE chat_id = ?", (chat_id,), fetch_all=True) or []}
+    counts: Dict[Tuple[int, int, str], List[Any]] = {}
+    for seg in segments: # По сегменту за раз: в памяти только один месяц
+        for m in _archived_messages(chat_id, segments=[seg]):
+            if m['message_id'] in hot_ids: continue
+            entry = counts.setdefault(((m['timestamp'] or 0) // _DAY_MS, m['user_id'], m['type']), [0, None])
+            entry[0] += 1
+            if m['username']: entry[1] = max(entry[1] or '', m['username'])
+    return [(chat_id, day, user_id, msg_type, cnt, username) for (day, user_id, msg_type), (cnt, username) in counts.items()]
+
+def rebuild_chat_rollup(chat_id: int):
+    """Пересчитывает сводку чата из messages и архивных сегментов одной транзакцией (ремонт/первичное заполнение)."""
+    archived = _archived_rollup_rows(chat_id) # Файлы читаются до захвата блокировки записи
+    with _write_connection() as conn, conn:
+        conn.execute("DELETE FROM chat_activity_daily WHERE chat_id = ?", (chat_id,))
+        conn.execute(f"""
+            INSERT INTO chat_activity_daily (chat_id, day, user_id, message_type, cnt, username)
+            SELECT chat_id, {_ROLLUP_DAY_EXPR.format(row='messages')} AS day, user_id, message_type, COUNT(*), MAX(username)
+            FROM messages WHERE chat_id = ? GROUP BY day, user_id, message_type
+        """, (chat_id,))
+        conn.executemany("""
+            INSERT INTO chat_activity_daily (chat_id, day, user_id, message_type, cnt, username) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id, day, user_id, message_type) DO UPDATE SET cnt = cnt + excluded.cnt, username = COALESCE(username, excluded.username)
+        """, archived)
+
+def _rollup_backfill_loop():
+    global _rollups_ready
+    if _timestamp_ms_thread: _timestamp_ms_thread.join() # День в сводке считается по timestamp_ms
+    if not _timestamp_ms_ready: logger.info("Rollup backfill: миграция timestamp_ms не завершена, отложен до следующего запуска."); return
+    try:
+        started = time.perf_counter()
+        cursor_value = _get_meta('chat_activity_daily_cursor')
+        last_chat = int(cursor_value) if cursor_value else -2**63
+        chat_ids = [r[0] for r in _execute_query("SELECT DISTINCT chat_id FROM messages WHERE chat_id > ? ORDER BY chat_id", (last_chat,), fetch_all=True)]
+        logger.info(f"Rollup backfill: строю сводки для {len(chat_ids)} чатов...")
+        for chat_id in chat_ids:
+            rebuild_chat_rollup(chat_id)
+            _set_meta('chat_activity_daily_cursor', str(chat_id))
+        _set_meta('chat_activity_daily', 'done'); _rollups_ready = True
+        logger.info(f"Rollup backfill завершен за {time.perf_counter() - started:.1f}s.")
+    except Exception as e: logger.error(f"Rollup backfill прерван (продолжится при следующем запуске): {e}", exc_info=True)
+
+def start_rollup_backfill():
+    """Запускает фоновое заполнение сводок, если оно еще не выполнено (вызывается после load_data)."""
+    global _rollups_ready, _rollup_thread
+    if _get_meta('chat_activity_daily') == 'done': _rollups_ready = True; return
+    if _rollup_thread and _rollup_thread.is_alive(): return
+    _rollup_thread = threading.Thread(target=_rollup_backfill_loop, name="rollup-backfill", daemon=True)
+    _rollup_thread.start()
+
+# --- Полнотекстовый поиск (FTS5) ---
+# messages - WITHOUT ROWID, поэтому индекс ссылается на сообщения через messages_fts_map (id -> chat_id, message_id),
+# а текст берет из представления messages_fts_src (external content - текст не хранится дважды).
+# Триггеры на messages поддерживают индекс при вставке, замене (recursive_triggers) и любых удалениях.
+# Колонка chat хранит токен чата ('c<id>', минус -> 'n'): поиск ограничивается чатом самим индексом.
+_FTS_CHAT_TOKEN = "'c' || replace({row}.chat_id, '-', 'n')"
+_FTS_INDEXED_EXPR = "{row}.content IS NOT NULL AND {row}.content <> '' AND {row}.message_type <> 'sticker'"
+_FTS_TERM_RE = re.compile(r'"([^"]+)"|(\w+)')
+_SNIPPET_MARKS = ('\x02', '\x03') # Маркеры совпадений во фрагменте (в тексте сообщений не встречаются)
+_fts_available = False # FTS5 есть не в каждой сборке SQLite
+_fts_ready = False
+_fts_thread: Optional[threading.Thread] = None
+_fts_stats: Dict[str, Any] = {'merge_runs': 0, 'merge_steps': 0, 'last_merge_ms': 0.0, 'searches': 0, 'last_search_ms': 0.0}
+
+def _init_fts():
+    global _fts_available
+    try:
+        _execute_query("CREATE TABLE IF NOT EXISTS messages_fts_map (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, UNIQUE (chat_id, message_id))")
+        _execute_query("DROP VIEW IF EXISTS messages_fts_src") # Представление и триггеры пересоздаются: их определения менялись между версиями
+        _execute_query(f"""
+            CREATE VIEW messages_fts_src AS
+            SELECT f.id AS id, content_text(m.content) AS content, {_FTS_CHAT_TOKEN.format(row='f')} AS chat
+            FROM messages_fts_map f JOIN messages m ON m.chat_id = f.chat_id AND m.message_id = f.message_id
+        """)
+        _execute_query("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, chat, content='messages_fts_src', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+    except sqlite3.OperationalError as e: logger.warning(f"FTS5 недоступен ({e}): поиск /search отключен."); return
+    _execute_query("DROP TRIGGER IF EXISTS trg_messages_fts_ins"); _execute_query("DROP TRIGGER IF EXISTS trg_messages_fts_del")
+    _execute_query(f"""
+        CREATE TRIGGER trg_messages_fts_ins AFTER INSERT ON messages WHEN {_FTS_INDEXED_EXPR.format(row='NEW')} BEGIN
+            INSERT INTO messages_fts_map (chat_id, message_id) VALUES (NEW.chat_id, NEW.message_id);
+            INSERT INTO messages_fts (rowid, content, chat) VALUES (last_insert_rowid(), content_text(NEW.content), {_FTS_CHAT_TOKEN.format(row='NEW')});
+        END
+    """)
+    _execute_query(f"""
+        CREATE TRIGGER trg_messages_fts_del AFTER DELETE ON messages WHEN {_FTS_INDEXED_EXPR.format(row='OLD')} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, chat)
+            SELECT 'delete', id, content_text(OLD.content), {_FTS_CHAT_TOKEN.format(row='OLD')} FROM messages_fts_map WHERE chat_id = OLD.chat_id AND message_id = OLD.message_id;
+            DELETE FROM messages_fts_map WHERE chat_id = OLD.chat_id AND message_id = OLD.message_id;
+        END
+    """)
+    _fts_available = True
+    logger.info("Индекс 'messages_fts' и триггеры проверены/созданы.")
+
+def _fts_chat_token(chat_id: int) -> str:
+    return f"c{chat_id}".replace('-', 'n')
+
+def _index_chat_fts(chat_id: int) -> int:
+    """Добавляет в индекс еще не проиндексированные сообщения чата (первичное заполнение для старых БД)."""
+    with _write_connection() as conn, conn:
+        first_new_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages_fts_map").fetchone()[0]
+        added = conn.execute(f"""
+            INSERT OR IGNORE INTO messages_fts_map (chat_id, message_id)
+            SELECT chat_id, message_id FROM messages WHERE chat_id = ? AND {_FTS_INDEXED_EXPR.format(row='messages')}
+        """, (chat_id,)).rowcount
+        if added: conn.execute("INSERT INTO messages_fts (rowid, content, chat) SELECT id, content, chat FROM messages_fts_src WHERE id >= ?", (first_new_id,))
+    return added
+
+def _fts_backfill_loop():
+    global _fts_ready
+    try:
+        started = time.perf_counter(); total = 0
+        cursor_value = _get_meta('messages_fts_cursor')
+        last_chat = int(cursor_value) if cursor_value else -2**63
+        chat_ids = [r[0] for r in _execute_query("SELECT DISTINCT chat_id FROM messages WHERE chat_id > ? ORDER BY chat_id", (last_chat,), fetch_all=True)]
+        logger.info(f"FTS backfill: индексирую историю {len(chat_ids)} чатов...")
+        for chat_id in chat_ids:
+            total += _index_chat_fts(chat_id)
+            _set_meta('messages_fts_cursor', str(chat_id))
+        _set_meta('messages_fts', 'done'); _fts_ready = True
+        logger.info(f"FTS backfill завершен: {total} сообщений за {time.perf_counter() - started:.1f}s.")
+    except Exception as e: logger.error(f"FTS backfill прерван (продолжится при следующем запуске): {e}", exc_info=True)
+
+def start_fts_backfill():
+    """Запускает фоновую индексацию старых сообщений, если она еще не выполнена (вызывается после load_data)."""
+    global _fts_ready, _fts_thread
+    if not _fts_available: return
+    if _get_meta('messages_fts') == 'done': _fts_ready = True; return
+    if _fts_thread and _fts_thread.is_alive(): return
+    _fts_thread = threading.Thread(target=_fts_backfill_loop, name="fts-backfill", daemon=True)
+    _fts_thread.start()
+
+def search_terms(text: str) -> List[Tuple[List[str], bool]]:
+    """Разбирает запрос пользователя: [(слова, префиксный_поиск)]. "Фраза в кавычках" ищется точно,
+    отдельные слова от 3 букв - по префиксу (кошк -> кошка, кошки)."""
+    terms = []
+    for phrase, word in _FTS_TERM_RE.findall(text or ""):
+        words = re.findall(r'\w+', phrase) if phrase else [word]
+        if words and words[0]: terms.append((words, not phrase and len(word) >= 3))
+    return terms
+
+def build_fts_query(text: str) -> Optional[str]:
+    """Пользовательский запрос -> безопасное выражение FTS5 (термы через AND, без синтаксиса пользователя)."""
+    return " AND ".join('"' + ' '.join(words) + '"' + ('*' if prefix else '') for words, prefix in search_terms(text)) or None
+
+def snippet_to_html(snippet: Optional[str]) -> str:
+    """Фрагмент с маркерами _SNIPPET_MARKS -> HTML: текст экранируется, совпадения выделяются <b>."""
+    return html.escape(snippet or '').replace(_SNIPPET_MARKS[0], '<b>').replace(_SNIPPET_MARKS[1], '</b>')
+
+def search_messages(chat_id: int, query: str, since: Optional[Union[datetime.datetime, int]] = None, limit: int = SEARCH_RESULTS_LIMIT, snippet_tokens: int = SEARCH_SNIPPET_TOKENS) -> List[Dict[str, Any]]:
+    """Ищет сообщения чата по тексту (ранжирование bm25). Возвращает сообщения с полем 'snippet'
+    (совпадения выделены <b></b>, остальной текст экранирован для HTML). since - нижняя граница времени."""
+    fts_query = build_fts_query(query)
+    if not _fts_available or not fts_query: return []
+    started = time.perf_counter()
+    sql = f"""
+        SELECT m.message_id, m.user_id, m.username, {_ts_ms('m.')} AS timestamp, m.message_type AS type,
+               snippet(messages_fts, 0, ?, ?, '…', ?) AS snippet
+        FROM messages_fts
+        JOIN messages_fts_map f ON f.id = messages_fts.rowid
+        JOIN messages m ON m.chat_id = f.chat_id AND m.message_id = f.message_id
+        WHERE messages_fts MATCH ?{f" AND {_ts_ms('m.')} >= ?" if since is not None else ''}
+        ORDER BY rank LIMIT ?
+    """
+    params: tuple = (*_SNIPPET_MARKS, snippet_tokens, f"chat : {_fts_chat_token(chat_id)} AND content : ({fts_query})")
+    if since is not None: params += (to_epoch_ms(since),)
+    try: rows = _execute_query(sql, params + (limit,), fetch_all=True)
+    except sqlite3.Error: logger.exception(f"Ошибка поиска в чате {chat_id} по запросу {query!r}"); return []
+    results = [dict(r, snippet=snippet_to_html(r['snippet'])) for r in rows]
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    _fts_stats['searches'] += 1; _fts_stats['last_search_ms'] = elapsed_ms
+    logger.debug(f"Search chat={chat_id}: {len(results)} результатов за {elapsed_ms:.1f} мс.")
+    return results
+
+def fts_maintenance(budget_sec: float, full: bool = False, pages: int = FTS_MERGE_PAGES) -> Dict[str, Any]:
+    """Пошаговое слияние сегментов индекса ('merge'), каждый шаг - короткая транзакция писателя.
+    full=True сливает все сегменты (постепенный аналог 'optimize'), иначе только уровни с >= usermerge сегментов.
+    Останавливается, когда слиять нечего или истек бюджет времени."""
+    if not _fts_available: return {'steps': 0, 'done': True, 'duration_s': 0.0}
+    started = time.perf_counter(); steps = 0; done = False
+    while time.perf_counter() - started < budget_sec:
+        with _write_connection() as conn, conn:
+            changes_before = conn.total_changes
+            conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('merge', ?)", (-pages if full else pages,))
+            steps += 1
+            if conn.total_changes - changes_before < 2: done = True; break # Слиять больше нечего
+        time.sleep(PURGE_BATCH_PAUSE_SEC) # Уступаем запись ingest между шагами
+    duration = time.perf_counter() - started
+    _fts_stats['merge_runs'] += 1; _fts_stats['merge_steps'] += steps; _fts_stats['last_merge_ms'] = duration * 1000
+    (logger.info if steps > 1 else logger.debug)(f"FTS merge{' (full)' if full else ''}: {steps} шагов за {duration:.2f}s{'' if done else ' (бюджет исчерпан, продолжим в следующий раз)'}.")
+    return {'steps': steps, 'done': done, 'duration_s': duration}
+
+def get_fts_stats() -> Dict[str, Any]:
+    return dict(_fts_stats, available=_fts_available, ready=_fts_ready)
+
+# --- Сжатие текста сообщений (content_codec, CONTENT_COMPRESSION=zstd) ---
+# Новые сообщения сжимает писатель ingest. Словарь zstd обучается один раз, когда в БД накопится
+# достаточно сообщений, и хранится в content_dicts (старые словари остаются - по ним читаются старые строки).
+# После обучения фоновый поток один раз сжимает уже сохраненные тексты чанками по первичному ключу.
+_compression_thread: Optional[threading.Thread] = None
+_COMPRESSION_RETRY_SEC = 3600 # Как часто проверять, хватает ли сообщений для обучения словаря
+
+def _init_content_compression():
+    _execute_query("CREATE TABLE IF NOT EXISTS content_dicts (dict_id INTEGER PRIMARY KEY, data BLOB NOT NULL, created_ts INTEGER NOT NULL)")
+    active = _get_meta('content_zstd_dict')
+    for r in _execute_query("SELECT dict_id, data FROM content_dicts", fetch_all=True):
+        content_codec.register_dictionary(r['dict_id'], r['data'], active=str(r['dict_id']) == active)
+
+def train_content_dictionary() -> Optional[int]:
+    """Обучает словарь zstd на сохраненных текстах и делает его активным. None - если образцов пока мало."""
+    rows = _execute_query("SELECT content_text(content) FROM messages WHERE content IS NOT NULL AND message_type <> 'sticker' LIMIT ?", (CONTENT_ZSTD_TRAIN_SAMPLES,), fetch_all=True)
+    if len(rows) < max(1000, CONTENT_ZSTD_TRAIN_SAMPLES // 10): return None
+    started = time.perf_counter()
+    dict_id, data = content_codec.train_dictionary([r[0].encode('utf-8') for r in rows])
+    with _write_connection() as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO content_dicts (dict_id, data, created_ts) VALUES (?, ?, ?)", (dict_id, data, int(time.time())))
+        _set_meta('content_zstd_dict', str(dict_id), conn)
+    content_codec.register_dictionary(dict_id, data, active=True)
+    logger.info(f"Словарь zstd {dict_id} обучен на {len(rows)} сообщениях ({len(data) // 1024} КБ) за {time.perf_counter() - started:.1f}s.")
+    return dict_id
+
+def compress_existing_content() -> int:
+    """Сжимает сохраненные тексты активным словарем. Каждый чанк - короткая транзакция, позиция хранится
+    в schema_meta (прерванный проход продолжается). Сжатие идет вне блокировки писателя."""
+    cursor_value = _get_meta('content_compress_cursor')
+    last_key = tuple(int(x) for x in cursor_value.split(':')) if cursor_value else (-2**63, -2**63)
+    started = time.perf_counter(); compressed = 0; bytes_before = 0; bytes_after = 0
+    active_dict_id = content_codec.active_dict_id()
+    while True:
+        rows = _execute_query("SELECT chat_id, message_id, content FROM messages WHERE (chat_id, message_id) > (?, ?) ORDER BY chat_id, message_id LIMIT ?", (*last_key, MIGRATION_CHUNK_SIZE), fetch_all=True)
+        if not rows: break
+        updates = []
+        for r in rows:
+            stored = r['content']
+            if isinstance(stored, bytes): # Сжатые до появления словаря пережимаем с ним
+                if content_codec.dict_id_of(stored) == active_dict_id: continue
+                text = content_codec.decompress(stored)
+            elif isinstance(stored, str) and len(stored) * 2 >= CONTENT_COMPRESSION_MIN_BYTES: text = stored # Грубый отсев заведомо коротких
+            else: continue
+            packed = content_codec.compress(text)
+            if isinstance(packed, bytes) and (isinstance(stored, str) or len(packed) < len(stored)):
+                updates.append((packed, r['chat_id'], r['message_id'], stored))
+                bytes_before += len(stored.encode('utf-8')) if isinstance(stored, str) else len(stored); bytes_after += len(packed)
+        last_key = (rows[-1]['chat_id'], rows[-1]['message_id'])
+        with _write_connection() as conn, conn: # content = ? - сообщение не заменили, пока мы его сжимали
+            if updates: conn.executemany("UPDATE messages SET content = ? WHERE chat_id = ? AND message_id = ? AND content = ?", updates)
+            _set_meta('content_compress_cursor', f"{last_key[0]}:{last_key[1]}", conn)
+        compressed += len(updates)
+        time.sleep(PURGE_BATCH_PAUSE_SEC) # Уступаем запись ingest
+    _set_meta('content_compress', 'done')
+    logger.info(f"Сжатие сохраненных сообщений: {compressed} текстов, {bytes_before // 1024} КБ -> {bytes_after // 1024} КБ за {time.perf_counter() - started:.1f}s.")
+    return compressed
+
+def _compression_loop():
+    try:
+        while content_codec.active_dict_id() is None and train_content_dictionary() is None:
+            logger.info(f"Сжатие: сообщений для обучения словаря пока мало, следующая попытка через {_COMPRESSION_RETRY_SEC // 60} мин.")
+            time.sleep(_COMPRESSION_RETRY_SEC)
+        if _get_meta('content_compress') != 'done': compress_existing_content()
+    except Exception as e: logger.error(f"Фоновое сжатие прервано (продолжится при следующем запуске): {e}", exc_info=True)
+
+def start_content_compression():
+    """Запускает обучение словаря и сжатие старых сообщений, если CONTENT_COMPRESSION=zstd (вызывается после load_data)."""
+    global _compression_thread
+    if not content_codec.enabled(): return
+    if _compression_thread and _compression_thread.is_alive(): return
+    _compression_thread = threading.Thread(target=_compression_loop, name="content-compression", daemon=True)
+    _compression_thread.start()
+
+def aggregate_chat_stats(rows: Iterable[Any]) -> Dict[str, Any]:
+    """Сводит строки (user_id, message_type, cnt, username) в словарь статистики для /chat_stats."""
     stats = {'active_users': 0, 'total_messages': 0, 'photos': 0, 'stickers': 0, 'top_users': []}
-    if since_datetime_utc.tzinfo is None: since_datetime_utc = pytz.utc.localize(since_datetime_utc)
-    else: since_datetime_utc = since_datetime_utc.astimezone(pytz.utc)
-    since_iso_str = since_datetime_utc.isoformat()
-    params = (chat_id, since_iso_str)
-    logger.debug(f"Собираю статистику для чата {chat_id} с {since_iso_str}") # <-- Лог начала
+    per_user: Dict[int, List[Any]] = {} # user_id -> [username, count]
+    for row in rows:
+        stats['total_messages'] += row['cnt']
+        if row['message_type'] == 'photo': stats['photos'] += row['cnt']
+        elif row['message_type'] == 'sticker': stats['stickers'] += row['cnt']
+        entry = per_user.setdefault(row['user_id'], [row['username'], 0]); entry[1] += row['cnt']
+        if row['username']: entry[0] = row['username']
+    stats['active_users'] = len(per_user)
+    stats['top_users'] = [(name, cnt) for name, cnt in sorted(per_user.values(), key=lambda e: e[1], reverse=True)[:3]]
+    return stats
 
+def get_chat_stats(chat_id: int, since: Union[datetime.datetime, int]) -> Optional[Dict[str, Any]]:
+    """Собирает статистику чата с указанного момента (datetime или epoch ms). Возвращает None при ошибке.
+    Полные дни берутся из сводки (O(дней) строк), неполный первый день - из messages по индексу."""
+    since_ms = to_epoch_ms(since)
     try:
-        # 1. Общее кол-во сообщений и типы
-        sql_counts = "SELECT message_type, COUNT(*) as count FROM messages WHERE chat_id = ? AND timestamp >= ? GROUP BY message_type"
-        rows_counts = _execute_query(sql_counts, params, fetch_all=True)
-        logger.debug(f"Stats query 1 (counts): Found {len(rows_counts) if rows_counts else '0'} rows.") # <-- Лог 1
-        if rows_counts: # Проверяем, что результат не None
-            for row in rows_counts:
-                stats['total_messages'] += row['count']
-                msg_type = row['message_type']
-                if msg_type == 'photo': stats['photos'] = row['count']
-                elif msg_type == 'sticker': stats['stickers'] = row['count']
-                # Добавить другие типы по желанию
-
-        # 2. Топ активных пользователей
-        sql_top_users = "SELECT username, COUNT(*) as msg_count FROM messages WHERE chat_id = ? AND timestamp >= ? GROUP BY user_id ORDER BY msg_count DESC LIMIT 3" # Group by user_id for count
-        rows_top = _execute_query(sql_top_users, params, fetch_all=True)
-        logger.debug(f"Stats query 2 (top users): Found {len(rows_top) if rows_top else '0'} rows.") # <-- Лог 2
-        if rows_top: # Проверяем, что результат не None
-            stats['top_users'] = [(row['username'], row['msg_count']) for row in rows_top]
-
-        # 3. Количество уникальных активных пользователей
-        sql_active_users = "SELECT COUNT(DISTINCT user_id) as unique_users FROM messages WHERE chat_id = ? AND timestamp >= ?"
-        active_users_row = _execute_query(sql_active_users, params, fetch_one=True)
-        logger.debug(f"Stats query 3 (active users): Found row - {bool(active_users_row)}") # <-- Лог 3
-        if active_users_row: # Проверяем, что результат не None
-            stats['active_users'] = active_users_row['unique_users']
-
-        logger.debug(f"Статистика для чата {chat_id} собрана: {stats}") # <-- Итоговый лог перед return
-        return stats
+        raw_sql = f"SELECT user_id, message_type, COUNT(*) AS cnt, MAX(username) AS username FROM messages WHERE chat_id = ? AND {_ts_ms()} >= ?"
+        if _rollups_ready:
+            first_full_day = -(-since_ms // _DAY_MS)
+            rows = _execute_query("SELECT user_id, message_type, SUM(cnt) AS cnt, MAX(username) AS username FROM chat_activity_daily WHERE chat_id = ? AND day >= ? GROUP BY user_id, message_type", (chat_id, first_full_day), fetch_all=True) or []
+            rows += _execute_query(raw_sql + " AND timestamp_ms < ? GROUP BY user_id, message_type", (chat_id, since_ms, first_full_day * _DAY_MS), fetch_all=True) or []
+            if _archive_has_segments: rows += _archived_stats_rows(chat_id, since_ms, first_full_day * _DAY_MS) # Полные дни архива уже в сводке
+        else:
+            rows = _execute_query(raw_sql + " GROUP BY user_id, message_type", (chat_id, since_ms), fetch_all=True) or []
+            if _archive_has_segments: rows += _archived_stats_rows(chat_id, since_ms)
 
-    except Exception as e:
+        stats = aggregate_chat_stats(rows)
+        logger.debug(f"Статистика для чата {chat_id} с {since_ms} ({'rollup' if _rollups_ready else 'raw'}): {stats}")
+        return stats
+    except Exception:
         logger.exception(f"Ошибка сбора статистики чата {chat_id}")
-        # --- ИЗМЕНЕНО: Возвращаем None при любой ошибке внутри try ---
         return None
 
+# --- Сохраненные результаты генерации (generated_outputs) ---
+# Ключ - чат, окно сообщений, на которых построен текст (время первого и последнего + их число),
+# и отпечаток настроек вывода. Рассылка и /generate_now считают период от разных моментов,
+# поэтому повторная выдача ищет последний результат с тем же отпечатком: если после его
+# period_end_ms сообщений не было, а начало покрывает текущий период, текст отдается без
+# скачивания фото и запроса к прокси.
+def output_fingerprint(output_format: str, genre: str, personality: str, lang: str) -> str:
+    """Отпечаток настроек, от которых зависит текст (смена любой делает сохраненный результат непригодным)."""
+    return f"{output_format}:{genre}:{personality}:{lang}"
+
+def output_window(messages: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+    """(period_start_ms, period_end_ms, message_count) для сообщений, переданных в генерацию."""
+    timestamps = [to_epoch_ms(m['timestamp']) for m in messages if m.get('timestamp') is not None]
+    if not timestamps: return 0, 0, len(messages)
+    return min(timestamps), max(timestamps), len(messages)
+
+def get_latest_generated_output(chat_id: int, fingerprint: str, first_message_ms: int) -> Optional[Dict[str, Any]]:
+    """Последний результат с теми же настройками, который начинается не позже first_message_ms
+    (первого сообщения текущего периода) и после конца которого в чат ничего не пришло, или None."""
+    sql = f"""
+        SELECT g.output_text, g.note, g.photo_count, g.created_ms, g.period_start_ms, g.period_end_ms, g.message_count FROM generated_outputs g
+        WHERE g.chat_id = ? AND g.fingerprint = ? AND g.period_start_ms <= ?
+          AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.chat_id = g.chat_id AND {_ts_ms('m.')} > g.period_end_ms)
+        ORDER BY g.period_end_ms DESC, g.created_ms DESC LIMIT 1
+    """
+    try: row = _execute_query(sql, (chat_id, fingerprint, first_message_ms), fetch_one=True); return dict(row) if row else None
+    except Exception: logger.error(f"Failed get latest generated output chat={chat_id}."); return None
+
+def save_generated_output(chat_id: int, fingerprint: str, period_start_ms: int, period_end_ms: int, message_count: int,
+                          output_text: str, note: Optional[str] = None, photo_count: int = 0):
+    sql = """
+        INSERT OR REPLACE INTO generated_outputs (chat_id, period_start_ms, period_end_ms, fingerprint, message_count, output_text, note, photo_count, created_ms)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    try: _execute_query(sql, (chat_id, period_start_ms, period_end_ms, fingerprint, message_count, output_text, note, photo_count, round(time.time() * 1000))); logger.debug(f"Saved generated output chat={chat_id} fp={fingerprint} n={message_count}.")
+    except Exception: logger.error(f"Failed save generated output chat={chat_id}.") # Не критично: в худшем случае сгенерируем заново
+
+def purge_generated_outputs(days: int = GENERATED_OUTPUT_RETENTION_DAYS) -> int:
+    """Удаляет результаты старше days дней. Возвращает число удаленных строк."""
+    sql = "DELETE FROM generated_outputs WHERE created_ms < ?"
+    try: deleted = _execute_query(sql, (round(time.time() * 1000) - days * _DAY_MS,)) or 0; logger.debug(f"Purged {deleted} generated outputs older {days}d."); return deleted
+    except Exception: logger.error(f"Failed purge generated outputs older {days}d."); return 0
+
+# --- Промежуточные конспекты дня (partial_digests) ---
+# partial_digest_job каждые несколько часов конспектирует новые сообщения включенных чатов
+# в пределах текущих "суток" чата (24 часа до следующего слота из chat_schedule), так что
+# daily_story_job в слот получает готовые конспекты и дописывает только хвост сообщений.
+def get_partial_digest_candidates() -> List[Tuple[int, int, int]]:
+    """[(chat_id, window_start_ms, resume_ms)]: начало окна ближайшей сводки и конец последнего конспекта в нем."""
+    sql = """
+        SELECT s.chat_id, (s.next_run_ts - 86400) * 1000 AS window_start_ms,
+               (SELECT MAX(p.period_end_ms) FROM partial_digests p WHERE p.chat_id = s.chat_id AND p.period_start_ms >= (s.next_run_ts - 86400) * 1000) AS last_end_ms
+        FROM chat_schedule s
+    """
+    try: rows = _execute_query(sql, fetch_all=True) or []; return [(r['chat_id'], r['window_start_ms'], max(r['window_start_ms'], r['last_end_ms'] or 0)) for r in rows]
+    except Exception: logger.error("Failed get partial digest candidates."); return []
+
+def get_partial_digests(chat_id: int, since_ms: int) -> List[Dict[str, Any]]:
+    """Конспекты чата, начинающиеся не раньше since_ms, по времени."""
+    sql = "SELECT period_start_ms, period_end_ms, notes, message_count, image_count FROM partial_digests WHERE chat_id = ? AND period_start_ms >= ? ORDER BY period_start_ms"
+    try: return [dict(r) for r in _execute_query(sql, (chat_id, since_ms), fetch_all=True) or []]
+    except Exception: logger.error(f"Failed get partial digests chat={chat_id}."); return []
+
+def save_partial_digest(chat_id: int, period_start_ms: int, period_end_ms: int, notes: str, message_count: int, image_count: int = 0):
+    sql = "INSERT OR REPLACE INTO partial_digests (chat_id, period_start_ms, period_end_ms, notes, message_count, image_count, created_ms) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    try: _execute_query(sql, (chat_id, period_start_ms, period_end_ms, notes, message_count, image_count, round(time.time() * 1000)))
+    except Exception: logger.error(f"Failed save partial digest chat={chat_id}.")
+
+def purge_partial_digests(before_ms: int) -> int:
+    """Удаляет конспекты, закончившиеся до before_ms (их сутки уже сведены)."""
+    try: return _execute_query("DELETE FROM partial_digests WHERE period_end_ms < ?", (before_ms,)) or 0
+    except Exception: logger.error("Failed purge partial digests."); return 0
+
 # --- add_feedback, close_all_connections (без изменений) ---
 def add_feedback(message_id: int, chat_id: int, user_id: int, rating: int):
     """Сохраняет отзыв пользователя (1 для 👍, -1 для 👎)."""
@@ -494,7 +1634,25 @@ def add_feedback(message_id: int, chat_id: int, user_id: int, rating: int):
         # Лог ошибки уже будет в _execute_query, можно добавить специфичное сообщение
         logger.error(f"Failed to save feedback u={user_id} m={message_id}.")
 
-# --- Функция закрытия соединений (ВОССТАНОВЛЕНО ФОРМАТИРОВАНИЕ) ---
+# --- Функция закрытия соединений ---
 def close_all_connections():
-    """Закрывает соединение с БД для текущего потока (вызывается при остановке)."""
-    close_db_connection()
\ No newline at end of file
+    """Закрывает все соединения (читатели и писатель) и переносит WAL в основной файл. Вызывается при остановке."""
+    global _writer_conn
+    with _registry_lock: readers = [c for c in _registry if c is not _writer_conn]; _registry.difference_update(readers)
+    for conn in readers: # Сначала читатели: их снимки мешают checkpoint TRUNCATE
+        try: conn.close()
+        except sqlite3.Error as e: logger.error(f"Ошибка при закрытии SQLite соединения: {e}")
+    while True:
+        try: _reader_idle.get_nowait()
+        except queue.Empty: break
+    with _writer_lock:
+        if _writer_conn is None: return
+        try:
+            busy, wal_pages, moved = _writer_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            logger.info(f"WAL checkpoint: {moved}/{wal_pages} страниц перенесено{' (БД занята)' if busy else ''}.")
+        except sqlite3.Error as e: logger.warning(f"Не удалось выполнить WAL checkpoint: {e}")
+        try: _writer_conn.close()
+        except sqlite3.Error as e: logger.error(f"Ошибка при закрытии SQLite соединения: {e}")
+        with _registry_lock: _registry.discard(_writer_conn)
+        _writer_conn = None
+    logger.info(f"Закрыто соединений с БД: {len(readers) + 1}.")
\ No newline at end of file
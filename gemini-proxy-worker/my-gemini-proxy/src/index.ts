@@ -80,13 +80,102 @@ async function fetchWithRetry(url: string, options: RequestInit, maxRetries: num
 }
 
 
+// --- Стриминг: streamGenerateContent (SSE от Google) -> наш SSE для бота ---
+// Бот получает события:
+//   event: chunk  data: {"text": "..."}        - очередной фрагмент текста
+//   event: done   data: {"finish_reason": "..."} - генерация завершена
+//   event: error  data: {"error": "..."}       - ошибка после начала стрима
+// Ошибки ДО начала стрима отдаются обычным JSON со статусом, как в /generate.
+function extractChunkText(chunk: GoogleApiResponse): string {
+    const parts = chunk.candidates?.[0]?.content?.parts ?? [];
+    return parts.map(p => p.text ?? '').join('');
+}
+
+async function streamGeminiAsSse(googleApiUrl: string, requestBody: string, ctx: ExecutionContext): Promise<Response> {
+    const requestStartTime = Date.now();
+    const googleResponse = await fetchWithRetry(googleApiUrl, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: requestBody,
+    });
+
+    if (!googleResponse.ok || !googleResponse.body) {
+        let errorDetails = `Status ${googleResponse.status}`;
+        try {
+            const errorData: GoogleApiResponse = await googleResponse.json();
+            if (errorData.error) errorDetails = `${errorData.error.status}(${errorData.error.code}): ${errorData.error.message}`;
+        } catch (_) { /* тело не JSON - оставляем статус */ }
+        console.error(`Gemini stream API returned HTTP error: ${errorDetails}`);
+        return new Response(JSON.stringify({ error: `Gemini API Error: ${errorDetails}` }), {
+            status: googleResponse.ok ? 502 : googleResponse.status,
+            headers: { 'Content-Type': 'application/json' },
+        });
+    }
+
+    const encoder = new TextEncoder();
+    const decoder = new TextDecoder();
+    const { readable, writable } = new TransformStream<Uint8Array, Uint8Array>();
+    const writer = writable.getWriter();
+    const sendEvent = (event: string, data: object) => writer.write(encoder.encode(`event: ${event}\ndata: ${JSON.stringify(data)}\n\n`));
+
+    const pump = async () => {
+        const reader = googleResponse.body!.getReader();
+        let buffer = '';
+        let finishReason: string | undefined;
+        let firstChunkLogged = false;
+        try {
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, '\n');
+                let separatorIndex: number;
+                while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, separatorIndex);
+                    buffer = buffer.slice(separatorIndex + 2);
+                    const data = rawEvent.split('\n').filter(line => line.startsWith('data:')).map(line => line.slice(5).trim()).join('');
+                    if (!data) continue;
+                    const chunk: GoogleApiResponse = JSON.parse(data);
+                    if (chunk.promptFeedback?.blockReason) {
+                        await sendEvent('error', { error: `Request blocked by safety settings: ${chunk.promptFeedback.blockReason}` });
+                        return;
+                    }
+                    const text = extractChunkText(chunk);
+                    if (text) {
+                        if (!firstChunkLogged) {
+                            console.log(`First Gemini stream chunk after ${Date.now() - requestStartTime}ms`);
+                            firstChunkLogged = true;
+                        }
+                        await sendEvent('chunk', { text });
+                    }
+                    finishReason = chunk.candidates?.[0]?.finishReason ?? finishReason;
+                }
+            }
+            await sendEvent('done', { finish_reason: finishReason ?? null });
+            console.log(`Gemini stream finished in ${Date.now() - requestStartTime}ms (finishReason: ${finishReason})`);
+        } catch (e: any) {
+            console.error("Error while proxying Gemini stream:", e);
+            try { await sendEvent('error', { error: `Proxy stream error: ${e.message || 'Unknown error'}` }); } catch (_) { /* клиент отключился */ }
+        } finally {
+            try { await writer.close(); } catch (_) { /* уже закрыт */ }
+        }
+    };
+    ctx.waitUntil(pump());
+
+    return new Response(readable, {
+        status: 200,
+        headers: { 'Content-Type': 'text/event-stream; charset=utf-8', 'Cache-Control': 'no-cache' },
+    });
+}
+
+
 export default {
     // Основной обработчик входящих HTTP запросов
     async fetch(request: Request, env: Env, ctx: ExecutionContext): Promise<Response> {
         const url = new URL(request.url);
 
-        // 1. Проверяем метод и путь
-        if (request.method !== 'POST' || url.pathname !== '/generate') {
+        // 1. Проверяем метод и путь (/generate - целиком, /generate_stream - SSE)
+        const isStream = url.pathname === '/generate_stream';
+        if (request.method !== 'POST' || (url.pathname !== '/generate' && !isStream)) {
             return new Response('Not Found', { status: 404 });
         }
 
@@ -143,6 +232,19 @@ export default {
 
         // 5. Вызываем Google Gemini API с помощью fetchWithRetry
         const modelName = 'gemini-2.5-flash-preview-04-17'; 
+        if (isStream) {
+            const streamApiUrl = `https://generativelanguage.googleapis.com/v1beta/models/${modelName}:streamGenerateContent?alt=sse&key=${env.GEMINI_API_KEY}`;
+            console.log(`Sending streaming request to Gemini API (${modelName})...`);
+            try {
+                return await streamGeminiAsSse(streamApiUrl, JSON.stringify({ contents: googleApiContents }), ctx);
+            } catch (e: any) {
+                console.error("Failed to start Gemini stream:", e);
+                return new Response(JSON.stringify({ error: `Proxy failed to process request: ${e.message || 'Unknown fetch error'}` }), {
+                    status: 502,
+                    headers: { 'Content-Type': 'application/json' },
+                });
+            }
+        }
         const googleApiUrl = `https://generativelanguage.googleapis.com/v1beta/models/${modelName}:generateContent?key=${env.GEMINI_API_KEY}`;
         const requestStartTime = Date.now();
         console.log(`Sending request to Gemini API (${modelName})...`);
@@ -3,7 +3,10 @@ import logging
 import asyncio
 import httpx
 import base64
-from typing import List, Dict, Union, Tuple, Optional, Any
+import time
+import importlib.util
+from typing import List, Dict, Union, Tuple, Optional, Any, AsyncIterator, Awaitable, Callable
+import json
 from tenacity import (
     retry, stop_after_attempt, wait_exponential, retry_if_exception_type,
     before_sleep_log, RetryError
@@ -13,7 +16,10 @@ from tenacity import (
 import prompt_builder as pb
 from config import (
     CLOUDFLARE_WORKER_URL, CLOUDFLARE_AUTH_TOKEN, DEFAULT_LANGUAGE,
-    INTERVENTION_MAX_RETRY, INTERVENTION_TIMEOUT_SEC # Настройки для вмешательств
+    INTERVENTION_MAX_RETRY, INTERVENTION_TIMEOUT_SEC, # Настройки для вмешательств
+    PROXY_HTTP2_ENABLED, PROXY_MAX_CONNECTIONS, PROXY_MAX_KEEPALIVE_CONNECTIONS,
+    PROXY_KEEPALIVE_EXPIRY_SEC, PROXY_CONNECT_TIMEOUT_SEC, PROXY_WARMUP_ENABLED,
+    GEMINI_STREAMING_ENABLED, MAP_REDUCE_THRESHOLD_TOKENS, MAP_REDUCE_CHUNK_TOKENS, MAP_REDUCE_CONCURRENCY
 )
 from localization import get_user_friendly_proxy_error, get_text # Добавили get_text для user-friendly ошибки конфига
 
@@ -24,6 +30,65 @@ retry_log = logging.getLogger(__name__ + '.retry') # Отдельный логг
 ContentPart = pb.ContentPart
 PreparedContent = pb.PreparedContent
 
+# --- Общий HTTP-клиент к прокси ---
+# Один клиент на все приложение: пул соединений и keep-alive убирают TCP/TLS
+# рукопожатие из каждого запроса и каждого ретрая. Создается в main.post_init.
+_http_client: Optional[httpx.AsyncClient] = None
+_proxy_stats: Dict[str, Any] = {
+    'requests': 0, 'errors': 0, 'last_ms': 0.0, 'max_ms': 0.0, 'total_ms': 0.0,
+    'startup_ms': None, 'http_version': None,
+    'stream_requests': 0, 'stream_fallbacks': 0, 'last_ttft_ms': 0.0, 'total_ttft_ms': 0.0,
+}
+
+def _create_http_client() -> httpx.AsyncClient:
+    http2 = PROXY_HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+    if PROXY_HTTP2_ENABLED and not http2: logger.warning("HTTP/2 для прокси запрошен, но пакет 'h2' не установлен. Используется HTTP/1.1.")
+    limits = httpx.Limits(max_connections=PROXY_MAX_CONNECTIONS, max_keepalive_connections=PROXY_MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=PROXY_KEEPALIVE_EXPIRY_SEC)
+    # Таймаут по умолчанию переопределяется в каждом запросе (истории долгие, вмешательства короткие)
+    timeout = httpx.Timeout(120.0, connect=PROXY_CONNECT_TIMEOUT_SEC)
+    logger.info(f"HTTP-клиент прокси: http2={http2}, max_connections={PROXY_MAX_CONNECTIONS}, keepalive={PROXY_MAX_KEEPALIVE_CONNECTIONS}/{PROXY_KEEPALIVE_EXPIRY_SEC}s")
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий клиент; если init_http_client не вызывался (скрипты), создает его лениво."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed: _http_client = _create_http_client()
+    return _http_client
+
+async def init_http_client():
+    """Создает общий клиент и (опционально) прогревает соединение к воркеру, замеряя время старта."""
+    started = time.perf_counter()
+    client = _get_http_client()
+    if PROXY_WARMUP_ENABLED and CLOUDFLARE_WORKER_URL:
+        try:
+            # Воркер отвечает 404 на GET без обращения к Gemini - этого хватает, чтобы поднять TCP/TLS
+            response = await client.get(CLOUDFLARE_WORKER_URL, timeout=PROXY_CONNECT_TIMEOUT_SEC)
+            _proxy_stats['http_version'] = response.http_version
+        except httpx.HTTPError as e: logger.warning(f"Прогрев соединения с прокси не удался: {e}")
+    _proxy_stats['startup_ms'] = (time.perf_counter() - started) * 1000
+    logger.info(f"HTTP-клиент прокси готов за {_proxy_stats['startup_ms']:.0f} мс (протокол: {_proxy_stats['http_version'] or 'n/a'}).")
+
+async def close_http_client():
+    """Закрывает общий клиент (идемпотентно)."""
+    global _http_client
+    if _http_client is None: return
+    try: await _http_client.aclose(); logger.info("HTTP-клиент прокси закрыт.")
+    except Exception as e: logger.error(f"Ошибка при закрытии HTTP-клиента прокси: {e}")
+    finally: _http_client = None
+
+def get_proxy_stats() -> Dict[str, Any]:
+    """Метрики запросов к прокси (латентность одной попытки, включая ретраи как отдельные попытки)."""
+    stats = dict(_proxy_stats)
+    stats['avg_ms'] = stats['total_ms'] / stats['requests'] if stats['requests'] else 0.0
+    stats['avg_ttft_ms'] = stats['total_ttft_ms'] / stats['stream_requests'] if stats['stream_requests'] else 0.0
+    return stats
+
+def _record_proxy_latency(elapsed_ms: float, ok: bool, http_version: Optional[str] = None):
+    _proxy_stats['requests'] += 1; _proxy_stats['last_ms'] = elapsed_ms; _proxy_stats['total_ms'] += elapsed_ms
+    _proxy_stats['max_ms'] = max(_proxy_stats['max_ms'], elapsed_ms)
+    if not ok: _proxy_stats['errors'] += 1
+    if http_version: _proxy_stats['http_version'] = http_version
+
 # --- Логика Retry ---
 
 def _is_retryable_exception(exception: BaseException) -> bool:
@@ -86,41 +151,48 @@ async def _call_proxy(
     @retry_decorator
     async def _make_request():
         logger.info(f"{log_prefix} Отправка запроса к прокси: {proxy_url} (payload ~{len(str(payload)) // 1024} KB, timeout={effective_timeout}s)")
-        async with httpx.AsyncClient(timeout=effective_timeout) as client:
-            response = await client.post(proxy_url, json=payload, headers=headers)
-
+        started = time.perf_counter()
+        try: response = await _get_http_client().post(proxy_url, json=payload, headers=headers, timeout=effective_timeout)
+        except httpx.RequestError as req_err:
+            _record_proxy_latency((time.perf_counter() - started) * 1000, ok=False)
+            logger.warning(f"{log_prefix} Сетевая ошибка: {req_err}, попытка повтора...")
+            raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        _record_proxy_latency(elapsed_ms, ok=response.is_success, http_version=response.http_version)
+        logger.debug(f"{log_prefix} Ответ прокси за {elapsed_ms:.0f} мс ({response.http_version}).")
+
+        try:
+            response.raise_for_status() # Генерирует исключение для 4xx/5xx
+            # Если мы здесь, статус успешный (2xx)
+            logger.info(f"{log_prefix} Успешный ответ ({response.status_code}) от прокси.")
             try:
-                response.raise_for_status() # Генерирует исключение для 4xx/5xx
-                # Если мы здесь, статус успешный (2xx)
-                logger.info(f"{log_prefix} Успешный ответ ({response.status_code}) от прокси.")
+                # Пытаемся распарсить JSON из успешного ответа
+                return response.json()
+            except Exception as json_err:
+                 logger.error(f"{log_prefix} Не удалось распарсить JSON из УСПЕШНОГО ответа прокси ({response.status_code}): {json_err}")
+                 # Возвращаем словарь ошибки, т.к. не смогли получить результат
+                 return {"error": f"Proxy OK but failed to parse JSON ({response.status_code})"}
+
+        except httpx.HTTPStatusError as http_err:
+            # Ошибка HTTP (4xx/5xx)
+            # Проверяем, требует ли ошибка повторной попытки согласно нашей логике
+            if _is_retryable_exception(http_err):
+                logger.warning(f"{log_prefix} Получена ошибка {http_err.response.status_code}, попытка повтора...")
+                raise http_err # Передаем исключение дальше для механизма retry
+            else:
+                # Ошибка не требует повтора (напр., 400 Bad Request, 401 Unauthorized)
+                logger.warning(f"{log_prefix} Прокси вернул неretryable статус {http_err.response.status_code}. Тело: {response.text[:200]}")
+                # Пытаемся получить JSON с описанием ошибки от прокси
                 try:
-                    # Пытаемся распарсить JSON из успешного ответа
                     return response.json()
-                except Exception as json_err:
-                     logger.error(f"{log_prefix} Не удалось распарсить JSON из УСПЕШНОГО ответа прокси ({response.status_code}): {json_err}")
-                     # Возвращаем словарь ошибки, т.к. не смогли получить результат
-                     return {"error": f"Proxy OK but failed to parse JSON ({response.status_code})"}
-
-            except httpx.HTTPStatusError as http_err:
-                # Ошибка HTTP (4xx/5xx)
-                # Проверяем, требует ли ошибка повторной попытки согласно нашей логике
-                if _is_retryable_exception(http_err):
-                    logger.warning(f"{log_prefix} Получена ошибка {http_err.response.status_code}, попытка повтора...")
-                    raise http_err # Передаем исключение дальше для механизма retry
-                else:
-                    # Ошибка не требует повтора (напр., 400 Bad Request, 401 Unauthorized)
-                    logger.warning(f"{log_prefix} Прокси вернул неretryable статус {http_err.response.status_code}. Тело: {response.text[:200]}")
-                    # Пытаемся получить JSON с описанием ошибки от прокси
-                    try:
-                        return response.json()
-                    except Exception:
-                         # Если тело ответа - не JSON, возвращаем свою ошибку
-                         return {"error": f"Proxy returned status {http_err.response.status_code}"}
-
-            except httpx.RequestError as req_err:
-                # Ошибка сети или подключения (всегда требует повтора по нашим правилам)
-                logger.warning(f"{log_prefix} Сетевая ошибка: {req_err}, попытка повтора...")
-                raise req_err # Передаем исключение дальше для механизма retry
+                except Exception:
+                     # Если тело ответа - не JSON, возвращаем свою ошибку
+                     return {"error": f"Proxy returned status {http_err.response.status_code}"}
+
+        except httpx.RequestError as req_err:
+            # Ошибка сети или подключения (всегда требует повтора по нашим правилам)
+            logger.warning(f"{log_prefix} Сетевая ошибка: {req_err}, попытка повтора...")
+            raise req_err # Передаем исключение дальше для механизма retry
 
     # Выполняем внутреннюю функцию с применением retry декоратора
     try:
@@ -139,6 +211,26 @@ async def _call_proxy(
 
 # --- Обработка ответа и подготовка данных ---
 
+def _build_payload(prepared_content: PreparedContent) -> Dict[str, Any]:
+    """Формирует JSON для воркера: строки как есть, изображения - в Base64."""
+    json_payload_content = []
+    # Кодируем изображения в Base64
+    for part in prepared_content:
+        if isinstance(part, str):
+            json_payload_content.append(part)
+        elif isinstance(part, dict) and 'data' in part and isinstance(part['data'], bytes):
+            base64_encoded_data = base64.b64encode(part['data']).decode('utf-8')
+            json_payload_content.append({
+                "mime_type": part.get('mime_type', 'image/jpeg'), # Gemini предпочитает JPEG/PNG/WEBP/HEIC/HEIF
+                "data_base64": base64_encoded_data
+            })
+        else:
+            logger.warning(f"Пропуск некорректной части контента при подготовке JSON: {type(part)}")
+
+    if not json_payload_content:
+        raise ValueError("Нет валидных частей контента после форматирования для JSON.")
+    return {"content": json_payload_content}
+
 async def generate_via_proxy(
     prepared_content: Optional[PreparedContent],
     lang: str = DEFAULT_LANGUAGE,
@@ -153,32 +245,13 @@ async def generate_via_proxy(
         # Это не ошибка, просто нет данных
         return "Нет данных для обработки.", None
 
-    json_payload_content = []
-    try:
-        # Кодируем изображения в Base64
-        for part in prepared_content:
-            if isinstance(part, str):
-                json_payload_content.append(part)
-            elif isinstance(part, dict) and 'data' in part and isinstance(part['data'], bytes):
-                base64_encoded_data = base64.b64encode(part['data']).decode('utf-8')
-                json_payload_content.append({
-                    "mime_type": part.get('mime_type', 'image/jpeg'), # Gemini предпочитает JPEG/PNG/WEBP/HEIC/HEIF
-                    "data_base64": base64_encoded_data
-                })
-            else:
-                logger.warning(f"Пропуск некорректной части контента при подготовке JSON: {type(part)}")
-
-        if not json_payload_content:
-            raise ValueError("Нет валидных частей контента после форматирования для JSON.")
-
+    try: payload = _build_payload(prepared_content)
     except Exception as e:
         logger.error(f"Ошибка подготовки JSON payload: {e}", exc_info=True)
         technical_error = f"Payload prep error: {e.__class__.__name__}"
         user_error = get_user_friendly_proxy_error(technical_error, lang)
         return None, user_error
 
-    payload = {"content": json_payload_content}
-
     try:
         # Вызываем прокси, передавая флаг для настроек retry/timeout
         proxy_response_data = await _call_proxy(
@@ -225,6 +298,71 @@ async def generate_via_proxy(
              # Уведомление владельца произойдет в вызывающем коде (generate_now и т.д.)
         return None, user_error
 
+# --- Стриминг (/generate_stream на воркере) ---
+
+class ProxyStreamError(Exception):
+    """Ошибка стрима от прокси (technical message для get_user_friendly_proxy_error)."""
+
+async def stream_via_proxy(prepared_content: PreparedContent, timeout: float = 120.0) -> AsyncIterator[str]:
+    """
+    Асинхронный итератор по фрагментам текста от /generate_stream воркера (SSE).
+    Без ретраев: при ошибке вызывающий код откатывается на обычный generate_via_proxy.
+    timeout - максимальная пауза между фрагментами. Пишет time-to-first-token в статистику.
+    """
+    if not CLOUDFLARE_WORKER_URL or not CLOUDFLARE_AUTH_TOKEN: raise ValueError("Proxy URL or Auth Token is not configured.")
+    headers = {"Content-Type": "application/json", "X-Auth-Token": CLOUDFLARE_AUTH_TOKEN, "Accept": "text/event-stream"}
+    proxy_url = f"{CLOUDFLARE_WORKER_URL.rstrip('/')}/generate_stream"
+    payload = _build_payload(prepared_content)
+    started = time.perf_counter(); first_chunk = True
+    logger.info(f"[Stream] Отправка запроса к прокси: {proxy_url} (payload ~{len(str(payload)) // 1024} KB)")
+    async with _get_http_client().stream("POST", proxy_url, json=payload, headers=headers, timeout=timeout) as response:
+        if response.status_code != 200 or not response.headers.get("content-type", "").startswith("text/event-stream"):
+            body = (await response.aread()).decode("utf-8", "replace")
+            try: error = json.loads(body).get("error") or f"Proxy returned status {response.status_code}"
+            except (ValueError, AttributeError): error = f"Proxy returned status {response.status_code}"
+            raise ProxyStreamError(error)
+        event, data_lines = "message", []
+        async for line in response.aiter_lines():
+            if line.startswith("event:"): event = line[6:].strip(); continue
+            if line.startswith("data:"): data_lines.append(line[5:].strip()); continue
+            if line or not data_lines: continue
+            # Пустая строка - конец события
+            data = json.loads("".join(data_lines)); data_lines = []
+            if event == "chunk" and data.get("text"):
+                if first_chunk:
+                    ttft_ms = (time.perf_counter() - started) * 1000; first_chunk = False
+                    _proxy_stats['stream_requests'] += 1; _proxy_stats['last_ttft_ms'] = ttft_ms; _proxy_stats['total_ttft_ms'] += ttft_ms
+                    logger.info(f"[Stream] Первый фрагмент через {ttft_ms:.0f} мс.")
+                yield data["text"]
+            elif event == "error": raise ProxyStreamError(data.get("error") or "Unknown stream error")
+            elif event == "done": logger.info(f"[Stream] Завершено за {(time.perf_counter() - started) * 1000:.0f} мс (finish_reason={data.get('finish_reason')})."); return
+            event = "message"
+    raise ProxyStreamError("Stream ended without 'done' event")
+
+async def generate_via_proxy_streaming(
+    prepared_content: Optional[PreparedContent],
+    lang: str = DEFAULT_LANGUAGE,
+    on_progress: Optional[Callable[[str], Awaitable[None]]] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Как generate_via_proxy, но с прогрессом: on_progress(накопленный_текст) вызывается на каждом фрагменте.
+    При любой ошибке стрима (в т.ч. старый воркер без /generate_stream) откатывается на обычный запрос.
+    """
+    if not prepared_content or not GEMINI_STREAMING_ENABLED or on_progress is None:
+        return await generate_via_proxy(prepared_content, lang)
+    accumulated = ""
+    try:
+        async for piece in stream_via_proxy(prepared_content):
+            accumulated += piece
+            try: await on_progress(accumulated)
+            except Exception as progress_e: logger.warning(f"[Stream] Ошибка колбэка прогресса: {progress_e}")
+        if accumulated.strip(): return accumulated.strip(), None
+        logger.warning("[Stream] Стрим завершился без текста, повтор без стрима.")
+    except (ProxyStreamError, httpx.HTTPError, ValueError) as e:
+        logger.warning(f"[Stream] Стрим не удался ({e.__class__.__name__}: {e}), повтор без стрима.")
+    _proxy_stats['stream_fallbacks'] += 1
+    return await generate_via_proxy(prepared_content, lang)
+
 # --- Обертки для конкретных задач ---
 
 async def safe_generate_output(
@@ -233,35 +371,115 @@ async def safe_generate_output(
     output_format: str,
     genre_key: Optional[str],
     personality_key: str,
-    lang: str = DEFAULT_LANGUAGE
+    lang: str = DEFAULT_LANGUAGE,
+    on_progress: Optional[Callable[[str], Awaitable[None]]] = None
 ) -> Tuple[Optional[str], Optional[str]]:
     """
     Безопасно генерирует историю ИЛИ дайджест.
-    Использует стандартные настройки retry/timeout.
+    Использует стандартные настройки retry/timeout; с on_progress - стриминг.
     """
     logger.debug(f"Generating output: format={output_format}, genre={genre_key}, personality={personality_key}, lang={lang}")
-    prepared_content = pb.build_content(
-        messages, images_data, output_format, genre_key, personality_key
+    prepared_content = pb.build_content( # Выборка до бюджета - только если большой лог некуда отдать в map-reduce
+        messages, images_data, output_format, genre_key, personality_key, token_budget=0 if MAP_REDUCE_THRESHOLD_TOKENS > 0 else None
     )
     if not prepared_content:
         # Используем локализованное имя формата в сообщении
         format_name = get_text(f"output_format_name_{output_format}", lang)
         return f"Нет данных для генерации '{format_name}'.", None
+    estimated_tokens = pb.estimate_tokens(prepared_content)
+    if MAP_REDUCE_THRESHOLD_TOKENS > 0 and estimated_tokens > MAP_REDUCE_THRESHOLD_TOKENS:
+        return await _generate_output_map_reduce(messages, images_data, output_format, genre_key, personality_key, lang, on_progress, estimated_tokens)
+    if on_progress: return await generate_via_proxy_streaming(prepared_content, lang, on_progress)
     # Вызываем прокси со стандартными настройками
     return await generate_via_proxy(prepared_content, lang, use_intervention_retry=False)
 
+async def _generate_output_map_reduce(
+    messages: List[Dict[str, Any]], images_data: Dict[str, bytes], output_format: str, genre_key: Optional[str],
+    personality_key: str, lang: str, on_progress: Optional[Callable[[str], Awaitable[None]]], estimated_tokens: int
+) -> Tuple[Optional[str], Optional[str]]:
+    """Лог больше порога: части по времени -> параллельные конспекты (не больше MAP_REDUCE_CONCURRENCY
+    запросов) -> финальный проход в формате/жанре/личности чата. Упавшая часть отмечается пропуском;
+    если не удалась ни одна, возвращается ошибка первой."""
+    logger.info(f"[MapReduce] Лог ~{estimated_tokens} токенов > {MAP_REDUCE_THRESHOLD_TOKENS}: {len(messages)} сообщений.")
+    notes, error, _ = await _map_chunk_notes(messages, images_data, lang)
+    if notes is None: return None, error
+    reduce_content = pb.build_reduce_content(notes, output_format, genre_key, personality_key)
+    if on_progress: return await generate_via_proxy_streaming(reduce_content, lang, on_progress)
+    return await generate_via_proxy(reduce_content, lang)
+
+async def _map_chunk_notes(
+    messages: List[Dict[str, Any]], images_data: Dict[str, bytes], lang: str, image_offset: int = 0
+) -> Tuple[Optional[List[str]], Optional[str], int]:
+    """Map-фаза: конспекты частей лога. Возвращает (конспекты | None, ошибка, номер последнего изображения)."""
+    chunks = pb.split_messages_for_map_reduce(messages, images_data, MAP_REDUCE_CHUNK_TOKENS)
+    started = time.perf_counter()
+    contents: List[Optional[PreparedContent]] = []
+    for i, chunk in enumerate(chunks, 1):
+        content, image_offset = pb.build_chunk_notes_content(chunk, images_data, i, len(chunks), image_offset)
+        contents.append(content)
+    semaphore = asyncio.Semaphore(max(1, MAP_REDUCE_CONCURRENCY))
+
+    async def _notes(content: Optional[PreparedContent]) -> Tuple[Optional[str], Optional[str]]:
+        if not content: return None, None
+        async with semaphore: return await generate_via_proxy(content, lang)
+
+    results = await asyncio.gather(*(_notes(c) for c in contents))
+    failed = [error for text, error in results if not text]
+    if len(failed) == len(results): return None, failed[0] if failed else None, image_offset
+    if failed: logger.warning(f"[MapReduce] Не удалось законспектировать {len(failed)} из {len(results)} частей.")
+    logger.info(f"[MapReduce] {len(results)} конспектов готовы за {time.perf_counter() - started:.1f}s.")
+    return [text if text else "(конспект этой части недоступен)" for text, _ in results], None, image_offset
+
+async def safe_generate_partial_notes(
+    messages: List[Dict[str, Any]], images_data: Dict[str, bytes], lang: str = DEFAULT_LANGUAGE, image_offset: int = 0
+) -> Tuple[Optional[str], Optional[str], int]:
+    """Промежуточный конспект части дня (partial_digest_job). Возвращает (конспект, ошибка, номер последнего изображения).
+    Слишком большая часть конспектируется по кускам, куски склеиваются."""
+    content, last_image = pb.build_chunk_notes_content(messages, images_data, image_offset=image_offset)
+    if not content: return None, None, image_offset
+    if MAP_REDUCE_THRESHOLD_TOKENS > 0 and pb.estimate_tokens(content) > MAP_REDUCE_THRESHOLD_TOKENS:
+        notes, error, last_image = await _map_chunk_notes(messages, images_data, lang, image_offset)
+        return ("\n\n".join(notes) if notes else None), error, last_image
+    text, error = await generate_via_proxy(content, lang)
+    return text, error, last_image
+
+async def safe_generate_output_from_partials(
+    partial_notes: List[str], tail_messages: List[Dict[str, Any]], images_data: Dict[str, bytes],
+    output_format: str, genre_key: Optional[str], personality_key: str, lang: str = DEFAULT_LANGUAGE,
+    image_offset: int = 0, on_progress: Optional[Callable[[str], Awaitable[None]]] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """История/дайджест дня из промежуточных конспектов и полного лога оставшегося "хвоста" сообщений."""
+    tail_parts, _ = pb.build_log_parts(pb.in_time_order(tail_messages), images_data, image_offset)
+    if tail_parts and MAP_REDUCE_THRESHOLD_TOKENS > 0 and pb.estimate_tokens(tail_parts) > MAP_REDUCE_THRESHOLD_TOKENS:
+        tail_notes, error, _ = await _map_chunk_notes(tail_messages, images_data, lang, image_offset) # Хвост сам оказался огромным
+        if tail_notes is None: return None, error
+        partial_notes, tail_parts = partial_notes + tail_notes, None
+    logger.info(f"[Partials] Финальный проход: {len(partial_notes)} конспектов + {len(tail_messages)} сообщений хвоста.")
+    content = pb.build_reduce_content(partial_notes, output_format, genre_key, personality_key, tail_parts=tail_parts)
+    if on_progress: return await generate_via_proxy_streaming(content, lang, on_progress)
+    return await generate_via_proxy(content, lang)
+
 async def safe_generate_summary(
     messages: List[Dict[str, Any]],
-    lang: str = DEFAULT_LANGUAGE
+    lang: str = DEFAULT_LANGUAGE,
+    on_progress: Optional[Callable[[str], Awaitable[None]]] = None
 ) -> Tuple[Optional[str], Optional[str]]:
     """
     Безопасно генерирует саммари (для команды /summarize).
-    Использует стандартные настройки retry/timeout.
+    Использует стандартные настройки retry/timeout; с on_progress - стриминг.
     """
     logger.debug(f"Generating simple summary, lang={lang}")
-    prepared_content = pb.build_summary_content(messages)
+    return await safe_generate_summary_from_content(pb.build_summary_content(messages), lang, on_progress)
+
+async def safe_generate_summary_from_content(
+    prepared_content: Optional[PreparedContent],
+    lang: str = DEFAULT_LANGUAGE,
+    on_progress: Optional[Callable[[str], Awaitable[None]]] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """Саммари по уже собранному контенту (pb.build_summary_content, например в потоке БД над потоком сообщений)."""
     if not prepared_content:
         return "Нет текстовых сообщений для выжимки.", None
+    if on_progress: return await generate_via_proxy_streaming(prepared_content, lang, on_progress)
     # Вызываем прокси со стандартными настройками
     return await generate_via_proxy(prepared_content, lang, use_intervention_retry=False)
 
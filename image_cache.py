@@ -0,0 +1,113 @@
+# image_cache.py
+# Дисковый кэш изображений чатов, ключ - file_unique_id Telegram (одинаков для одного и того же файла).
+# Повторные генерации за тот же день (/generate_now, /regenerate_story, daily_story_job)
+# берут фото отсюда без сетевых запросов. Размер ограничен, вытеснение - LRU по mtime.
+# Все операции с диском выполняются в потоках (asyncio.to_thread), event loop не блокируется.
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from config import IMAGE_CACHE_ENABLED, IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+_CACHE_SUFFIX = ".img"
+_SAFE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,128}$") # file_unique_id - base64url
+_lock = threading.Lock() # Защищает счетчики и вытеснение (операции идут из разных потоков)
+_total_bytes: Optional[int] = None # Лениво считается при первом обращении
+_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'pruned': 0}
+
+def _path_for(file_unique_id: str) -> Optional[str]:
+    if not _SAFE_ID_RE.match(file_unique_id or ""): return None
+    return os.path.join(IMAGE_CACHE_DIR, file_unique_id[:2], file_unique_id + _CACHE_SUFFIX)
+
+def _iter_entries() -> Iterable[Tuple[str, str, os.stat_result]]:
+    """(file_unique_id, path, stat) для всех файлов кэша."""
+    if not os.path.isdir(IMAGE_CACHE_DIR): return
+    for sub in os.scandir(IMAGE_CACHE_DIR):
+        if not sub.is_dir(): continue
+        for entry in os.scandir(sub.path):
+            if entry.name.endswith(_CACHE_SUFFIX):
+                try: yield entry.name[:-len(_CACHE_SUFFIX)], entry.path, entry.stat()
+                except FileNotFoundError: continue
+
+def _ensure_total_locked():
+    global _total_bytes
+    if _total_bytes is None: _total_bytes = sum(st.st_size for _, _, st in _iter_entries())
+
+def _get_sync(file_unique_id: str) -> Optional[bytes]:
+    path = _path_for(file_unique_id)
+    if not path: return None
+    try:
+        with open(path, "rb") as f: data = f.read()
+        os.utime(path, None) # mtime = время последнего использования (для LRU)
+        with _lock: _stats['hits'] += 1
+        return data
+    except FileNotFoundError:
+        with _lock: _stats['misses'] += 1
+        return None
+
+def _put_sync(file_unique_id: str, data: bytes) -> bytes:
+    """Сохраняет изображение (уже обработанное image_processing) и возвращает сохраненные байты."""
+    global _total_bytes
+    path = _path_for(file_unique_id)
+    if not path: return data
+    with _lock: _ensure_total_locked() # Считаем до записи, иначе новый файл учтется дважды
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f: f.write(data)
+    old_size = os.path.getsize(path) if os.path.exists(path) else 0
+    os.replace(tmp_path, path) # Атомарно: читатели не увидят недописанный файл
+    with _lock:
+        _total_bytes += len(data) - old_size; _stats['writes'] += 1
+        if _total_bytes > IMAGE_CACHE_MAX_MB * 1024 * 1024: _evict_locked()
+    return data
+
+def _evict_locked():
+    """Удаляет самые давно использованные файлы, пока кэш не станет <= 90% лимита."""
+    global _total_bytes
+    target = int(IMAGE_CACHE_MAX_MB * 1024 * 1024 * 0.9)
+    entries = sorted(_iter_entries(), key=lambda e: e[2].st_mtime)
+    for _, path, st in entries:
+        if _total_bytes <= target: break
+        try: os.remove(path); _total_bytes -= st.st_size; _stats['evictions'] += 1
+        except FileNotFoundError: pass
+    logger.info(f"Image cache: вытеснение завершено, размер {_total_bytes / 1048576:.1f} МБ.")
+
+def _prune_sync(keep_ids: Set[str]) -> Tuple[int, int]:
+    """Удаляет изображения, на которые больше не ссылается ни одно сообщение. Возвращает (файлов, байт)."""
+    global _total_bytes
+    removed, freed = 0, 0
+    with _lock:
+        for uid, path, st in list(_iter_entries()):
+            if uid in keep_ids: continue
+            try: os.remove(path); removed += 1; freed += st.st_size
+            except FileNotFoundError: pass
+        if _total_bytes is not None: _total_bytes -= freed
+        _stats['pruned'] += removed
+    return removed, freed
+
+# --- Асинхронный интерфейс ---
+async def get(file_unique_id: str) -> Optional[bytes]:
+    if not IMAGE_CACHE_ENABLED: return None
+    try: return await asyncio.to_thread(_get_sync, file_unique_id)
+    except OSError as e: logger.warning(f"Image cache: ошибка чтения {file_unique_id}: {e}"); return None
+
+async def put(file_unique_id: str, data: bytes) -> bytes:
+    if not IMAGE_CACHE_ENABLED: return data
+    try: return await asyncio.to_thread(_put_sync, file_unique_id, data)
+    except OSError as e: logger.warning(f"Image cache: ошибка записи {file_unique_id}: {e}"); return data
+
+async def prune_orphans(keep_ids: Set[str]) -> Tuple[int, int]:
+    if not IMAGE_CACHE_ENABLED or not os.path.isdir(IMAGE_CACHE_DIR): return 0, 0
+    started = time.perf_counter()
+    removed, freed = await asyncio.to_thread(_prune_sync, keep_ids)
+    logger.info(f"Image cache: удалено {removed} осиротевших файлов ({freed / 1048576:.1f} МБ) за {time.perf_counter() - started:.2f}s.")
+    return removed, freed
+
+def get_stats() -> Dict[str, int]:
+    with _lock: return dict(_stats, size_bytes=_total_bytes or 0)
@@ -0,0 +1,80 @@
+# image_processing.py
+# Подготовка фото перед отправкой в прокси: уменьшение до IMAGE_MAX_DIMENSION по большей
+# стороне и перекодирование в JPEG/WEBP с IMAGE_QUALITY. Фото из Telegram бывают до 20 МБ,
+# а в JSON они уходят в Base64 (+33%), поэтому экономия на payload значительная.
+# Работа идет в отдельном пуле потоков (Pillow отпускает GIL при decode/resize/encode).
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from config import (
+    IMAGE_PREPROCESS_ENABLED, IMAGE_MAX_DIMENSION, IMAGE_OUTPUT_FORMAT, IMAGE_QUALITY,
+    IMAGE_PROCESSING_WORKERS
+)
+
+try: # Pillow опционален: без него изображения уходят как есть
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_stats: Dict[str, int] = {'processed': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+if IMAGE_PREPROCESS_ENABLED and Image is None:
+    logger.warning("Pillow не установлен: предобработка изображений отключена, фото отправляются без изменений.")
+
+def detect_mime(data: bytes) -> str:
+    """Определяет MIME по сигнатуре файла (по умолчанию image/jpeg, как раньше)."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n": return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP": return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"): return "image/gif"
+    return "image/jpeg"
+
+def _process_sync(data: bytes) -> bytes:
+    """Уменьшает и перекодирует одно изображение. Если выгоды нет - возвращает оригинал."""
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img) # Учитываем поворот из EXIF до уменьшения
+        if max(img.size) > IMAGE_MAX_DIMENSION: img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, format=IMAGE_OUTPUT_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+    processed = out.getvalue()
+    return processed if len(processed) < len(data) else data
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None: _executor = ThreadPoolExecutor(max_workers=IMAGE_PROCESSING_WORKERS, thread_name_prefix="img-proc")
+    return _executor
+
+async def preprocess_image(data: bytes) -> bytes:
+    """Асинхронно готовит одно изображение для прокси (при ошибке - оригинал)."""
+    if not IMAGE_PREPROCESS_ENABLED or Image is None: return data
+    loop = asyncio.get_running_loop()
+    try: processed = await loop.run_in_executor(_get_executor(), _process_sync, data)
+    except Exception as e: logger.warning(f"Не удалось обработать изображение ({len(data)} байт): {e}"); return data
+    _stats['processed'] += 1; _stats['bytes_in'] += len(data); _stats['bytes_out'] += len(processed)
+    return processed
+
+async def preprocess_images(images: Dict[str, bytes], log_prefix: str = "") -> Tuple[Dict[str, bytes], int]:
+    """Обрабатывает пачку изображений параллельно. Возвращает (результат, сэкономлено байт)."""
+    if not images: return images, 0
+    keys = list(images.keys())
+    results = await asyncio.gather(*(preprocess_image(images[k]) for k in keys))
+    processed = dict(zip(keys, results))
+    bytes_in = sum(len(v) for v in images.values()); bytes_out = sum(len(v) for v in results)
+    saved = bytes_in - bytes_out
+    if saved > 0:
+        logger.info(f"{log_prefix} Images: {len(keys)} шт., {bytes_in // 1024} KB -> {bytes_out // 1024} KB (сэкономлено {saved // 1024} KB, ~{saved * 4 // 3 // 1024} KB в Base64).")
+    return processed, saved
+
+def get_stats() -> Dict[str, int]:
+    return dict(_stats, bytes_saved=_stats['bytes_in'] - _stats['bytes_out'])
+
+def shutdown():
+    global _executor
+    if _executor is not None: _executor.shutdown(wait=False, cancel_futures=True); _executor = None
@@ -2,6 +2,7 @@
 import logging
 import asyncio
 import datetime
+import time
 import pytz
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot
 from telegram.constants import ParseMode
@@ -12,19 +13,204 @@ import html
 
 # Импорты проекта
 import data_manager as dm
+import async_data_manager as adm
 import gemini_client as gc
+import image_cache
+import activity_tracker
 from config import (
-    BOT_OWNER_ID, SCHEDULE_HOUR, SCHEDULE_MINUTE, JOB_CHECK_INTERVAL_MINUTES,
-    DEFAULT_OUTPUT_FORMAT, DEFAULT_PERSONALITY # Добавлены для использования в коде
+    BOT_OWNER_ID,
+    DEFAULT_OUTPUT_FORMAT, DEFAULT_PERSONALITY, # Добавлены для использования в коде
+    DAILY_JOB_CONCURRENCY, DAILY_JOB_CHAT_TIMEOUT_SEC,
+    PURGE_JOB_INTERVAL_HOURS, PURGE_MAX_DELAY_HOURS, FTS_MERGE_BUDGET_SEC, ARCHIVE_ENABLED,
+    PARTIAL_DIGEST_INTERVAL_HOURS, PARTIAL_DIGEST_MIN_MESSAGES
 )
 from localization import get_text, get_chat_lang, get_output_format_name # Добавили get_output_format_name
 from utils import download_images, MAX_PHOTOS_TO_ANALYZE, notify_owner
 
 logger = logging.getLogger(__name__)
 
+_DAY_MS = 86400000
+_PARTIAL_DIGEST_LAG_MS = 60000 # Сообщения последней минуты еще могут быть в очереди записи - оставляем их хвосту
+
 # ==================================
 # ЗАДАЧА ГЕНЕРАЦИИ СВОДОК (ИСТОРИИ/ДАЙДЖЕСТЫ)
 # ==================================
+async def _process_scheduled_chat(
+    context: ContextTypes.DEFAULT_TYPE, bot: Bot, chat_id: int,
+    scheduled_ts: int, current_chat_log_prefix: str
+) -> Tuple[bool, Optional[Tuple[str, Optional[BaseException]]]]:
+    """
+    Генерирует и отправляет сводку одного чата за 24 часа до его запланированного времени
+    (scheduled_ts - слот из chat_schedule; при догоне пропущенного слота он в прошлом).
+    Возвращает (output_sent, error_for_owner). Все ошибки чата изолированы здесь.
+    """
+    output_sent = False
+    chat_lang = await get_chat_lang(chat_id)
+    error_for_owner: Optional[Tuple[str, Optional[BaseException]]] = None
+    settings = await adm.get_chat_settings(chat_id) # Получаем настройки чата ОДИН РАЗ
+
+    try:
+        # --- ОПРЕДЕЛЕНИЕ ПЕРИОДА В 24 ЧАСА ---
+        target_dt_utc = datetime.datetime.fromtimestamp(scheduled_ts, tz=pytz.utc)
+
+        # Рассчитываем время начала периода (24 часа ДО целевого времени)
+        since_dt_utc = target_dt_utc - datetime.timedelta(hours=24)
+        logger.debug(f"{current_chat_log_prefix} Fetching messages since {since_dt_utc.isoformat()}")
+
+        # --- ПОЛУЧЕНИЕ СООБЩЕНИЙ ЗА ПЕРИОД ---
+        messages = await adm.get_messages_for_chat_since(chat_id, since_dt_utc)
+
+        if not messages:
+            logger.info(f"{current_chat_log_prefix} No messages found since {since_dt_utc.isoformat()}, skipping.")
+            return False, None # Переходим к следующему чату
+
+        logger.info(f"{current_chat_log_prefix} Found {len(messages)} messages since {since_dt_utc.isoformat()}.")
+
+        # Получаем остальные настройки формата, жанра, личности
+        output_format = settings.get('output_format', DEFAULT_OUTPUT_FORMAT)
+        chat_genre = settings.get('story_genre', 'default')
+        personality_key = settings.get('story_personality', DEFAULT_PERSONALITY)
+        output_format_name = get_output_format_name(output_format, chat_lang)
+        logger.info(f"{current_chat_log_prefix} Format: {output_format}, Genre: {chat_genre}, Personality: {personality_key}")
+
+        # Промежуточные конспекты (partial_digest_job): начало суток уже сведено, в промпт идет только хвост
+        partials = _contiguous_partials(await adm.get_partial_digests(chat_id, dm.to_epoch_ms(since_dt_utc)), dm.to_epoch_ms(since_dt_utc)) if PARTIAL_DIGEST_INTERVAL_HOURS > 0 else []
+        partial_images = sum(p['image_count'] for p in partials)
+        tail_messages = [m for m in messages if m['timestamp'] >= partials[-1]['period_end_ms']] if partials else messages
+
+        # Скачиваем изображения (только для формата 'story'; лимит общий с конспектами)
+        downloaded_images = {}
+        if output_format == 'story':
+             downloaded_images = await download_images(context, tail_messages, chat_id, max(0, MAX_PHOTOS_TO_ANALYZE - partial_images))
+
+        # Генерируем результат
+        if partials:
+            logger.info(f"{current_chat_log_prefix} Using {len(partials)} partial digests ({sum(p['message_count'] for p in partials)} msgs) + {len(tail_messages)} tail msgs.")
+            output_text, error_msg_friendly = await gc.safe_generate_output_from_partials(
+                [p['notes'] for p in partials], tail_messages, downloaded_images, output_format, chat_genre, personality_key, chat_lang, image_offset=partial_images
+            )
+        else:
+            output_text, error_msg_friendly = await gc.safe_generate_output(
+                messages, downloaded_images, output_format, chat_genre, personality_key, chat_lang
+            )
+        photos_used = len(downloaded_images) + partial_images
+        if output_text: # /generate_now сразу после рассылки отдаст этот же текст
+            await adm.save_generated_output(chat_id, dm.output_fingerprint(output_format, chat_genre, personality_key, chat_lang), *dm.output_window(messages), output_text, error_msg_friendly, photos_used)
+
+        # --- Обработка и отправка результата ---
+        if output_text:
+            try:
+                # Определяем дату для заголовка
+                try:
+                    chat_tz_str = settings.get('timezone', 'UTC')
+                    chat_tz = pytz.timezone(chat_tz_str)
+                    target_dt_local = target_dt_utc.astimezone(chat_tz)
+                    date_str = target_dt_local.strftime("%d %B %Y")
+                except Exception:
+                     date_str = target_dt_utc.strftime("%d %B %Y") # Fallback to UTC date
+
+                photo_note_str = get_text("photo_info_text", chat_lang, count=photos_used) if photos_used else ""
+                chat_title_str = str(chat_id)
+                try:
+                    chat_info = await bot.get_chat(chat_id)
+                    chat_title_str = f"'{html.escape(chat_info.title)}'" if chat_info.title else str(chat_id)
+                except Exception as e_chat:
+                    logger.warning(f"{current_chat_log_prefix} Could not get chat title: {e_chat}")
+
+                header_loc_key = "daily_story_header"
+                final_message_header = get_text(
+                    header_loc_key, chat_lang,
+                    output_format_name_capital=get_output_format_name(output_format, chat_lang, capital=True),
+                    date_str=date_str, chat_title=chat_title_str, photo_info=photo_note_str
+                )
+                await bot.send_message(chat_id=chat_id, text=final_message_header, parse_mode=ParseMode.HTML)
+                await asyncio.sleep(0.2)
+
+                # Отправка тела и кнопок
+                sent_message = None
+                keyboard = InlineKeyboardMarkup([[
+                    InlineKeyboardButton("👍", callback_data="feedback_good_placeholder"),
+                    InlineKeyboardButton("👎", callback_data="feedback_bad_placeholder")
+                ]])
+                MAX_MSG_LEN = 4096
+                parts = [output_text[i:i+MAX_MSG_LEN] for i in range(0, len(output_text), MAX_MSG_LEN)]
+                if len(parts) > 1:
+                     logger.warning(f"{current_chat_log_prefix} Output too long ({len(output_text)} chars), splitting into {len(parts)} parts.")
+
+                for k, part in enumerate(parts):
+                    current_reply_markup = keyboard if k == len(parts) - 1 else None
+                    sent_message = await bot.send_message(chat_id=chat_id, text=part, reply_markup=current_reply_markup, parse_mode=ParseMode.MARKDOWN)
+                    if k < len(parts) - 1: await asyncio.sleep(0.5) # Небольшая пауза между частями
+
+                if sent_message: # Обновляем ID в кнопках последней части
+                    kb_upd = InlineKeyboardMarkup([[
+                        InlineKeyboardButton("👍", callback_data=f"feedback_good_{sent_message.message_id}"),
+                        InlineKeyboardButton("👎", callback_data=f"feedback_bad_{sent_message.message_id}")
+                    ]])
+                    try:
+                        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=sent_message.message_id, reply_markup=kb_upd)
+                    except BadRequest: # Игнорируем ошибку, если сообщение не изменилось
+                        pass
+                    except TelegramError as e:
+                        logger.warning(f"Error updating feedback buttons: {e}")
+
+                logger.info(f"{current_chat_log_prefix} {output_format_name.capitalize()} sent successfully for the last 24h.")
+                output_sent = True
+
+                # Отправляем примечание от прокси, если оно есть
+                if error_msg_friendly:
+                    try:
+                        await bot.send_message(chat_id=chat_id, text=get_text("proxy_note", chat_lang, note=error_msg_friendly), parse_mode=ParseMode.HTML)
+                    except Exception as e:
+                        logger.warning(f"{current_chat_log_prefix} Failed send proxy note: {e}")
+
+            except TelegramError as e: # Ошибка отправки в Telegram
+                logger.error(f"{current_chat_log_prefix} TG error sending output: {e}")
+                error_for_owner = (f"TG Send Err ({e.__class__.__name__})", e)
+                error_str = str(e).lower()
+                is_fatal = any(sub in error_str for sub in ["blocked", "deactivated", "kicked", "forbidden", "not found"])
+                if is_fatal:
+                    logger.warning(f"{current_chat_log_prefix} Disabling chat due to fatal TG error: {e}.")
+                    await adm.update_chat_setting(chat_id, 'enabled', False)
+                    error_for_owner = (f"Disabled: Fatal TG Err ({e.__class__.__name__})", e)
+            except Exception as e:
+                logger.exception(f"{current_chat_log_prefix} Unexpected error during sending output: {e}")
+                error_for_owner = (f"Send Err ({e.__class__.__name__})", e)
+
+        else: # Ошибка генерации (output_text is None)
+            logger.warning(f"{current_chat_log_prefix} Failed generate {output_format} for the last 24h. Reason: {error_msg_friendly}")
+            error_for_owner = (f"Gen Err ({error_msg_friendly or 'Unknown'})", None)
+            # Отправляем уведомление пользователю в чат
+            error_text_chat = get_text("daily_job_failed_chat_user_friendly", chat_lang, output_format_name=output_format_name, reason=error_msg_friendly or 'неизвестной')
+            try:
+                await bot.send_message(chat_id=chat_id, text=error_text_chat, parse_mode=ParseMode.HTML)
+            except TelegramError as e_err:
+                logger.warning(f"{current_chat_log_prefix} Failed send failure notification to chat: {e_err}")
+                error_for_owner = (f"Gen Err + Failed Notify ({e_err.__class__.__name__})", e_err) # Обновляем ошибку для владельца
+                error_str = str(e_err).lower()
+                is_fatal = any(sub in error_str for sub in ["blocked", "deactivated", "kicked", "forbidden", "not found"])
+                if is_fatal:
+                    logger.warning(f"{current_chat_log_prefix} Disabling chat after fatal TG error on sending failure notification: {e_err}.")
+                    await adm.update_chat_setting(chat_id, 'enabled', False)
+                    error_for_owner = (f"Disabled: Fatal TG Err ({e_err.__class__.__name__})", e_err)
+            except Exception as e_notify:
+                logger.exception(f"{current_chat_log_prefix} Unexpected error sending failure notification: {e_notify}")
+                error_for_owner = (f"Gen Err + Notify Err ({e_notify.__class__.__name__})", e_notify)
+
+    except Exception as e: # Глобальная ошибка обработки чата
+        logger.exception(f"{current_chat_log_prefix} CRITICAL error processing chat for the last 24h: {e}")
+        error_for_owner = (f"Critical Err ({e.__class__.__name__})", e)
+
+    return output_sent, error_for_owner
+
+def _contiguous_partials(partials: List[Dict[str, Any]], since_ms: int) -> List[Dict[str, Any]]:
+    """Непрерывная цепочка конспектов от начала окна (после смены времени сводки окна не совпадут - цепочка пуста)."""
+    chain: List[Dict[str, Any]] = []; expected_start = since_ms
+    for partial in partials:
+        if partial['period_start_ms'] != expected_start: break
+        chain.append(partial); expected_start = partial['period_end_ms']
+    return chain
+
 async def daily_story_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Периодически проверяет чаты и генерирует истории/дайджесты по расписанию
@@ -53,201 +239,42 @@ async def daily_story_job(context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.error(f"Failed get bot name: {e}")
 
     logger.info(f"[{bot_username}] Running {job_name}...")
-    enabled_chat_ids = dm.get_enabled_chats()
-    if not enabled_chat_ids:
-        logger.info(f"[{bot_username}] No enabled chats found for generation.")
-        return
-
-    now_utc = job_start_time
-    current_hour_utc = now_utc.hour
-    current_minute_utc = now_utc.minute
-
-    # Округляем текущее время до ближайшего интервала проверки
-    current_minute_rounded = (current_minute_utc // JOB_CHECK_INTERVAL_MINUTES) * JOB_CHECK_INTERVAL_MINUTES
-    logger.debug(f"UTC {now_utc:%H:%M}, checking for tasks ~{current_hour_utc:02d}:{current_minute_rounded:02d}")
-
-    chats_to_process = []
-    for chat_id in enabled_chat_ids:
-        settings = dm.get_chat_settings(chat_id)
-        target_hour_utc, target_minute_utc = SCHEDULE_HOUR, SCHEDULE_MINUTE
-        custom_time_utc_str = settings.get('custom_schedule_time')
-        if custom_time_utc_str:
-            try:
-                th, tm = map(int, custom_time_utc_str.split(':'))
-                target_hour_utc, target_minute_utc = th, tm
-            except (ValueError, TypeError):
-                logger.warning(f"[Chat {chat_id}] Invalid time format '{custom_time_utc_str}'. Using default.")
-        # Сравниваем текущее округленное время с целевым временем UTC
-        if current_hour_utc == target_hour_utc and current_minute_rounded == target_minute_utc:
-            chats_to_process.append(chat_id)
-            logger.debug(f"[Chat {chat_id}] Scheduled time matched.")
+    # Один запрос по индексу chat_schedule.next_run_ts вместо перебора всех включенных чатов
+    due_chats = await adm.claim_due_chats(job_start_time.timestamp())
+    scheduled_ts_by_chat = dict(due_chats)
+    chats_to_process = [chat_id for chat_id, _ in due_chats]
 
     if not chats_to_process:
         logger.info("No chats due for processing now.")
         return
     logger.info(f"Chats to process now ({len(chats_to_process)}): {chats_to_process}")
 
-    # --- Начало основного цикла обработки чатов ---
+    # --- Параллельная обработка чатов (не более DAILY_JOB_CONCURRENCY одновременно) ---
     processed_in_this_run = 0
-    for chat_id in chats_to_process:
-        current_chat_log_prefix = f"[{bot_username}][Chat {chat_id}]"
-        logger.info(f"{current_chat_log_prefix} Processing scheduled generation...")
-        output_sent = False
-        chat_lang = await get_chat_lang(chat_id)
-        error_for_owner: Optional[Tuple[str, Optional[BaseException]]] = None
-        settings = dm.get_chat_settings(chat_id) # Получаем настройки чата ОДИН РАЗ
-
-        try:
-            # --- ОПРЕДЕЛЕНИЕ ПЕРИОДА В 24 ЧАСА ---
-            target_hour_utc, target_minute_utc = SCHEDULE_HOUR, SCHEDULE_MINUTE
-            custom_time_utc_str = settings.get('custom_schedule_time')
-            if custom_time_utc_str:
-                try:
-                    th, tm = map(int, custom_time_utc_str.split(':'))
-                    target_hour_utc, target_minute_utc = th, tm
-                except (ValueError, TypeError):
-                    pass # Ошибка уже логировалась при проверке времени, используем дефолт
-
-            # Создаем datetime объект для целевого времени UTC СЕГОДНЯ
-            target_dt_utc = job_start_time.replace(
-                hour=target_hour_utc, minute=target_minute_utc, second=0, microsecond=0
-            )
-
-            # Рассчитываем время начала периода (24 часа ДО целевого времени)
-            since_dt_utc = target_dt_utc - datetime.timedelta(hours=24)
-            logger.debug(f"{current_chat_log_prefix} Fetching messages since {since_dt_utc.isoformat()}")
+    semaphore = asyncio.Semaphore(DAILY_JOB_CONCURRENCY)
 
-            # --- ПОЛУЧЕНИЕ СООБЩЕНИЙ ЗА ПЕРИОД ---
-            messages = dm.get_messages_for_chat_since(chat_id, since_dt_utc)
-
-            if not messages:
-                logger.info(f"{current_chat_log_prefix} No messages found since {since_dt_utc.isoformat()}, skipping.")
-                continue # Переходим к следующему чату
-
-            logger.info(f"{current_chat_log_prefix} Found {len(messages)} messages since {since_dt_utc.isoformat()}.")
-
-            # Получаем остальные настройки формата, жанра, личности
-            output_format = settings.get('output_format', DEFAULT_OUTPUT_FORMAT)
-            chat_genre = settings.get('story_genre', 'default')
-            personality_key = settings.get('story_personality', DEFAULT_PERSONALITY)
-            output_format_name = get_output_format_name(output_format, chat_lang)
-            logger.info(f"{current_chat_log_prefix} Format: {output_format}, Genre: {chat_genre}, Personality: {personality_key}")
-
-            # Скачиваем изображения (только для формата 'story')
-            downloaded_images = {}
-            if output_format == 'story':
-                 downloaded_images = await download_images(context, messages, chat_id)
-
-            # Генерируем результат
-            output_text, error_msg_friendly = await gc.safe_generate_output(
-                messages, downloaded_images, output_format, chat_genre, personality_key, chat_lang
-            )
-
-            # --- Обработка и отправка результата ---
-            if output_text:
-                try:
-                    # Определяем дату для заголовка
-                    try:
-                        chat_tz_str = settings.get('timezone', 'UTC')
-                        chat_tz = pytz.timezone(chat_tz_str)
-                        target_dt_local = target_dt_utc.astimezone(chat_tz)
-                        date_str = target_dt_local.strftime("%d %B %Y")
-                    except Exception:
-                         date_str = target_dt_utc.strftime("%d %B %Y") # Fallback to UTC date
-
-                    photo_note_str = get_text("photo_info_text", chat_lang, count=len(downloaded_images)) if downloaded_images else ""
-                    chat_title_str = str(chat_id)
-                    try:
-                        chat_info = await bot.get_chat(chat_id)
-                        chat_title_str = f"'{html.escape(chat_info.title)}'" if chat_info.title else str(chat_id)
-                    except Exception as e_chat:
-                        logger.warning(f"{current_chat_log_prefix} Could not get chat title: {e_chat}")
-
-                    header_loc_key = "daily_story_header"
-                    final_message_header = get_text(
-                        header_loc_key, chat_lang,
-                        output_format_name_capital=get_output_format_name(output_format, chat_lang, capital=True),
-                        date_str=date_str, chat_title=chat_title_str, photo_info=photo_note_str
-                    )
-                    await bot.send_message(chat_id=chat_id, text=final_message_header, parse_mode=ParseMode.HTML)
-                    await asyncio.sleep(0.2)
-
-                    # Отправка тела и кнопок
-                    sent_message = None
-                    keyboard = InlineKeyboardMarkup([[
-                        InlineKeyboardButton("👍", callback_data="feedback_good_placeholder"),
-                        InlineKeyboardButton("👎", callback_data="feedback_bad_placeholder")
-                    ]])
-                    MAX_MSG_LEN = 4096
-                    parts = [output_text[i:i+MAX_MSG_LEN] for i in range(0, len(output_text), MAX_MSG_LEN)]
-                    if len(parts) > 1:
-                         logger.warning(f"{current_chat_log_prefix} Output too long ({len(output_text)} chars), splitting into {len(parts)} parts.")
-
-                    for k, part in enumerate(parts):
-                        current_reply_markup = keyboard if k == len(parts) - 1 else None
-                        sent_message = await bot.send_message(chat_id=chat_id, text=part, reply_markup=current_reply_markup, parse_mode=ParseMode.MARKDOWN)
-                        if k < len(parts) - 1: await asyncio.sleep(0.5) # Небольшая пауза между частями
-
-                    if sent_message: # Обновляем ID в кнопках последней части
-                        kb_upd = InlineKeyboardMarkup([[
-                            InlineKeyboardButton("👍", callback_data=f"feedback_good_{sent_message.message_id}"),
-                            InlineKeyboardButton("👎", callback_data=f"feedback_bad_{sent_message.message_id}")
-                        ]])
-                        try:
-                            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=sent_message.message_id, reply_markup=kb_upd)
-                        except BadRequest: # Игнорируем ошибку, если сообщение не изменилось
-                            pass
-                        except TelegramError as e:
-                            logger.warning(f"Error updating feedback buttons: {e}")
-
-                    logger.info(f"{current_chat_log_prefix} {output_format_name.capitalize()} sent successfully for the last 24h.")
-                    output_sent = True
-
-                    # Отправляем примечание от прокси, если оно есть
-                    if error_msg_friendly:
-                        try:
-                            await bot.send_message(chat_id=chat_id, text=get_text("proxy_note", chat_lang, note=error_msg_friendly), parse_mode=ParseMode.HTML)
-                        except Exception as e:
-                            logger.warning(f"{current_chat_log_prefix} Failed send proxy note: {e}")
-
-                except TelegramError as e: # Ошибка отправки в Telegram
-                    logger.error(f"{current_chat_log_prefix} TG error sending output: {e}")
-                    error_for_owner = (f"TG Send Err ({e.__class__.__name__})", e)
-                    error_str = str(e).lower()
-                    is_fatal = any(sub in error_str for sub in ["blocked", "deactivated", "kicked", "forbidden", "not found"])
-                    if is_fatal:
-                        logger.warning(f"{current_chat_log_prefix} Disabling chat due to fatal TG error: {e}.")
-                        dm.update_chat_setting(chat_id, 'enabled', False)
-                        error_for_owner = (f"Disabled: Fatal TG Err ({e.__class__.__name__})", e)
-                except Exception as e:
-                    logger.exception(f"{current_chat_log_prefix} Unexpected error during sending output: {e}")
-                    error_for_owner = (f"Send Err ({e.__class__.__name__})", e)
-
-            else: # Ошибка генерации (output_text is None)
-                logger.warning(f"{current_chat_log_prefix} Failed generate {output_format} for the last 24h. Reason: {error_msg_friendly}")
-                error_for_owner = (f"Gen Err ({error_msg_friendly or 'Unknown'})", None)
-                # Отправляем уведомление пользователю в чат
-                error_text_chat = get_text("daily_job_failed_chat_user_friendly", chat_lang, output_format_name=output_format_name, reason=error_msg_friendly or 'неизвестной')
-                try:
-                    await bot.send_message(chat_id=chat_id, text=error_text_chat, parse_mode=ParseMode.HTML)
-                except TelegramError as e_err:
-                    logger.warning(f"{current_chat_log_prefix} Failed send failure notification to chat: {e_err}")
-                    error_for_owner = (f"Gen Err + Failed Notify ({e_err.__class__.__name__})", e_err) # Обновляем ошибку для владельца
-                    error_str = str(e_err).lower()
-                    is_fatal = any(sub in error_str for sub in ["blocked", "deactivated", "kicked", "forbidden", "not found"])
-                    if is_fatal:
-                        logger.warning(f"{current_chat_log_prefix} Disabling chat after fatal TG error on sending failure notification: {e_err}.")
-                        dm.update_chat_setting(chat_id, 'enabled', False)
-                        error_for_owner = (f"Disabled: Fatal TG Err ({e_err.__class__.__name__})", e_err)
-                except Exception as e_notify:
-                    logger.exception(f"{current_chat_log_prefix} Unexpected error sending failure notification: {e_notify}")
-                    error_for_owner = (f"Gen Err + Notify Err ({e_notify.__class__.__name__})", e_notify)
-
-        except Exception as e: # Глобальная ошибка обработки чата
-            logger.exception(f"{current_chat_log_prefix} CRITICAL error processing chat for the last 24h: {e}")
-            error_for_owner = (f"Critical Err ({e.__class__.__name__})", e)
-
-        # --- Запись результатов и ошибок ---
+    async def _run_chat(chat_id: int) -> Tuple[int, bool, Optional[Tuple[str, Optional[BaseException]]]]:
+        current_chat_log_prefix = f"[{bot_username}][Chat {chat_id}]"
+        async with semaphore:
+            logger.info(f"{current_chat_log_prefix} Processing scheduled generation...")
+            try:
+                output_sent, error_for_owner = await asyncio.wait_for(
+                    _process_scheduled_chat(context, bot, chat_id, scheduled_ts_by_chat[chat_id], current_chat_log_prefix),
+                    timeout=DAILY_JOB_CHAT_TIMEOUT_SEC
+                )
+            except asyncio.TimeoutError:
+                logger.error(f"{current_chat_log_prefix} Timed out after {DAILY_JOB_CHAT_TIMEOUT_SEC}s, cancelled.")
+                output_sent, error_for_owner = False, (f"Timeout ({DAILY_JOB_CHAT_TIMEOUT_SEC}s)", None)
+            except Exception as e: # Страховка: _process_scheduled_chat сам ловит ошибки
+                logger.exception(f"{current_chat_log_prefix} CRITICAL error processing chat for the last 24h: {e}")
+                output_sent, error_for_owner = False, (f"Critical Err ({e.__class__.__name__})", e)
+            return chat_id, output_sent, error_for_owner
+
+    results = await asyncio.gather(*(_run_chat(chat_id) for chat_id in chats_to_process))
+
+    # --- Запись результатов и ошибок ---
+    for chat_id, output_sent, error_for_owner in results:
+        current_chat_log_prefix = f"[{bot_username}][Chat {chat_id}]"
         if output_sent:
             processed_in_this_run += 1
         elif error_for_owner:
@@ -256,9 +283,7 @@ async def daily_story_job(context: ContextTypes.DEFAULT_TYPE) -> None:
         else:
             # Сюда попадаем, если не было сообщений за 24ч или генерация/отправка не удалась без записи явной ошибки
             logger.warning(f"{current_chat_log_prefix} Output not sent (check previous logs for reason - e.g., no messages or non-critical generation/send issue).")
-
-        await asyncio.sleep(1.5) # Небольшая пауза между обработкой чатов
-    # --- Конец цикла по чатам ---
+    # --- Конец обработки чатов ---
 
     job_end_time = datetime.datetime.now(pytz.utc)
     duration = job_end_time - job_start_time
@@ -282,7 +307,9 @@ async def daily_story_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 # НОВАЯ ЗАДАЧА ОЧИСТКИ СТАРЫХ СООБЩЕНИЙ
 # ============================
 async def purge_old_messages_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Периодически удаляет старые сообщения согласно настройкам чатов."""
+    """Удаляет старые сообщения согласно настройкам чатов.
+    Запускается часто (PURGE_CHECK_INTERVAL_MIN), но реально чистит не чаще PURGE_JOB_INTERVAL_HOURS
+    и предпочтительно в тихий час по профилю нагрузки (не дольше PURGE_MAX_DELAY_HOURS ожидания)."""
     application: Optional[Application] = context.application
     if not application:
         logger.critical("Application object not found in purge_job context! Aborting job.")
@@ -291,6 +318,13 @@ async def purge_old_messages_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Идентификаторы задачи для логов и bot_data
     job_name = context.job.name if context.job else "purge_job"
+    now_ts = time.time()
+    last_done_ts = application.bot_data.get(f'last_{job_name}_completed_ts')
+    due_since_ts = last_done_ts + PURGE_JOB_INTERVAL_HOURS * 3600 if last_done_ts else application.bot_data.get('bot_start_time', now_ts)
+    if now_ts < due_since_ts: return
+    if not activity_tracker.is_quiet_hour(now_ts) and now_ts - due_since_ts < PURGE_MAX_DELAY_HOURS * 3600:
+        logger.debug(f"{job_name}: очистка отложена до более тихого часа.")
+        return
     job_start_time = datetime.datetime.now(pytz.utc)
 
     # Записываем время старта и сбрасываем ошибку для ЭТОЙ задачи
@@ -308,33 +342,34 @@ async def purge_old_messages_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"[{bot_username}] Running {job_name}...")
     try:
         # Получаем список чатов с установленным сроком хранения
-        chats_to_purge = dm.get_chats_with_retention()
+        chats_to_purge = await adm.get_chats_with_retention()
         if not chats_to_purge:
             logger.info(f"[{bot_username}] No chats found with retention policy set for purging.")
+            # Фото могли осиротеть и без политики хранения (/purge_history all)
+            try: await image_cache.prune_orphans(await adm.get_referenced_photo_ids())
+            except Exception as e: logger.error(f"[{bot_username}] Image cache prune failed: {e}", exc_info=True)
+            await _archive_old_messages(bot_username)
+            await adm.purge_generated_outputs()
+            application.bot_data[f'last_{job_name}_completed_ts'] = now_ts
             return
 
         logger.info(f"[{bot_username}] Found {len(chats_to_purge)} chats to check for purging.")
-        for chat_id, days in chats_to_purge:
-            log_prefix = f"[{bot_username}][Chat {chat_id}]"
-            if days <= 0: # Пропускаем невалидные значения на всякий случай
-                logger.warning(f"{log_prefix} Invalid retention period ({days} days), skipping purge.")
-                continue
-
-            logger.info(f"{log_prefix} Purging messages older than {days} days...")
-            try:
-                # Вызываем функцию удаления из data_manager
-                deleted_count = dm.delete_messages_older_than(chat_id, days) # Предполагаем, что она возвращает кол-во
-                if deleted_count > 0:
-                    deleted_messages_total += deleted_count
-                processed_chats_count += 1
-            except Exception as e:
-                logger.error(f"{log_prefix} Error purging messages (>{days} days): {e}", exc_info=True)
-                errors_count += 1
-                # Сохраняем первую ошибку для отчета владельцу
-                if not application.bot_data.get(f'last_{job_name}_error'):
-                    application.bot_data[f'last_{job_name}_error'] = f"Chat {chat_id} (>{days}d): {e.__class__.__name__}"
-                # Продолжаем со следующим чатом
-            await asyncio.sleep(0.5) # Пауза между чатами для снижения нагрузки
+        # Один проход по всем чатам в потоке БД: пачки с паузами, event loop не блокируется
+        result = await adm.purge_expired_messages(chats_to_purge)
+        deleted_messages_total = result['rows']
+        processed_chats_count = result['chats'] - len(result['errors'])
+        errors_count = len(result['errors'])
+        if result['errors']:
+            chat_id, days, error_name = result['errors'][0] # Первую ошибку - в отчет владельцу
+            application.bot_data[f'last_{job_name}_error'] = f"Chat {chat_id} (>{days}d): {error_name}"
+
+        # Кэш изображений: удаляем фото, сообщения с которыми уже удалены политикой хранения
+        try: await image_cache.prune_orphans(await adm.get_referenced_photo_ids())
+        except Exception as e: logger.error(f"[{bot_username}] Image cache prune failed: {e}", exc_info=True)
+        # Архивация после очистки: сообщения с истекшим сроком не переносятся в архив
+        await _archive_old_messages(bot_username)
+        try: await adm.purge_generated_outputs()
+        except Exception as e: logger.error(f"[{bot_username}] Generated outputs purge failed: {e}", exc_info=True)
 
         # Логирование итогов
         job_end_time = datetime.datetime.now(pytz.utc)
@@ -342,8 +377,9 @@ async def purge_old_messages_job(context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info(
             f"[{bot_username}] {job_name} finished in {duration.total_seconds():.2f}s. "
             f"Checked: {len(chats_to_purge)}. Processed OK: {processed_chats_count}. "
-            f"Total deleted: {deleted_messages_total}. Errors: {errors_count}."
+            f"Total deleted: {deleted_messages_total} ({result['bytes_freed'] / 1048576:.1f} MB freed). Errors: {errors_count}."
         )
+        application.bot_data[f'last_{job_name}_completed_ts'] = now_ts
         # Уведомляем владельца, если были ошибки
         if errors_count > 0 and application.bot_data.get(f'last_{job_name}_error'):
              await notify_owner(bot=bot, message=f"Errors during {job_name}: {application.bot_data[f'last_{job_name}_error']} (see logs for details)", operation=job_name, important=True)
@@ -352,4 +388,57 @@ async def purge_old_messages_job(context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.exception(f"[{bot_username}] CRITICAL error in {job_name}: {e}")
         application.bot_data[f'last_{job_name}_error'] = f"Critical: {e.__class__.__name__}"
         # Уведомляем владельца
-        await notify_owner(bot=bot, message=f"Critical error in {job_name}", exception=e, important=True)
\ No newline at end of file
+        await notify_owner(bot=bot, message=f"Critical error in {job_name}", exception=e, important=True)
+
+async def _archive_old_messages(bot_username: str) -> None:
+    """Перенос старых сообщений в холодный архив (ARCHIVE_ENABLED) в том же тихом окне, что и очистка."""
+    if not ARCHIVE_ENABLED: return
+    try:
+        result = await adm.archive_old_messages()
+        if result['rows']: logger.info(f"[{bot_username}] Archived {result['rows']} messages from {result['chats']} chats in {result['duration_s']:.1f}s.")
+    except Exception as e: logger.error(f"[{bot_username}] Archive step failed: {e}", exc_info=True)
+
+# ==================================
+# ЗАДАЧА ПРОМЕЖУТОЧНЫХ КОНСПЕКТОВ ДНЯ
+# ==================================
+async def partial_digest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Каждые PARTIAL_DIGEST_INTERVAL_HOURS конспектирует новые сообщения включенных чатов в пределах
+    суток до их следующей сводки. Чаты обрабатываются по одному: нагрузка на прокси размазывается по дню,
+    а в слот сводки остается только финальный проход по конспектам и хвосту сообщений."""
+    if PARTIAL_DIGEST_INTERVAL_HOURS <= 0: return
+    job_name = context.job.name if context.job else "partial_digest_job"
+    started = time.perf_counter()
+    now_ms = round(time.time() * 1000); end_ms = now_ms - _PARTIAL_DIGEST_LAG_MS
+    await adm.purge_partial_digests(now_ms - 2 * _DAY_MS) # Сутки этих конспектов уже сведены
+    digested = 0
+    for chat_id, window_start_ms, resume_ms in await adm.get_partial_digest_candidates():
+        try:
+            messages = await adm.get_messages_for_chat_since(chat_id, resume_ms, end_ms)
+            if len(messages) < PARTIAL_DIGEST_MIN_MESSAGES: continue
+            settings = await adm.get_chat_settings(chat_id)
+            chat_lang = await get_chat_lang(chat_id)
+            image_offset = sum(p['image_count'] for p in await adm.get_partial_digests(chat_id, window_start_ms))
+            images = {}
+            if settings.get('output_format', DEFAULT_OUTPUT_FORMAT) == 'story':
+                images = await download_images(context, messages, chat_id, max(0, MAX_PHOTOS_TO_ANALYZE - image_offset))
+            notes, error, last_image = await gc.safe_generate_partial_notes(messages, images, chat_lang, image_offset)
+            if not notes: logger.warning(f"{job_name}: конспект чата {chat_id} не получен ({error}), сообщения уйдут в хвост сводки."); continue
+            await adm.save_partial_digest(chat_id, resume_ms, end_ms, notes, len(messages), last_image - image_offset)
+            digested += 1
+            logger.info(f"{job_name}: чат {chat_id} - конспект {len(messages)} сообщений.")
+        except Exception as e: logger.error(f"{job_name}: ошибка конспекта чата {chat_id}: {e}", exc_info=True)
+    if digested: logger.info(f"{job_name}: {digested} конспектов за {time.perf_counter() - started:.1f}s.")
+
+# ==================================
+# ЗАДАЧА ОБСЛУЖИВАНИЯ ПОИСКОВОГО ИНДЕКСА
+# ==================================
+async def fts_maintenance_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сливает сегменты FTS5-индекса, чтобы он не разрастался от постоянных вставок и удалений.
+    Обычно - только переполненные уровни; в тихий час - постепенное полное слияние (аналог 'optimize').
+    Каждый шаг - короткая транзакция, запуск ограничен FTS_MERGE_BUDGET_SEC."""
+    job_name = context.job.name if context.job else "fts_maintenance_job"
+    full = activity_tracker.is_quiet_hour(time.time())
+    try:
+        result = await adm.fts_maintenance(FTS_MERGE_BUDGET_SEC, full=full)
+        if context.application: context.application.bot_data[f'last_{job_name}_result'] = result
+    except Exception as e: logger.error(f"{job_name}: ошибка слияния индекса: {e}", exc_info=True)
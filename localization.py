@@ -21,7 +21,6 @@ from config import (
 )
 
 logger = logging.getLogger(__name__)
-chat_language_cache: Dict[int, str] = {}
 
 # Словарь текстов
 LOCALIZED_TEXTS: Dict[str, Dict[str, str]] = {
@@ -63,6 +62,7 @@ LOCALIZED_TEXTS: Dict[str, Dict[str, str]] = {
 
 <b>📊 Аналитика:</b>
 <code>/chat_stats</code> - 📈 Статистика активности чата
+<code>/search</code> - 🔎 Поиск по истории чата
 
 <b>🛠️ Администрирование:</b>
 <code>/purge_history</code> - 🗑️ Очистить историю сообщений (Админ)
@@ -218,7 +218,7 @@ LOCALIZED_TEXTS: Dict[str, Dict[str, str]] = {
         "output_format_name_story": "История", "output_format_name_digest": "Дайджест", # Именительный падеж
 
         # Статус
-        "status_command_reply": "<b>📊 Статус Бота</b>\nUptime: {uptime}\nАктивных чатов: {active_chats}\nПосл. запуск сводок: {last_job_run}\nПосл. ошибка сводок: <i>{last_job_error}</i>\nПосл. запуск очистки: {last_purge_run}\nПосл. ошибка очистки: <i>{last_purge_error}</i>\nВерсия PTB: {ptb_version}",
+        "status_command_reply": "<b>📊 Статус Бота</b>\nUptime: {uptime}\nАктивных чатов: {active_chats}\nПосл. запуск сводок: {last_job_run}\nПосл. ошибка сводок: <i>{last_job_error}</i>\nПосл. запуск очистки: {last_purge_run}\nПосл. ошибка очистки: <i>{last_purge_error}</i>\nБуфер записи: {ingest_queue} в очереди, flush {ingest_last_ms} мс (сред. {ingest_avg_ms}, макс. {ingest_max_ms})\nПрокси Gemini: {proxy_requests} запросов, посл. {proxy_last_ms} мс (сред. {proxy_avg_ms}), старт {proxy_startup_ms} мс, {proxy_http_version}\nСтриминг: TTFT сред. {proxy_ttft_ms} мс, откатов {proxy_stream_fallbacks}\nОчистка: посл. {purge_rows} строк, освобождено {purge_freed_mb} МБ за {purge_duration_s} с; свободно в БД {db_free_mb} МБ\nВерсия PTB: {ptb_version}",
 
         # Очистка Истории
         "purge_prompt": "🗑️ Вы уверены, что хотите удалить сообщения?\nПериод: <b>{period_text}</b>\n\n<b>Это действие необратимо!</b>",
@@ -248,6 +248,14 @@ LOCALIZED_TEXTS: Dict[str, Dict[str, str]] = {
         "stats_error": "😔 Не удалось собрать статистику.",
         "stats_period_name_today": "Сегодня", "stats_period_name_week": "Неделя", "stats_period_name_month": "Месяц",
 
+        # Поиск
+        "search_usage": "🔎 Укажите, что искать: <code>/search кошка</code>\nМожно ограничить период: <code>/search 7d кошка</code> (дни), <code>/search 12h кошка</code> (часы) или <code>/search 2024-05-01 кошка</code>. Фразу берите в кавычки.",
+        "search_title": "🔎 <b>Найдено по запросу «{query}»:</b>",
+        "search_title_since": "🔎 <b>Найдено по запросу «{query}»</b> (с {since}):",
+        "search_entry": "{index}. {when} <b>{username}</b>: {snippet}",
+        "search_no_results": "🤷‍♀️ По запросу «{query}» ничего не найдено.",
+        "search_error": "😔 Не удалось выполнить поиск.",
+
         # Команды
         "cmd_start_desc": "👋 Статус и приветствие",
         "cmd_help_desc": "❓ Помощь по командам",
@@ -256,6 +264,7 @@ LOCALIZED_TEXTS: Dict[str, Dict[str, str]] = {
         "cmd_summarize_desc": "📝 Краткая выжимка чата",
         "cmd_story_settings_desc": "⚙️ Настройки Летописца (Админ)",
         "cmd_chat_stats_desc": "📈 Статистика активности чата",
+        "cmd_search_desc": "🔎 Поиск по истории чата",
         "cmd_purge_history_desc": "🗑️ Очистить историю сообщений (Админ)",
         "cmd_status_desc": "📊 Статус бота (Владелец)",
     },
@@ -286,6 +295,7 @@ Analyzing chat, creating unique summaries.
 
 <b>📊 Analytics:</b>
 <code>/chat_stats</code> - 📈 Chat activity statistics
+<code>/search</code> - 🔎 Search chat history
 
 <b>🛠️ Administration:</b>
 <code>/purge_history</code> - 🗑️ Purge message history (Admin)
@@ -397,7 +407,7 @@ Analyzing chat, creating unique summaries.
         "output_format_name_story": "Story", "output_format_name_digest": "Digest",
 
         # Status
-        "status_command_reply": "<b>📊 Bot Status</b>\nUptime: {uptime}\nActive Chats: {active_chats}\nLast Summary Run: {last_job_run}\nLast Summary Error: <i>{last_job_error}</i>\nLast Purge Run: {last_purge_run}\nLast Purge Error: <i>{last_purge_error}</i>\nPTB Version: {ptb_version}",
+        "status_command_reply": "<b>📊 Bot Status</b>\nUptime: {uptime}\nActive Chats: {active_chats}\nLast Summary Run: {last_job_run}\nLast Summary Error: <i>{last_job_error}</i>\nLast Purge Run: {last_purge_run}\nLast Purge Error: <i>{last_purge_error}</i>\nWrite Buffer: {ingest_queue} queued, flush {ingest_last_ms} ms (avg {ingest_avg_ms}, max {ingest_max_ms})\nGemini Proxy: {proxy_requests} requests, last {proxy_last_ms} ms (avg {proxy_avg_ms}), startup {proxy_startup_ms} ms, {proxy_http_version}\nStreaming: avg TTFT {proxy_ttft_ms} ms, fallbacks {proxy_stream_fallbacks}\nPurge: last {purge_rows} rows, freed {purge_freed_mb} MB in {purge_duration_s} s; free in DB {db_free_mb} MB\nPTB Version: {ptb_version}",
 
         # Purge History
         "purge_prompt": "🗑️ Are you sure you want to purge messages?\nPeriod: <b>{period_text}</b>\n\n<b>This action is irreversible!</b>",
@@ -427,6 +437,14 @@ Analyzing chat, creating unique summaries.
         "stats_error": "😔 Could not retrieve statistics.",
         "stats_period_name_today": "Today", "stats_period_name_week": "This Week", "stats_period_name_month": "This Month",
 
+        # Search
+        "search_usage": "🔎 Tell me what to look for: <code>/search cat</code>\nYou can limit the period: <code>/search 7d cat</code> (days), <code>/search 12h cat</code> (hours) or <code>/search 2024-05-01 cat</code>. Put phrases in quotes.",
+        "search_title": "🔎 <b>Results for «{query}»:</b>",
+        "search_title_since": "🔎 <b>Results for «{query}»</b> (since {since}):",
+        "search_entry": "{index}. {when} <b>{username}</b>: {snippet}",
+        "search_no_results": "🤷‍♀️ Nothing found for «{query}».",
+        "search_error": "😔 Search failed.",
+
         # Commands
         "cmd_start_desc": "👋 Status & greeting",
         "cmd_help_desc": "❓ Help",
@@ -435,6 +453,7 @@ Analyzing chat, creating unique summaries.
         "cmd_summarize_desc": "📝 Brief chat summary",
         "cmd_story_settings_desc": "⚙️ Chronicler Settings (Admin)",
         "cmd_chat_stats_desc": "📈 Chat activity statistics",
+        "cmd_search_desc": "🔎 Search chat history",
         "cmd_purge_history_desc": "🗑️ Purge message history (Admin)",
         "cmd_status_desc": "📊 Bot status (Owner)",
     }
@@ -444,20 +463,13 @@ Analyzing chat, creating unique summaries.
 # Функции работы с локализацией
 # =======================================
 async def get_chat_lang(chat_id: int) -> str:
-    """Получает язык чата из кэша или БД (асинхронно)."""
-    if chat_id in chat_language_cache:
-        return chat_language_cache[chat_id]
+    """Получает язык чата из кэша настроек data_manager (при промахе - из БД, асинхронно)."""
     lang = DEFAULT_LANGUAGE # Значение по умолчанию
     try: 
-        import data_manager as dm; settings = dm.get_chat_settings(chat_id); lang_from_db = settings.get('lang')
+        import async_data_manager as adm; settings = await adm.get_chat_settings(chat_id); lang_from_db = settings.get('lang')
         if lang_from_db and lang_from_db in SUPPORTED_LANGUAGES: lang = lang_from_db
     except Exception as e: logger.error(f"Error get lang chat={chat_id}: {e}")
-    chat_language_cache[chat_id] = lang; return lang
-
-def update_chat_lang_cache(chat_id: int, lang: str):
-    """Обновляет кэш языка чата."""
-    if lang in SUPPORTED_LANGUAGES: chat_language_cache[chat_id] = lang
-    else: logger.warning(f"Attempted cache unsupported lang '{lang}' chat={chat_id}")
+    return lang
 
 def get_text(key: str, lang: Optional[str] = None, **kwargs) -> str:
     """Возвращает локализованный текст по ключу с форматированием."""
@@ -15,9 +15,15 @@ from typing import Optional
 from config import (
     TELEGRAM_BOT_TOKEN, # Убрал MESSAGE_FILTERS т.к. он используется только в bot_handlers
     validate_config, setup_logging, JOB_CHECK_INTERVAL_MINUTES, BOT_OWNER_ID,
-    PURGE_JOB_INTERVAL_HOURS # Интервал для задачи очистки
+    PURGE_CHECK_INTERVAL_MIN, # Интервал проверки окна задачи очистки
+    FTS_MERGE_INTERVAL_MIN, STORAGE_BACKEND, PARTIAL_DIGEST_INTERVAL_HOURS
 )
 import data_manager as dm
+import async_data_manager as adm
+import activity_tracker
+import gemini_client as gc
+import image_processing
+import prompt_builder as pb
 import bot_handlers # Основной модуль с логикой команд и колбэков
 import jobs # Модуль с фоновыми задачами
 from localization import get_text, DEFAULT_LANGUAGE # Для установки команд
@@ -54,6 +60,20 @@ async def post_init(app: Application):
     app.bot_data['last_purge_job_error'] = None
 
     logger = logging.getLogger(__name__)
+    if STORAGE_BACKEND == "postgres": # Пул нужен до первых запросов; очередь сообщений пишет в PostgreSQL через event loop
+        import postgres_storage
+        await postgres_storage.init_pool()
+        loop = asyncio.get_running_loop()
+        dm.set_message_batch_sink(postgres_storage.make_batch_sink(loop), overflow=postgres_storage.make_overflow_writer(loop))
+    # Счетчики активности для вмешательств: заполняем из БД, дальше ведутся в памяти
+    try:
+        since_dt = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=activity_tracker.WINDOW_MINUTES)
+        activity_tracker.seed(await adm.get_recent_activity_buckets(since_dt))
+    except Exception as e:
+        logger.error(f"Не удалось заполнить счетчики активности из БД: {e}", exc_info=True)
+    # Общий HTTP-клиент к прокси Gemini (пул keep-alive соединений)
+    await gc.init_http_client()
+
     try:
         bot_info = await app.bot.get_me()
         logger.info(f"Бот {bot_info.username} (ID: {bot_info.id}) успешно запущен.")
@@ -67,6 +87,7 @@ async def post_init(app: Application):
             BotCommand("summarize", get_text("cmd_summarize_desc", DEFAULT_LANGUAGE)),
             BotCommand("story_settings", get_text("cmd_story_settings_desc", DEFAULT_LANGUAGE)),
             BotCommand("chat_stats", get_text("cmd_chat_stats_desc", DEFAULT_LANGUAGE)),
+            BotCommand("search", get_text("cmd_search_desc", DEFAULT_LANGUAGE)),
             # BotCommand("onthisday", ...), # <-- УДАЛЕНО
             BotCommand("purge_history", get_text("cmd_purge_history_desc", DEFAULT_LANGUAGE)),
         ]
@@ -103,6 +124,7 @@ def configure_handlers(app: Application):
     app.add_handler(CommandHandler("summarize", bot_handlers.summarize_command))
     app.add_handler(CommandHandler("story_settings", bot_handlers.story_settings_command))
     app.add_handler(CommandHandler("chat_stats", bot_handlers.chat_stats_command)) # Статистика
+    app.add_handler(CommandHandler("search", bot_handlers.search_command)) # Полнотекстовый поиск
     app.add_handler(CommandHandler("purge_history", bot_handlers.purge_history_command)) # Очистка
     # app.add_handler(CommandHandler("onthisday", ...)) # <-- УДАЛЕНО
 
@@ -154,7 +176,8 @@ def configure_scheduler(app: Application):
         logger.error("Не удалось запланировать задачу 'daily_story_job'.")
 
     # 2. Задача очистки старых сообщений
-    interval_purge = max(datetime.timedelta(hours=PURGE_JOB_INTERVAL_HOURS).total_seconds(), 3600) # Не чаще раза в час
+    # Задача проверяет окно часто, а чистит раз в PURGE_JOB_INTERVAL_HOURS в тихий час (см. jobs.purge_old_messages_job)
+    interval_purge = max(datetime.timedelta(minutes=PURGE_CHECK_INTERVAL_MIN).total_seconds(), 300)
     job_purge = job_queue.run_repeating(
         jobs.purge_old_messages_job, # Функция задачи из jobs.py
         interval=interval_purge,     # Интервал в секундах
@@ -167,6 +190,29 @@ def configure_scheduler(app: Application):
     else:
         logger.error("Не удалось запланировать задачу 'purge_job'.")
 
+    # 3. Обслуживание поискового индекса: слияние сегментов FTS5 небольшими шагами (в PostgreSQL это делает autovacuum)
+    if STORAGE_BACKEND == "sqlite":
+        interval_fts = max(datetime.timedelta(minutes=FTS_MERGE_INTERVAL_MIN).total_seconds(), 60)
+        job_fts = job_queue.run_repeating(jobs.fts_maintenance_job, interval=interval_fts, first=600, name="fts_maintenance_job", data={'application': app})
+        if job_fts: logger.info(f"Задача 'fts_maintenance_job' запланирована (интервал {interval_fts:.0f} секунд).")
+        else: logger.error("Не удалось запланировать задачу 'fts_maintenance_job'.")
+
+    # 4. Промежуточные конспекты дня: сглаживают пик нагрузки на прокси в момент ежедневной сводки
+    if PARTIAL_DIGEST_INTERVAL_HOURS > 0:
+        interval_partial = max(PARTIAL_DIGEST_INTERVAL_HOURS * 3600, 600)
+        job_partial = job_queue.run_repeating(jobs.partial_digest_job, interval=interval_partial, first=900, name="partial_digest_job", data={'application': app})
+        if job_partial: logger.info(f"Задача 'partial_digest_job' запланирована (интервал {interval_partial:.0f} секунд).")
+        else: logger.error("Не удалось запланировать задачу 'partial_digest_job'.")
+
+
+async def post_shutdown(app: Application):
+    """Выполняется после штатной остановки Application: освобождает сетевые ресурсы."""
+    await gc.close_http_client()
+    if STORAGE_BACKEND == "postgres": # Дописываем очередь, пока event loop и пул еще работают
+        import postgres_storage
+        await asyncio.to_thread(dm.stop_ingest_writer)
+        await postgres_storage.close_pool()
+
 
 async def shutdown_signal_handler(signal_num):
     """Обрабатывает сигналы SIGINT и SIGTERM для корректного завершения."""
@@ -200,8 +246,17 @@ async def shutdown_signal_handler(signal_num):
     else:
         logging.warning("Объект Application не найден при попытке остановки.")
 
-    # Закрываем соединения с базой данных
-    logging.info("Закрытие соединений с базой данных...")
+    await gc.close_http_client()
+    image_processing.shutdown()
+
+    # Дописываем буфер сообщений и закрываем соединения с базой данных
+    logging.info("Остановка ingest writer и закрытие соединений с базой данных...")
+    # Писатель в режиме postgres отдает пачки в этот event loop: останавливаем его из потока, пока loop работает
+    await asyncio.to_thread(dm.stop_ingest_writer)
+    if STORAGE_BACKEND == "postgres":
+        import postgres_storage
+        await postgres_storage.close_pool()
+    adm.shutdown_db_executor()
     dm.close_all_connections() # Используем функцию из data_manager
     logging.info("Соединения с базой данных закрыты.")
     logging.info(f"Бот остановлен после сигнала {sig.name}.")
@@ -226,8 +281,16 @@ def main() -> None:
     try:
         validate_config() # Проверяем наличие токенов и т.д.
         logger.info("Конфигурация успешно проверена.")
-        dm.load_data() # Создаем/проверяем таблицы БД
-        logger.info("База данных успешно инициализирована.")
+        dm.set_log_line_renderer(pb.format_log_entry, pb.LOG_LINE_VERSION) # До запуска писателя: строки лога пишутся вместе с сообщениями
+        if STORAGE_BACKEND == "sqlite": # PostgreSQL инициализируется в post_init (нужен event loop)
+            dm.load_data() # Создаем/проверяем таблицы БД
+            logger.info("База данных успешно инициализирована.")
+            dm.start_timestamp_ms_backfill() # Для старых БД: перевод времени сообщений в timestamp_ms (до него чтения разбирают TEXT)
+            dm.start_rollup_backfill() # Для старых БД: однократное заполнение сводок активности
+            dm.start_fts_backfill() # Для старых БД: однократная индексация истории для /search
+            dm.start_content_compression() # CONTENT_COMPRESSION=zstd: словарь и сжатие уже сохраненных сообщений
+            dm.start_log_line_backfill() # Строки лога промпта для сообщений, записанных до log_line или в старом формате
+        dm.start_ingest_writer() # Фоновая пакетная запись входящих сообщений
     except ValueError as e:
         logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА КОНФИГУРАЦИИ: {e}")
         return # Выход, если нет конфигурации
@@ -245,6 +308,7 @@ def main() -> None:
             .token(TELEGRAM_BOT_TOKEN)
             .defaults(defaults)
             .post_init(post_init) # Функция, выполняемая после инициализации (установка команд)
+            .post_shutdown(post_shutdown) # Закрытие общего HTTP-клиента
             # Настройки производительности и таймаутов
             .concurrent_updates(True) # Параллельная обработка входящих обновлений
             .pool_timeout(30) # Таймаут для long polling
@@ -308,6 +372,8 @@ def main() -> None:
         logger.warning("Polling завершен или был остановлен.")
         # Дополнительное закрытие соединений на случай, если shutdown_signal_handler не сработал
         logger.info("Финальное закрытие соединений с БД (на всякий случай)...")
+        adm.shutdown_db_executor()
+        dm.stop_ingest_writer() # Идемпотентно: повторный вызов просто дописывает остаток очереди
         dm.close_all_connections()
         logger.info("="*30 + " БОТ ОСТАНОВЛЕН " + "="*30)
 
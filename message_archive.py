@@ -0,0 +1,105 @@
+# message_archive.py
+# Холодный архив сообщений: сегмент на чат и месяц UTC - ARCHIVE_DIR/<chat_id>/<YYYY-MM>.ndjson.gz.
+# Сегмент - последовательность gzip-членов (каждый запуск архивации дописывает свой член),
+# внутри - NDJSON, по сообщению на строку, 'timestamp' (epoch ms) всегда первым полем.
+# Файлы читаются через mmap: распаковка идет прямо из страниц ОС без копирования файла в память процесса.
+# Сводный учет сегментов (строки, min/max время) хранит data_manager в таблице archive_segments;
+# этот модуль работает только с файлами.
+import datetime
+import json
+import logging
+import mmap
+import os
+import shutil
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from config import ARCHIVE_DIR
+
+logger = logging.getLogger(__name__)
+
+_TS_PREFIX = b'{"timestamp":'
+_READ_CHUNK = 1048576 # Распаковка кусками: в памяти не больше куска и его распакованного текста
+_FIELDS = ('message_id', 'user_id', 'username', 'type', 'content', 'file_id', 'file_unique_id', 'file_name')
+
+def month_of(ts_ms: int) -> str:
+    """epoch ms -> 'YYYY-MM' (UTC) - ключ сегмента."""
+    return datetime.datetime.fromtimestamp(ts_ms / 1000, tz=datetime.timezone.utc).strftime("%Y-%m")
+
+def segment_path(chat_id: int, month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, str(chat_id), f"{month}.ndjson.gz")
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    record = {'timestamp': message['timestamp']}
+    record.update((f, message.get(f)) for f in _FIELDS)
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _compress_member(messages: List[Dict[str, Any]]) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 - формат gzip
+    return compressor.compress(b"\n".join(_encode(m) for m in messages) + b"\n") + compressor.flush()
+
+def append_segment(chat_id: int, month: str, messages: List[Dict[str, Any]]) -> int:
+    """Дописывает сообщения в сегмент отдельным gzip-членом и сбрасывает на диск. Возвращает размер файла."""
+    path = segment_path(chat_id, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(_compress_member(messages)); f.flush(); os.fsync(f.fileno()) # Строки удаляются из БД только после fsync
+        return f.tell()
+
+def _iter_lines(path: str) -> Iterator[bytes]:
+    try: f = open(path, "rb")
+    except FileNotFoundError: return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0: return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm); pos = 0
+            try:
+                while pos < size: # Очередной gzip-член
+                    decompressor = zlib.decompressobj(31); pending = b""
+                    while not decompressor.eof and pos < size:
+                        end = min(pos + _READ_CHUNK, size)
+                        text = pending + decompressor.decompress(view[pos:end])
+                        pos = end - len(decompressor.unused_data) # После конца члена unused_data - начало следующего
+                        *lines, pending = text.split(b"\n")
+                        yield from lines
+                    if not decompressor.eof: logger.warning(f"Archive: сегмент {path} обрезан, прочитана только целая часть."); break # Обрывок строки отбрасывается
+                    if pending: yield pending # Член без завершающего перевода строки
+            finally: view.release()
+
+def _line_ts(line: bytes) -> int:
+    """Время из начала строки без разбора JSON (для фильтра по диапазону)."""
+    return int(line[len(_TS_PREFIX):line.index(b",", len(_TS_PREFIX))])
+
+def read_segment(path: str, since_ms: Optional[int] = None, until_ms: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Сообщения сегмента в диапазоне [since_ms, until_ms). Дубликаты (повтор после сбоя) не удаляются."""
+    for line in _iter_lines(path):
+        if not line: continue
+        if since_ms is not None or until_ms is not None:
+            ts = _line_ts(line)
+            if (since_ms is not None and ts < since_ms) or (until_ms is not None and ts >= until_ms): continue
+        yield json.loads(line)
+
+def rewrite_segment(path: str, keep_since_ms: int) -> Tuple[int, Optional[int], int]:
+    """Оставляет в сегменте только сообщения новее keep_since_ms (атомарная замена файла).
+    Возвращает (строк осталось, min timestamp, размер файла)."""
+    kept = {m['message_id']: m for m in read_segment(path, since_ms=keep_since_ms)} # Заодно убираем дубликаты
+    if not kept: delete_segment(path); return 0, None, 0
+    messages = sorted(kept.values(), key=lambda m: m['timestamp'])
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f: f.write(_compress_member(messages)); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(messages), messages[0]['timestamp'], os.path.getsize(path)
+
+def delete_segment(path: str) -> int:
+    """Удаляет файл сегмента. Возвращает освобожденные байты."""
+    try: size = os.path.getsize(path); os.remove(path); return size
+    except FileNotFoundError: return 0
+
+def delete_chat(chat_id: int) -> int:
+    """Удаляет весь архив чата. Возвращает освобожденные байты."""
+    chat_dir = os.path.join(ARCHIVE_DIR, str(chat_id))
+    if not os.path.isdir(chat_dir): return 0
+    freed = sum(e.stat().st_size for e in os.scandir(chat_dir) if e.is_file())
+    shutil.rmtree(chat_dir, ignore_errors=True)
+    return freed
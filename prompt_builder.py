@@ -4,15 +4,19 @@
 # =============================================================================
 import logging
 import datetime
-from typing import List, Dict, Union, Optional, Any
+import functools
+import math
+import re
+from typing import List, Dict, Union, Optional, Any, Tuple, Iterable
 
 import pytz
 
 # Импортируем необходимые константы и словари из конфига
 from config import (
     INTERVENTION_PROMPT_MESSAGE_COUNT, SUPPORTED_GENRES, SUPPORTED_PERSONALITIES, DEFAULT_PERSONALITY,
-    DEFAULT_OUTPUT_FORMAT, INTERVENTION_CONTEXT_HOURS
+    DEFAULT_OUTPUT_FORMAT, INTERVENTION_CONTEXT_HOURS, PROMPT_COMPACTION_ENABLED, PROMPT_TOKEN_BUDGET
 )
+from image_processing import detect_mime
 
 logger = logging.getLogger(__name__)
 
@@ -120,72 +124,228 @@ def get_output_initial_prompt(
 # ===========================================
 # Форматирование Записи Лога
 # ===========================================
-def format_log_entry(msg: Dict[str, Any], image_counter: Optional[int] = None, image_placeholder: str = "[IMAGE {count}]") -> str:
-    """Форматирует одну запись лога для включения в промпт."""
-    try:
-        dt_utc = datetime.datetime.fromisoformat(msg.get('timestamp','').replace('Z', '+00:00'))
-        # Конвертация в Московское время для наглядности в логе для ИИ (можно убрать или сделать опцией)
-        try:
-            ts_str = dt_utc.astimezone(pytz.timezone('Europe/Moscow')).strftime('%H:%M MSK')
-        except Exception:
-             ts_str = dt_utc.strftime('%H:%M UTC')
-    except Exception:
-        ts_str = "??:??"
-
-    user = msg.get('username', 'Неизвестный')
+# Версия формата строки лога без изображения: data_manager хранит отрисованную строку рядом с сообщением
+# (log_line/log_line_v). Любое изменение _entry_header/_describe_message - увеличить, старые строки перерисуются.
+LOG_LINE_VERSION = 1
+_LOG_TZ = pytz.timezone('Europe/Moscow') # Московское время для наглядности в логе для ИИ
+
+@functools.lru_cache(maxsize=4096)
+def _minute_label(epoch_minute: int) -> str:
+    """'ЧЧ:ММ MSK' для минуты от эпохи: за день в логе не больше 1440 разных меток."""
+    return datetime.datetime.fromtimestamp(epoch_minute * 60, tz=pytz.utc).astimezone(_LOG_TZ).strftime('%H:%M MSK')
+
+def _entry_header(msg: Dict[str, Any]) -> str:
+    """Префикс записи лога: время и автор."""
+    try: ts_str = _minute_label(int(msg['timestamp']) // 60000) # epoch ms из data_manager
+    except Exception: ts_str = "??:??"
+    return f"[{ts_str}] *{msg.get('username', 'Неизвестный')}*: "
+
+def _describe_message(msg: Dict[str, Any], image_counter: Optional[int] = None, image_placeholder: str = "[IMAGE {count}]") -> str:
+    """Что сделал автор (без префикса и перевода строки)."""
     content = msg.get('content', '')
     msg_type = msg.get('type')
     file_name = msg.get('file_name')
 
-    log_entry = f"[{ts_str}] *{user}*: "
-
     if msg_type == 'photo' and image_counter is not None:
-        log_entry += f"отправил(а) изображение {image_placeholder.format(count=image_counter)}{f' с подписью: «{content}»' if content else ''}\n"
+        return f"отправил(а) изображение {image_placeholder.format(count=image_counter)}{f' с подписью: «{content}»' if content else ''}"
     elif msg_type == 'text' and content:
-        log_entry += f"написал(а): \"{content[:150]}{'...' if len(content)>150 else ''}\"\n"
+        return f"написал(а): \"{content[:150]}{'...' if len(content)>150 else ''}\""
     elif msg_type == 'video':
-        log_entry += f"отправил(а) видео{f' «{content}»' if content else ''} (содержание не анализируется)\n"
+        return f"отправил(а) видео{f' «{content}»' if content else ''} (содержание не анализируется)"
     elif msg_type == 'sticker':
-        log_entry += f"отправил(а) стикер{f' ({content})' if content else ''}\n"
+        return f"отправил(а) стикер{f' ({content})' if content else ''}"
     elif msg_type == 'voice':
-        log_entry += f"записал(а) голосовое сообщение\n"
+        return f"записал(а) голосовое сообщение"
     elif msg_type == 'video_note':
-        log_entry += f"записал(а) видео-сообщение (кружок)\n"
+        return f"записал(а) видео-сообщение (кружок)"
     elif msg_type == 'document':
-        log_entry += f"отправил(а) документ '{file_name or 'без имени'}'{f' «{content}»' if content else ''}\n"
+        return f"отправил(а) документ '{file_name or 'без имени'}'{f' «{content}»' if content else ''}"
     elif msg_type == 'audio':
-        log_entry += f"отправил(а) аудио '{file_name or 'без имени'}'{f' «{content}»' if content else ''}\n"
+        return f"отправил(а) аудио '{file_name or 'без имени'}'{f' «{content}»' if content else ''}"
     elif msg_type == 'photo': # Фото без данных (например, превышен лимит анализа)
-        log_entry += f"отправил(а) фото (не анализируется){f' «{content}»' if content else ''}\n"
+        return f"отправил(а) фото (не анализируется){f' «{content}»' if content else ''}"
     elif content: # Другие типы с подписью
-        log_entry += f"отправил(а) медиа с подписью: «{content}» (тип: {msg_type})\n"
+        return f"отправил(а) медиа с подписью: «{content}» (тип: {msg_type})"
     else: # Другие типы без подписи/содержания
-        log_entry += f"отправил(а) медиа/сообщение (тип: {msg_type})\n"
+        return f"отправил(а) медиа/сообщение (тип: {msg_type})"
+
+def format_log_entry(msg: Dict[str, Any], image_counter: Optional[int] = None, image_placeholder: str = "[IMAGE {count}]") -> str:
+    """Форматирует одну запись лога для включения в промпт (сохраненная строка из БД, если ее версия актуальна)."""
+    if image_counter is None and msg.get('log_line_v') == LOG_LINE_VERSION and msg.get('log_line'): return msg['log_line']
+    return f"{_entry_header(msg)}{_describe_message(msg, image_counter, image_placeholder)}\n"
+
+def in_time_order(messages: Iterable[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+    """Сообщения с timestamp по времени. Список сортируется, только если порядок нарушен; итератор
+    (потоковые геттеры data_manager, уже по времени) проходится лениво, без материализации."""
+    if not isinstance(messages, list): return (m for m in messages if isinstance(m, dict) and 'timestamp' in m)
+    valid = [m for m in messages if isinstance(m, dict) and 'timestamp' in m]
+    if any(a['timestamp'] > b['timestamp'] for a, b in zip(valid, valid[1:])): valid.sort(key=lambda x: x['timestamp'])
+    return valid
 
-    return log_entry
+# ===========================================
+# Компактизация лога: серии автора, счетчики медиа, бюджет токенов
+# ===========================================
+LogEntry = Union[str, Dict[str, Any]] # Готовая строка лога или сообщение-фото с данными (строка с [IMAGE N] - при сборке)
+_RUN_GAP_MS = 10 * 60 * 1000 # Сообщения автора с паузой больше - уже отдельная реплика
+# Медиа без подписи сворачиваются в счетчик серии: тип -> подпись счетчика
+_COUNTED_MEDIA = {'sticker': 'стикеры', 'voice': 'голосовые', 'video_note': 'кружки', 'photo': 'фото (не анализируются)', 'video': 'видео'}
+# Реплики без содержания: подтверждения, смех, одни смайлы/знаки
+_LOW_INFO_RE = re.compile(r"^(?:ок(?:ей)?|ok(?:ay)?|ага|угу|лол|lol|кек|пон|спс|\++|[ах]*х[ах]*|(?:ha|ah)+)$", re.IGNORECASE)
+
+def _is_low_info(msg: Dict[str, Any]) -> bool:
+    text = (msg.get('content') or '').strip()
+    if not text: return True
+    if len(text) > 24: return False # Длинные реплики не проверяем: пустые реплики короткие
+    if not any(ch.isalnum() for ch in text): return True # Смайлы, ")))", "!!!"
+    return bool(_LOW_INFO_RE.match(re.sub(r"[\s!?.,)(]+", "", text)))
+
+def _run_line(run: List[Dict[str, Any]]) -> Tuple[Optional[str], int]:
+    """Одна строка лога на серию сообщений автора. Возвращает (строка | None, отброшено пустых реплик)."""
+    if len(run) == 1 and not (run[0].get('type') == 'text' and _is_low_info(run[0])): return format_log_entry(run[0]), 0
+    texts: List[str] = []; details: List[str] = []; counts: Dict[str, int] = {}; sticker_emoji: List[str] = []; dropped = 0
+    for msg in run:
+        msg_type, content = msg.get('type'), msg.get('content') or ''
+        if msg_type == 'text':
+            if _is_low_info(msg): dropped += 1
+            else: texts.append(f"{content[:150]}{'...' if len(content) > 150 else ''}")
+        elif msg_type in _COUNTED_MEDIA and not (content and msg_type != 'sticker'):
+            counts[msg_type] = counts.get(msg_type, 0) + 1
+            if msg_type == 'sticker' and content and content not in sticker_emoji: sticker_emoji.append(content)
+        else: details.append(_describe_message(msg))
+    pieces = [f"написал(а): \"{' / '.join(texts)}\""] if texts else []
+    pieces += details
+    if counts:
+        emoji = f" ({' '.join(sticker_emoji[:3])})" if sticker_emoji else ""
+        pieces.append("отправил(а): " + ", ".join(f"{_COUNTED_MEDIA[t]} ×{n}{emoji if t == 'sticker' else ''}" for t, n in counts.items()))
+    if not pieces: return None, dropped
+    return f"{_entry_header(run[0])}{'; '.join(pieces)}\n", dropped
+
+def _compact_entries(messages: Iterable[Dict[str, Any]], images_data: Dict[str, bytes]) -> Tuple[List[LogEntry], Dict[str, int]]:
+    """Записи лога: подряд идущие сообщения автора - одна строка, медиа без подписи - счетчики, пустые реплики
+    отброшены. Фото с данными не трогаются (нумерация [IMAGE N]). Один проход по messages, словари текстовых
+    сообщений не удерживаются; статистика: сообщений, отброшено, оценка токенов до компактизации."""
+    entries: List[LogEntry] = []; run: List[Dict[str, Any]] = []
+    stats = {'messages': 0, 'dropped': 0, 'tokens': 0}
+
+    def _flush():
+        if not run: return
+        line, run_dropped = _run_line(run); stats['dropped'] += run_dropped
+        if line: entries.append(line)
+        run.clear()
+
+    for msg in messages:
+        stats['messages'] += 1; stats['tokens'] += estimate_tokens(format_log_entry(msg))
+        if msg.get('type') == 'photo' and msg.get('file_unique_id') in images_data:
+            stats['tokens'] += _IMAGE_TOKENS
+            _flush(); entries.append(msg); continue
+        if run and (msg.get('user_id', msg.get('username')) != run[-1].get('user_id', run[-1].get('username')) or msg['timestamp'] - run[-1]['timestamp'] > _RUN_GAP_MS): _flush()
+        run.append(msg)
+    _flush()
+    return entries, stats
+
+def _sample_entries(entries: List[LogEntry], token_budget: int) -> List[LogEntry]:
+    """Равномерная по дню выборка текстовых записей в пределах бюджета; фото с данными сохраняются.
+    Пропуски помечаются строкой с числом выпавших записей."""
+    costs = [estimate_tokens(entry) if isinstance(entry, str) else _IMAGE_TOKENS + 30 for entry in entries]
+    if sum(costs) <= token_budget: return entries
+    text_idx = [i for i, entry in enumerate(entries) if isinstance(entry, str)]
+    text_total = sum(costs[i] for i in text_idx)
+    available = max(0, token_budget - (sum(costs) - text_total))
+    keep_count = len(text_idx) * available // max(1, text_total)
+    while keep_count > 0:
+        kept = {text_idx[j * len(text_idx) // keep_count] for j in range(keep_count)} # Шаг выборки равномерен по времени
+        if sum(costs[i] for i in kept) + 10 * len(kept) <= available: break # ~10 токенов на пометку пропуска
+        keep_count = keep_count * 9 // 10
+    else: kept = set()
+    sampled: List[LogEntry] = []; skipped = 0
+    for i, entry in enumerate(entries):
+        if isinstance(entry, str) and i not in kept: skipped += 1; continue
+        if skipped: sampled.append(f"(… пропущено записей: {skipped} …)\n"); skipped = 0
+        sampled.append(entry)
+    if skipped: sampled.append(f"(… пропущено записей: {skipped} …)\n")
+    return sampled
+
+def build_log_parts(messages: Iterable[Dict[str, Any]], images_data: Dict[str, bytes], image_offset: int = 0,
+                    token_budget: int = 0) -> Tuple[PreparedContent, int]:
+    """Тело лога: текстовые блоки и байты изображений по порядку. Нумерация [IMAGE N] продолжается
+    с image_offset (части лога в map-reduce). При PROMPT_COMPACTION_ENABLED лог компактизируется,
+    token_budget > 0 - дополнительно равномерная выборка до бюджета. Возвращает (части, номер последнего изображения)."""
+    stats: Optional[Dict[str, int]] = None
+    if PROMPT_COMPACTION_ENABLED:
+        entries, stats = _compact_entries(messages, images_data)
+        if token_budget > 0: entries = _sample_entries(entries, token_budget)
+    else:
+        entries = [msg if msg.get('type') == 'photo' and msg.get('file_unique_id') in images_data else format_log_entry(msg) for msg in messages]
+    content_parts: PreparedContent = []
+    image_counter = image_offset
+    text_block: List[str] = [] # Строки текущего текстового блока: склеиваются один раз, без квадратичного +=
+    for entry in entries:
+        if isinstance(entry, str):
+            text_block.append(entry)
+            continue
+        msg = entry
+        # Фото с данными: строка лога с placeholder [IMAGE N] и сами байты
+        if text_block:
+            content_parts.append("".join(text_block).strip())
+            text_block = []
+        image_counter += 1
+        image_bytes = images_data[msg['file_unique_id']]
+        content_parts.append(format_log_entry(msg, image_counter=image_counter).strip())
+        content_parts.append({"mime_type": detect_mime(image_bytes), "data": image_bytes})
+    # Добавляем последний текстовый блок лога, если он есть
+    if text_block:
+        content_parts.append("".join(text_block).strip())
+    if stats and stats['messages']:
+        logger.info(f"Лог: {stats['messages']} сообщений -> {len(entries)} записей (пустых реплик отброшено: {stats['dropped']}), ~{stats['tokens']} -> ~{estimate_tokens(content_parts)} токенов{f' (бюджет {token_budget})' if token_budget > 0 else ''}.")
+    return content_parts, image_counter
+
+# ===========================================
+# Оценка размера промпта (для выбора map-reduce)
+# ===========================================
+_CHARS_PER_TOKEN = 3.0 # Осторожная оценка: кириллица токенизируется плотнее латиницы
+_IMAGE_TOKENS = 258 # Изображение в запросе Gemini
+
+def estimate_tokens(content: Union[PreparedContent, str]) -> int:
+    """Грубая оценка числа токенов промпта без вызова токенизатора."""
+    if isinstance(content, str): return math.ceil(len(content) / _CHARS_PER_TOKEN)
+    return sum(math.ceil(len(part) / _CHARS_PER_TOKEN) if isinstance(part, str) else _IMAGE_TOKENS for part in content)
+
+def split_messages_for_map_reduce(messages: List[Dict[str, Any]], images_data: Dict[str, bytes], chunk_tokens: int) -> List[List[Dict[str, Any]]]:
+    """Делит сообщения (по времени) на последовательные части примерно равного размера не больше chunk_tokens.
+    Число частей выбирается по оценке всего лога, поэтому последняя часть не остается крошечной."""
+    ordered = list(in_time_order(messages))
+    costs = [estimate_tokens(format_log_entry(m)) + (_IMAGE_TOKENS if m.get('type') == 'photo' and m.get('file_unique_id') in images_data else 0) for m in ordered]
+    total = sum(costs)
+    if not ordered: return []
+    count = math.ceil(total / max(1, chunk_tokens))
+    chunks: List[List[Dict[str, Any]]] = [[] for _ in range(count)]; done = 0
+    for msg, cost in zip(ordered, costs): # Часть - по доле уже пройденного объема: границы равномерны
+        chunks[min(count - 1, done * count // total)].append(msg); done += cost
+    return [chunk for chunk in chunks if chunk]
 
 # ================================================
 # Сборка Контента для Ежедневной Сводки
 # ================================================
 def build_content(
-    messages: List[Dict[str, Any]],
+    messages: Iterable[Dict[str, Any]],
     images_data: Dict[str, bytes],
     output_format: str = DEFAULT_OUTPUT_FORMAT,
     genre_key: Optional[str] = 'default',
-    personality_key: str = DEFAULT_PERSONALITY
+    personality_key: str = DEFAULT_PERSONALITY,
+    token_budget: Optional[int] = None
 ) -> Optional[PreparedContent]:
     """
     Собирает полный контент (промпт + логи + изображения) для генерации
-    истории или дайджеста с учетом всех настроек.
+    истории или дайджеста с учетом всех настроек. token_budget - бюджет лога
+    (None - PROMPT_TOKEN_BUDGET, 0 - без выборки). messages - список или итератор, проходится один раз.
     """
-    if not messages:
+    if isinstance(messages, list) and not messages:
         logger.info("Нет сообщений для сборки контента.")
         return None
 
-    # Сортировка сообщений (важно для последовательности лога)
+    # Порядок по времени (важно для последовательности лога)
     try:
-        valid_messages = [m for m in messages if isinstance(m, dict) and 'timestamp' in m]
-        valid_messages.sort(key=lambda x: datetime.datetime.fromisoformat(x['timestamp'].replace('Z', '+00:00')))
+        valid_messages = in_time_order(messages)
     except Exception as e:
         logger.warning(f"Не удалось отсортировать сообщения ({e}). Используется исходный порядок.", exc_info=True)
         valid_messages = messages
@@ -193,33 +353,9 @@ def build_content(
     # Получаем начальный промпт и ожидаемое завершение
     initial_prompt, personality_closing = get_output_initial_prompt(output_format, genre_key, personality_key)
     content_parts: PreparedContent = [initial_prompt]
-    image_counter = 0
-    current_text_block = ""
-
     # Формируем тело лога с изображениями
-    for msg in valid_messages:
-        log_entry = None
-        msg_type = msg.get('type')
-        msg_file_unique_id = msg.get('file_unique_id')
-        # Вставляем изображение, если оно есть и требуется для формата
-        # TODO: Добавить проверку use_photos (возвращать из get_output_initial_prompt?)
-        if msg_type == 'photo' and msg_file_unique_id and msg_file_unique_id in images_data:
-            if current_text_block:
-                content_parts.append(current_text_block.strip())
-                current_text_block = ""
-            image_counter += 1
-            image_bytes = images_data[msg_file_unique_id]
-            log_entry = format_log_entry(msg, image_counter=image_counter) # Форматируем с placeholder [IMAGE N]
-            content_parts.append(log_entry.strip()) # Добавляем текст лога
-            content_parts.append({"mime_type": "image/jpeg", "data": image_bytes}) # Добавляем сами байты картинки
-        else:
-            # Форматируем запись для других типов или фото без данных
-            log_entry = format_log_entry(msg)
-            current_text_block += log_entry
-
-    # Добавляем последний текстовый блок лога, если он есть
-    if current_text_block:
-        content_parts.append(current_text_block.strip())
+    log_parts, _ = build_log_parts(valid_messages, images_data, token_budget=PROMPT_TOKEN_BUDGET if token_budget is None else token_budget)
+    content_parts.extend(log_parts)
 
     # Завершающая часть промпта
     final_instruction = "Теперь, выполни свою задачу как Летописец."
@@ -235,24 +371,73 @@ def build_content(
 
     return content_parts
 
+# ================================================
+# Map-reduce для больших логов: конспекты частей и финальный проход
+# ================================================
+def build_chunk_notes_content(
+    messages: Iterable[Dict[str, Any]], images_data: Dict[str, bytes],
+    chunk_index: Optional[int] = None, chunk_count: Optional[int] = None, image_offset: int = 0
+) -> Tuple[Optional[PreparedContent], int]:
+    """Промпт конспекта одной части лога (map; без номера части - промежуточный конспект дня).
+    Возвращает (контент, номер последнего изображения части)."""
+    log_parts, last_image = build_log_parts(messages, images_data, image_offset)
+    if not log_parts: return None, last_image
+    part_intro = (f"Перед тобой часть {chunk_index} из {chunk_count} лога сообщений чата за день (части идут по времени). " if chunk_count
+                  else "Перед тобой очередная часть лога сообщений чата за текущий день (день еще не закончился). ")
+    initial_prompt = (
+        f"{part_intro}"
+        "Составь **подробный хронологический конспект** этой части: ключевые темы и события, кто что предлагал и решил, "
+        "заметные шутки и споры, общее настроение. Упоминай имена пользователей. Изображения [IMAGE N] кратко опиши "
+        "с сохранением их номеров и отправителей. Не пиши вступлений и выводов, только факты из лога.\n\n"
+        "ЧАСТЬ ЛОГА:\n"
+        "---------------------------------\n"
+    )
+    return [initial_prompt, *log_parts, "\n---------------------------------\nКОНЕЦ ЧАСТИ.\n\nКонспект:\n"], last_image
+
+def build_reduce_content(
+    chunk_notes: List[str],
+    output_format: str = DEFAULT_OUTPUT_FORMAT,
+    genre_key: Optional[str] = 'default',
+    personality_key: str = DEFAULT_PERSONALITY,
+    tail_parts: Optional[PreparedContent] = None
+) -> Optional[PreparedContent]:
+    """Финальный проход (reduce): история/дайджест в формате, жанре и личности чата по конспектам частей.
+    tail_parts - полный лог последних часов после конспектов (промежуточные конспекты дня)."""
+    if not chunk_notes: return None
+    initial_prompt, personality_closing = get_output_initial_prompt(output_format, genre_key, personality_key)
+    if tail_parts:
+        notes_intro = (
+            "(Начало дня дано последовательными конспектами его частей по времени, после них - полный лог последних часов. "
+            "Описания изображений [IMAGE N] в конспектах заменяют сами изображения.)\n"
+        )
+    else:
+        notes_intro = (
+            "(Лог дня слишком большой, поэтому вместо него ниже даны последовательные конспекты его частей по времени. "
+            "Описания изображений [IMAGE N] в них заменяют сами изображения.)\n"
+        )
+    notes = "\n\n".join(f"ЧАСТЬ {i} из {len(chunk_notes)}:\n{note.strip()}" for i, note in enumerate(chunk_notes, 1))
+    final_instruction = "Теперь, выполни свою задачу как Летописец: опиши весь день целиком, а не каждую часть по отдельности."
+    if personality_closing:
+        final_instruction += f" Не забудь добавить финальную заметку в твоем стиле ({personality_closing})."
+    content: PreparedContent = [initial_prompt + notes_intro, notes]
+    if tail_parts: content += ["\n---------------------------------\nПОСЛЕДНИЕ ЧАСЫ (ПОЛНЫЙ ЛОГ):\n", *tail_parts]
+    return content + [f"\n---------------------------------\nКОНЕЦ КОНСПЕКТОВ.\n\n{final_instruction}\n"]
+
 # ================================================
 # Сборка Контента для Команды /summarize
 # ================================================
-def build_summary_content(messages: List[Dict[str, Any]]) -> Optional[PreparedContent]:
+def build_summary_content(messages: Iterable[Dict[str, Any]]) -> Optional[PreparedContent]:
     """
     Собирает контент для генерации простого саммари (для команды /summarize).
     Использует только текст, без личностей/жанров, формат Markdown.
+    messages - список или итератор, проходится один раз.
     """
-    if not messages:
+    if isinstance(messages, list) and not messages:
         logger.info("Нет сообщений для сборки /summarize контента.")
         return None
     try:
-        # Фильтруем и сортируем только текстовые сообщения
-        text_messages = [ m for m in messages if isinstance(m, dict) and m.get('timestamp') and m.get('type') == 'text' and m.get('content')]
-        if not text_messages:
-             logger.info("Не найдено текстовых сообщений для /summarize.")
-             return None
-        text_messages.sort(key=lambda x: datetime.datetime.fromisoformat(x['timestamp'].replace('Z', '+00:00')))
+        # Только текстовые сообщения, по времени (фильтр ленивый: итератор не материализуется)
+        text_messages = (m for m in in_time_order(messages) if m.get('timestamp') and m.get('type') == 'text' and m.get('content'))
     except Exception as e:
         logger.warning(f"Не удалось отсортировать сообщения для /summarize ({e}).", exc_info=True)
         return None # Возвращаем None при ошибке сортировки
@@ -275,9 +460,12 @@ def build_summary_content(messages: List[Dict[str, Any]]) -> Optional[PreparedCo
     )
     content_parts.append(initial_prompt)
 
-    # Добавляем только текст сообщений в лог
-    log_block = "".join(format_log_entry(msg) for msg in text_messages)
-    content_parts.append(log_block.strip())
+    # Добавляем только текст сообщений в лог (компактизированный, в пределах бюджета)
+    log_parts, _ = build_log_parts(text_messages, {}, token_budget=PROMPT_TOKEN_BUDGET)
+    if not log_parts:
+        logger.info("Не найдено текстовых сообщений для /summarize.")
+        return None
+    content_parts.extend(log_parts)
 
     # Финальная инструкция
     content_parts.append(f"\n---------------------------------\nКОНЕЦ ЛОГА.\n\nНапиши краткую выжимку обсуждений в Markdown:\n")
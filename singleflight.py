@@ -0,0 +1,55 @@
+# singleflight.py
+# Объединение одинаковых одновременных запросов (single-flight) для дорогих операций чата:
+# генерация истории/дайджеста и сводки /summarize. Первый запрос с ключом запускает вычисление,
+# остальные ждут тот же результат. Успешный результат еще SINGLEFLIGHT_RESULT_TTL_SEC секунд
+# отдается повторным запросам (нажали кнопку дважды, несколько участников подряд).
+# Состояние - в памяти процесса; вызывается только из event loop.
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+from config import SINGLEFLIGHT_RESULT_TTL_SEC
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_inflight: Dict[Hashable, "asyncio.Future"] = {}
+_results: Dict[Hashable, Tuple[float, Any]] = {} # key -> (monotonic-время истечения, результат)
+_stats: Dict[str, int] = {'started': 0, 'joined': 0, 'cache_hits': 0}
+
+def _prune_results(now: float):
+    for key in [k for k, (expires, _) in _results.items() if expires <= now]: del _results[key]
+
+def _on_done(key: Hashable, task: "asyncio.Future", ttl: float, cache_if: Callable[[Any], bool]):
+    if _inflight.get(key) is task: del _inflight[key]
+    if task.cancelled() or task.exception() is not None or ttl <= 0: return # Ошибки не кэшируем
+    result = task.result()
+    if not cache_if(result): return
+    now = time.monotonic(); _prune_results(now)
+    _results[key] = (now + ttl, result)
+
+async def run(key: Hashable, func: Callable[[], Awaitable[T]], ttl: Optional[float] = None,
+              cache_if: Callable[[T], bool] = lambda result: True) -> Tuple[T, bool]:
+    """Выполняет func() один раз на ключ. Возвращает (результат, shared): shared=True - результат
+    получен от чужого вычисления или из кэша. ttl=0 - только объединение, без кэша результата.
+    Вычисление идет отдельной задачей: отмена одного из ожидающих не прерывает его для остальных."""
+    ttl = SINGLEFLIGHT_RESULT_TTL_SEC if ttl is None else ttl
+    cached = _results.get(key)
+    if cached and cached[0] > time.monotonic():
+        _stats['cache_hits'] += 1; logger.debug(f"Single-flight {key}: результат из кэша.")
+        return cached[1], True
+    task = _inflight.get(key)
+    shared = task is not None
+    if task is None:
+        task = asyncio.ensure_future(func())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _on_done(key, t, ttl, cache_if))
+        _stats['started'] += 1
+    else:
+        _stats['joined'] += 1; logger.info(f"Single-flight {key}: ждем уже идущее вычисление.")
+    return await asyncio.shield(task), shared
+
+def get_stats() -> Dict[str, int]:
+    return dict(_stats, inflight=len(_inflight), cached=len(_results))
@@ -0,0 +1,60 @@
+# storage_backend.py
+# Интерфейс хранилища бота: сообщения, настройки чатов, отзывы, расписание и статистика.
+# Реализации - модули с одноименными async-функциями:
+#   async_data_manager - SQLite (data_manager в пуле потоков), STORAGE_BACKEND=sqlite;
+#   postgres_storage   - PostgreSQL через asyncpg, STORAGE_BACKEND=postgres.
+# Остальной код всегда вызывает adm.<функция>; при postgres async_data_manager подменяет
+# свои функции реализациями из postgres_storage (см. API_FUNCTIONS).
+# Запись входящих сообщений в обоих случаях идет через очередь data_manager.add_message,
+# меняется только приемник пачек (data_manager.set_message_batch_sink).
+import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Protocol, Set, Tuple, TypeVar, Union
+
+Since = Union[datetime.datetime, int] # datetime или epoch ms (UTC)
+T = TypeVar("T")
+
+class StorageBackend(Protocol):
+    # --- Сообщения ('timestamp' в словарях - epoch ms UTC) ---
+    async def get_messages_for_chat(self, chat_id: int) -> List[Dict[str, Any]]: ...
+    async def get_messages_for_chat_since(self, chat_id: int, since: Since, until: Optional[Since] = None) -> List[Dict[str, Any]]: ...
+    # reducer(поток сообщений периода) вне event loop -> (результат, data_manager.output_window)
+    async def reduce_messages_for_chat_since(self, chat_id: int, since: Since, reducer: Callable[[Iterable[Dict[str, Any]]], T], until: Optional[Since] = None) -> Tuple[T, Tuple[int, int, int]]: ...
+    async def get_messages_for_chat_last_n(self, chat_id: int, limit: int, only_text: bool = False) -> List[Dict[str, Any]]: ...
+    async def count_messages_since(self, chat_id: int, since: Since) -> int: ...
+    async def get_referenced_photo_ids(self) -> Set[str]: ...
+    async def get_recent_activity_buckets(self, since: Since) -> List[Tuple[int, int, int]]: ...
+    async def clear_messages_for_chat(self, chat_id: int) -> None: ...
+    async def delete_messages_older_than(self, chat_id: int, days: int) -> int: ...
+    async def purge_expired_messages(self, policies: Optional[List[Tuple[int, int]]] = None) -> Dict[str, Any]: ...
+    async def get_purge_stats(self) -> Dict[str, Any]: ...
+    async def archive_old_messages(self) -> Dict[str, Any]: ...
+    # --- Настройки чатов ---
+    async def get_chat_settings(self, chat_id: int) -> Dict[str, Any]: ...
+    async def update_chat_setting(self, chat_id: int, setting_key: str, setting_value: Optional[Union[str, bool, int]]) -> bool: ...
+    async def get_chat_language(self, chat_id: int) -> str: ...
+    async def get_enabled_chats(self) -> List[int]: ...
+    async def get_chat_timezone(self, chat_id: int) -> str: ...
+    async def get_chat_genre(self, chat_id: int) -> str: ...
+    async def get_chat_output_format(self, chat_id: int) -> str: ...
+    async def get_chat_personality(self, chat_id: int) -> str: ...
+    async def get_chat_retention_days(self, chat_id: int) -> Optional[int]: ...
+    async def get_chats_with_retention(self) -> List[Tuple[int, int]]: ...
+    async def get_intervention_settings(self, chat_id: int) -> Dict[str, Any]: ...
+    # --- Полнотекстовый поиск ('snippet' - готовый HTML) ---
+    async def search_messages(self, chat_id: int, query: str, since: Optional[Since] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]: ...
+    async def fts_maintenance(self, budget_sec: float, full: bool = False) -> Dict[str, Any]: ...
+    # --- Сохраненные результаты генерации (ключ - data_manager.output_window/output_fingerprint) ---
+    async def get_latest_generated_output(self, chat_id: int, fingerprint: str, first_message_ms: int) -> Optional[Dict[str, Any]]: ...
+    async def save_generated_output(self, chat_id: int, fingerprint: str, period_start_ms: int, period_end_ms: int, message_count: int, output_text: str, note: Optional[str] = None, photo_count: int = 0) -> None: ...
+    async def purge_generated_outputs(self, days: Optional[int] = None) -> int: ...
+    # --- Промежуточные конспекты дня (partial_digest_job) ---
+    async def get_partial_digest_candidates(self) -> List[Tuple[int, int, int]]: ...
+    async def get_partial_digests(self, chat_id: int, since_ms: int) -> List[Dict[str, Any]]: ...
+    async def save_partial_digest(self, chat_id: int, period_start_ms: int, period_end_ms: int, notes: str, message_count: int, image_count: int = 0) -> None: ...
+    async def purge_partial_digests(self, before_ms: int) -> int: ...
+    # --- Расписание, статистика, отзывы ---
+    async def claim_due_chats(self, now_ts: Optional[float] = None) -> List[Tuple[int, int]]: ...
+    async def get_chat_stats(self, chat_id: int, since: Since) -> Optional[Dict[str, Any]]: ...
+    async def add_feedback(self, message_id: int, chat_id: int, user_id: int, rating: int) -> None: ...
+
+API_FUNCTIONS: Tuple[str, ...] = tuple(name for name in StorageBackend.__dict__ if not name.startswith('_'))
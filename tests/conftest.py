@@ -0,0 +1,22 @@
+# tests/conftest.py
+# config читает переменные окружения при импорте: временная БД и архив задаются до импорта модулей бота.
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP_DIR = tempfile.mkdtemp(prefix="letopisets-tests-")
+os.environ["DATA_FILE_PATH"] = os.path.join(_TMP_DIR, "test.db")
+os.environ["ARCHIVE_DIR"] = os.path.join(_TMP_DIR, "archive")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope="session")
+def sqlite_db():
+    """data_manager с инициализированной временной SQLite-БД (одна на сессию; тесты берут свои chat_id)."""
+    import data_manager as dm
+    dm.load_data()
+    yield dm
+    dm.stop_ingest_writer()
+    dm.close_all_connections()
@@ -0,0 +1,67 @@
+# tests/test_activity_tracker.py
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import activity_tracker as at
+
+HOUR = 3600
+START = 1_700_000_000 // HOUR * HOUR # Начало часа UTC
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемые часы и чистое состояние трекера."""
+    now = {'ts': float(START), 'mono': 1000.0}
+    monkeypatch.setattr(at, "time", SimpleNamespace(time=lambda: now['ts'], monotonic=lambda: now['mono']))
+    monkeypatch.setattr(at, "_windows", OrderedDict())
+    monkeypatch.setattr(at, "_hourly_ewma", [None] * 24)
+    monkeypatch.setattr(at, "_current_hour", -1)
+    monkeypatch.setattr(at, "_current_hour_count", 0)
+    monkeypatch.setattr(at, "_last_sweep_ts", now['mono'])
+    return now
+
+def test_counts_within_window(clock):
+    at.record_message(1)
+    at.record_message(1, ts=clock['ts'] - 5 * 60, count=3)
+    at.record_message(1, ts=clock['ts'] - at.WINDOW_MINUTES * 60) # Старше окна - не учитывается
+    assert at.count_recent(1, 1) == 1
+    assert at.count_recent(1, 6) == 4
+    assert at.count_recent(1, 10_000) == 4 # timespan ограничен окном
+    assert at.count_recent(2, 60) == 0
+
+def test_ring_bucket_reused_after_full_turn(clock):
+    at.record_message(1, count=5)
+    clock['ts'] += at.WINDOW_MINUTES * 60 # Та же позиция в кольце, минута уже другая
+    at.record_message(1)
+    window = at._windows[1]
+    assert window.counts.count(0) == at.WINDOW_MINUTES - 1 # Старая корзина переиспользована, а не дополнена
+    assert at.count_recent(1, at.WINDOW_MINUTES) == 1
+
+def test_lru_eviction_and_idle_sweep(clock, monkeypatch):
+    monkeypatch.setattr(at, "ACTIVITY_MAX_CHATS", 2)
+    at.record_message(1); at.record_message(2); at.record_message(1) # Чат 1 снова самый свежий
+    at.record_message(3)
+    assert list(at._windows) == [1, 3]
+
+    clock['ts'] += at.WINDOW_MINUTES * 60; clock['mono'] += at.ACTIVITY_SWEEP_INTERVAL_SEC
+    at.record_message(4) # Запускает очистку: у чатов 1 и 3 нет сообщений в окне
+    assert list(at._windows) == [4] and at.tracked_chats() == 1
+
+def test_seed_does_not_touch_hourly_profile(clock):
+    minute = int(clock['ts'] // 60)
+    assert at.seed([(1, minute - 2, 4), (1, minute, 1), (2, minute - 1, 2)]) == 3
+    assert at.count_recent(1, 5) == 5 and at.count_recent(2, 5) == 2
+    assert at.get_hourly_profile() == [None] * 24
+
+def test_quiet_hours_follow_profile(clock):
+    assert at.is_quiet_hour(START) # Час еще не изучен
+    # Сутки: первый час самый загруженный, остальные - по одному сообщению, шестой без сообщений
+    for hour in range(24):
+        clock['ts'] = START + hour * HOUR
+        if hour != 5: at.record_message(1, count=100 if hour == 0 else 1)
+    first = START // HOUR % 24
+    assert not at.is_quiet_hour(START + 24 * HOUR, quiet_hours=6) # Новые сутки: первый час снова текущий
+    profile = at.get_hourly_profile()
+    assert profile[first] == 100 and profile[(first + 5) % 24] == 0 # Час без сообщений закрыт нулем
+    assert at.is_quiet_hour(START + 29 * HOUR, quiet_hours=1) # Шестой час - самый тихий
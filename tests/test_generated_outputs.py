@@ -0,0 +1,38 @@
+# tests/test_generated_outputs.py
+# Повторная выдача сохраненного результата: рассылка и /generate_now считают период от разных моментов.
+import time
+
+_HOUR_MS = 3_600_000
+
+def _add(dm, chat_id: int, message_id: int, ts_ms: int):
+    dm.add_message(chat_id, {'message_id': message_id, 'user_id': 1, 'username': 'u', 'timestamp': ts_ms, 'type': 'text', 'content': f"m{message_id}"})
+    dm.flush_message_buffer()
+
+def test_job_output_reused_by_generate_now(sqlite_db):
+    dm = sqlite_db; chat_id = -7001
+    now_ms = int(time.time() * 1000)
+    for i, hours_ago in enumerate((30, 20, 10, 2)): _add(dm, chat_id, i + 1, now_ms - hours_ago * _HOUR_MS)
+    fingerprint = dm.output_fingerprint('story', 'default', 'neutral', 'ru')
+
+    # Рассылка считала сутки от своего слота: в ее окне есть и сообщение 30-часовой давности
+    job_window = dm.output_window(dm.get_messages_for_chat_since(chat_id, now_ms - 31 * _HOUR_MS))
+    dm.save_generated_output(chat_id, fingerprint, *job_window, "история дня", None, 0)
+
+    # /generate_now: период now-24h дает другое окно, но новых сообщений после рассылки нет
+    now_window = dm.output_window(dm.get_messages_for_chat_since(chat_id, now_ms - 24 * _HOUR_MS))
+    assert now_window != job_window
+    stored = dm.get_latest_generated_output(chat_id, fingerprint, now_window[0])
+    assert stored and stored['output_text'] == "история дня"
+    assert dm.get_latest_generated_output(chat_id, dm.output_fingerprint('digest', 'default', 'neutral', 'ru'), now_window[0]) is None
+
+    _add(dm, chat_id, 5, now_ms) # Новое сообщение после конца сохраненного окна
+    assert dm.get_latest_generated_output(chat_id, fingerprint, now_window[0]) is None
+
+def test_stored_output_must_cover_period_start(sqlite_db):
+    dm = sqlite_db; chat_id = -7002
+    now_ms = int(time.time() * 1000)
+    for i, hours_ago in enumerate((20, 10, 2)): _add(dm, chat_id, i + 1, now_ms - hours_ago * _HOUR_MS)
+    fingerprint = dm.output_fingerprint('story', 'default', 'neutral', 'ru')
+    messages = dm.get_messages_for_chat_since(chat_id, now_ms - 24 * _HOUR_MS)
+    dm.save_generated_output(chat_id, fingerprint, *dm.output_window(messages[1:]), "без первого сообщения", None, 0)
+    assert dm.get_latest_generated_output(chat_id, fingerprint, dm.output_window(messages)[0]) is None
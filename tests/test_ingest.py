@@ -0,0 +1,41 @@
+# tests/test_ingest.py
+# Очередь записи: flush_message_buffer дожидается пачки, которую фоновый писатель еще набирает.
+import time
+
+import pytest
+
+@pytest.fixture
+def dm(sqlite_db, monkeypatch):
+    monkeypatch.setattr(sqlite_db, "INGEST_FLUSH_INTERVAL_SEC", 5.0) # Писатель долго держит недобранную пачку
+    sqlite_db.start_ingest_writer()
+    yield sqlite_db
+    sqlite_db.stop_ingest_writer()
+
+def _count(dm, chat_id: int) -> int:
+    return dm._execute_query("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,), fetch_one=True)[0]
+
+def _wait_for_inflight_batch(dm):
+    """Ждет, пока писатель заберет строки из очереди в свою пачку."""
+    for _ in range(100):
+        if dm._ingest_queue.qsize() == 0: return
+        time.sleep(0.01)
+    pytest.fail("писатель не забрал строки из очереди")
+
+def test_clear_does_not_resurrect_inflight_batch(dm):
+    chat_id = -6001
+    now_ms = int(time.time() * 1000)
+    for i in range(3): dm.add_message(chat_id, {'message_id': i, 'user_id': 1, 'username': 'u', 'timestamp': now_ms + i, 'type': 'text', 'content': f"m{i}"})
+    _wait_for_inflight_batch(dm)
+    assert _count(dm, chat_id) == 0 # Пачка еще не записана
+
+    started = time.monotonic()
+    dm.clear_messages_for_chat(chat_id)
+    assert time.monotonic() - started < 2 # Писатель отдал пачку сразу, а не через INGEST_FLUSH_INTERVAL_SEC
+    dm.stop_ingest_writer()
+    assert _count(dm, chat_id) == 0
+
+def test_flush_includes_inflight_photos(dm):
+    chat_id = -6002
+    dm.add_message(chat_id, {'message_id': 1, 'user_id': 1, 'username': 'u', 'timestamp': int(time.time() * 1000), 'type': 'photo', 'content': '', 'file_id': 'f', 'file_unique_id': 'inflight-photo'})
+    _wait_for_inflight_batch(dm)
+    assert 'inflight-photo' in dm.get_referenced_photo_ids()
@@ -0,0 +1,40 @@
+# tests/test_log_lines.py
+# Строки лога промпта, сохраненные в messages.log_line (renderer регистрируется слоем промптов).
+import time
+
+import pytest
+
+import prompt_builder as pb
+
+@pytest.fixture
+def dm(sqlite_db):
+    yield sqlite_db
+    sqlite_db.set_log_line_renderer(None)
+
+def _stored(dm, chat_id: int):
+    return dm._execute_query("SELECT message_id, log_line, log_line_v FROM messages WHERE chat_id = ? ORDER BY message_id", (chat_id,), fetch_all=True)
+
+def _add(dm, chat_id: int, count: int, now_ms: int):
+    for i in range(count):
+        dm.add_message(chat_id, {'message_id': i, 'user_id': 1, 'username': 'anna', 'timestamp': now_ms + i * 60_000,
+                                 'type': 'sticker' if i == 1 else 'text', 'content': '😂' if i == 1 else f"текст {i}"})
+    dm.flush_message_buffer()
+
+def test_data_manager_does_not_depend_on_prompt_layer():
+    with open(pb.__file__.replace('prompt_builder.py', 'data_manager.py'), encoding='utf-8') as f: source = f.read()
+    assert 'import prompt_builder' not in source
+
+def test_no_renderer_stores_null(dm):
+    dm.set_log_line_renderer(None)
+    _add(dm, -3001, 2, int(time.time() * 1000))
+    assert all(r['log_line'] is None and r['log_line_v'] is None for r in _stored(dm, -3001))
+    messages = dm.get_messages_for_chat(-3001)
+    assert ''.join(p for p in pb.build_content(messages, {}, token_budget=0) if isinstance(p, str)).count('текст 0') == 1 # Рисуются при сборке промпта
+
+def test_renderer_lines_match_prompt_rendering(dm):
+    dm.set_log_line_renderer(pb.format_log_entry, pb.LOG_LINE_VERSION)
+    _add(dm, -3002, 3, int(time.time() * 1000))
+    assert {r['log_line_v'] for r in _stored(dm, -3002)} == {pb.LOG_LINE_VERSION}
+    messages = dm.get_messages_for_chat(-3002)
+    bare = [{k: v for k, v in m.items() if k not in ('log_line', 'log_line_v')} for m in messages]
+    assert [pb.format_log_entry(m) for m in messages] == [pb.format_log_entry(m) for m in bare]
@@ -0,0 +1,67 @@
+# tests/test_message_archive.py
+import gzip
+import json
+import os
+
+import pytest
+
+import message_archive as ma
+
+BASE_TS = 1_714_521_600_000 # 2024-05-01 00:00 UTC
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ma, "ARCHIVE_DIR", str(tmp_path))
+    return tmp_path
+
+def _messages(start: int, count: int, step_ms: int = 60_000):
+    return [{'message_id': i, 'user_id': i % 3, 'username': f"user{i % 3}", 'timestamp': BASE_TS + i * step_ms,
+             'type': 'text', 'content': f"сообщение {i} " + "x" * (i % 50), 'file_id': None} for i in range(start, start + count)]
+
+def test_month_and_path():
+    assert ma.month_of(BASE_TS) == "2024-05" and ma.month_of(BASE_TS - 1) == "2024-04"
+    assert ma.segment_path(-100, "2024-05").endswith(os.path.join("-100", "2024-05.ndjson.gz"))
+
+def test_multi_member_segment_reads_in_order(monkeypatch):
+    monkeypatch.setattr(ma, "_READ_CHUNK", 257) # Границы кусков внутри строк и между членами
+    path = ma.segment_path(-1, "2024-05")
+    size = ma.append_segment(-1, "2024-05", _messages(0, 300))
+    assert ma.append_segment(-1, "2024-05", _messages(300, 200)) == os.path.getsize(path) > size
+    messages = list(ma.read_segment(path))
+    assert [m['message_id'] for m in messages] == list(range(500))
+    assert messages[7] == {**_messages(7, 1)[0], 'file_unique_id': None, 'file_name': None}
+    with gzip.open(path, "rt", encoding="utf-8") as f: # Обычный gzip читает файл как один поток
+        assert len([line for line in f if line.strip()]) == 500
+
+def test_read_segment_range_filter():
+    path = ma.segment_path(-2, "2024-05")
+    ma.append_segment(-2, "2024-05", _messages(0, 100))
+    assert [m['message_id'] for m in ma.read_segment(path, BASE_TS + 10 * 60_000, BASE_TS + 20 * 60_000)] == list(range(10, 20))
+    assert list(ma.read_segment(ma.segment_path(-2, "1999-01"))) == [] # Нет файла - пустой сегмент
+
+def test_truncated_segment_keeps_whole_lines(monkeypatch):
+    monkeypatch.setattr(ma, "_READ_CHUNK", 64)
+    path = ma.segment_path(-3, "2024-05")
+    first = ma.append_segment(-3, "2024-05", _messages(0, 50))
+    total = ma.append_segment(-3, "2024-05", _messages(50, 400))
+    with open(path, "r+b") as f: f.truncate(first + (total - first) // 2) # Сбой посреди второго члена
+    ids = [m['message_id'] for m in ma.read_segment(path)]
+    assert ids[:50] == list(range(50)) and 50 < len(ids) < 450
+    assert ids == list(range(len(ids))) # Только целые строки, без обрывка последней
+
+def test_rewrite_segment_drops_old_rows_and_duplicates():
+    path = ma.segment_path(-4, "2024-05")
+    ma.append_segment(-4, "2024-05", _messages(0, 100))
+    ma.append_segment(-4, "2024-05", _messages(40, 60)) # Повтор переноса после сбоя
+    assert len(list(ma.read_segment(path))) == 160
+    kept, min_ts, size = ma.rewrite_segment(path, BASE_TS + 30 * 60_000)
+    assert (kept, min_ts, size) == (70, BASE_TS + 30 * 60_000, os.path.getsize(path))
+    assert [m['message_id'] for m in ma.read_segment(path)] == list(range(30, 100))
+    assert not os.path.exists(f"{path}.tmp")
+    assert ma.rewrite_segment(path, BASE_TS + 10**9) == (0, None, 0) and not os.path.exists(path)
+
+def test_delete_chat_removes_all_segments():
+    ma.append_segment(-5, "2024-04", _messages(0, 10)); ma.append_segment(-5, "2024-05", _messages(10, 10))
+    freed = ma.delete_chat(-5)
+    assert freed > 0 and not os.path.exists(os.path.dirname(ma.segment_path(-5, "2024-05")))
+    assert ma.delete_chat(-5) == 0 and ma.delete_segment(ma.segment_path(-5, "2024-05")) == 0
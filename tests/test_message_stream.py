@@ -0,0 +1,69 @@
+# tests/test_message_stream.py
+# Потоковые геттеры: архив + горячая таблица по времени, свертка периода без списка, фоновая отрисовка log_line.
+import time
+
+import pytest
+
+import prompt_builder as pb
+
+_DAY_MS = 86_400_000
+
+@pytest.fixture
+def dm(sqlite_db):
+    sqlite_db.start_rollup_backfill()
+    if sqlite_db._rollup_thread: sqlite_db._rollup_thread.join(timeout=10)
+    yield sqlite_db
+    sqlite_db.set_log_line_renderer(None)
+
+def _add(dm, chat_id: int, message_id: int, ts_ms: int, content: str, msg_type: str = 'text'):
+    dm.add_message(chat_id, {'message_id': message_id, 'user_id': message_id % 2, 'username': f"user{message_id % 2}",
+                             'timestamp': ts_ms, 'type': msg_type, 'content': content})
+
+def test_iterator_merges_archive_and_hot_copies_in_time_order(dm):
+    chat_id = -4001
+    now_ms = int(time.time() * 1000)
+    for i in range(10): _add(dm, chat_id, i, now_ms - (25 - i) * _DAY_MS, f"старое {i}") # Все старше окна в 14 дней
+    for i in range(10, 15): _add(dm, chat_id, i, now_ms - (15 - i) * 3_600_000, f"новое {i}")
+    dm.flush_message_buffer()
+    dm.archive_old_messages(after_days=14)
+    assert dm._execute_query("SELECT SUM(rows) FROM archive_segments WHERE chat_id = ?", (chat_id,), fetch_one=True)[0] == 10
+    _add(dm, chat_id, 3, now_ms - 22 * _DAY_MS, "правка 3") # Горячая копия архивного сообщения
+    dm.flush_message_buffer()
+
+    messages = list(dm.iter_messages_for_chat_since(chat_id, now_ms - 30 * _DAY_MS))
+    assert [m['message_id'] for m in messages] == list(range(15))
+    assert messages[3]['content'] == "правка 3"
+    assert [m['timestamp'] for m in messages] == sorted(m['timestamp'] for m in messages)
+    window = list(dm.iter_messages_for_chat_since(chat_id, now_ms - 23 * _DAY_MS, now_ms - 19 * _DAY_MS))
+    assert [m["message_id"] for m in window] == [2, 3, 4, 5]
+
+def test_reduce_matches_list_getter_and_releases_cursor(dm):
+    chat_id = -4002
+    now_ms = int(time.time() * 1000)
+    for i in range(30): _add(dm, chat_id, i, now_ms - (30 - i) * 60_000, f"обсуждаем релиз {i}" if i % 3 else "ок")
+    dm.flush_message_buffer()
+    since = now_ms - 3_600_000
+    listed = dm.get_messages_for_chat_since(chat_id, since)
+    content, window = dm.reduce_messages_for_chat_since(chat_id, since, pb.build_summary_content)
+    assert window == dm.output_window(listed)
+    assert content == pb.build_summary_content(listed)
+    assert dm.reduce_messages_for_chat_since(chat_id, since, lambda stream: next(iter(stream))['message_id'])[0] == 0 # Поток не дочитан
+    assert dm.reduce_messages_for_chat_since(chat_id, now_ms + 60_000, pb.build_summary_content) == (None, (0, 0, 0))
+
+def test_reads_do_not_write_and_backfill_fills_lines(dm):
+    chat_id = -4003
+    now_ms = int(time.time() * 1000)
+    for i in range(5): _add(dm, chat_id, i, now_ms + i * 60_000, f"текст {i}")
+    dm.flush_message_buffer() # Без renderer: log_line = NULL
+    dm.set_log_line_renderer(pb.format_log_entry, pb.LOG_LINE_VERSION)
+    stored = lambda: dm._execute_query("SELECT log_line_v FROM messages WHERE chat_id = ?", (chat_id,), fetch_all=True)
+    dm.get_messages_for_chat(chat_id); dm.get_messages_for_chat_last_n(chat_id, 3)
+    assert {r[0] for r in stored()} == {None}
+
+    dm._set_meta('messages_log_line', '') # Проход для этой версии формата еще не выполнялся
+    dm.start_log_line_backfill(); dm._log_line_thread.join(timeout=10)
+    assert {r[0] for r in stored()} == {pb.LOG_LINE_VERSION}
+    assert dm._get_meta('messages_log_line') == str(pb.LOG_LINE_VERSION)
+    messages = dm.get_messages_for_chat(chat_id)
+    bare = [{k: v for k, v in m.items() if k not in ('log_line', 'log_line_v')} for m in messages]
+    assert [pb.format_log_entry(m) for m in messages] == [pb.format_log_entry(m) for m in bare]
@@ -0,0 +1,36 @@
+# tests/test_partial_digests.py
+# Промежуточные конспекты дня: выбор непрерывной цепочки для финального прохода и хранение в SQLite.
+import pytest
+
+HOUR_MS = 3_600_000
+SINCE = 1_714_521_600_000
+
+jobs = pytest.importorskip("jobs")
+
+def _partial(start_h: int, end_h: int, **extra):
+    return {'period_start_ms': SINCE + start_h * HOUR_MS, 'period_end_ms': SINCE + end_h * HOUR_MS, 'notes': f"{start_h}-{end_h}", 'message_count': 1, 'image_count': 0, **extra}
+
+def test_contiguous_chain_from_window_start():
+    partials = [_partial(0, 4), _partial(4, 8), _partial(8, 12)]
+    assert jobs._contiguous_partials(partials, SINCE) == partials
+
+def test_chain_stops_at_first_gap():
+    partials = [_partial(0, 4), _partial(5, 8), _partial(8, 12)]
+    assert jobs._contiguous_partials(partials, SINCE) == partials[:1]
+
+def test_window_moved_means_no_chain():
+    # Время сводки сменилось: конспекты начинаются не с начала нового окна
+    assert jobs._contiguous_partials([_partial(1, 4), _partial(4, 8)], SINCE) == []
+    assert jobs._contiguous_partials([], SINCE) == []
+
+def test_saved_digests_round_trip_and_purge(sqlite_db):
+    dm = sqlite_db
+    chat_id = -5001
+    for p in (_partial(4, 8, image_count=2), _partial(0, 4)):
+        dm.save_partial_digest(chat_id, p['period_start_ms'], p['period_end_ms'], p['notes'], p['message_count'], p['image_count'])
+    dm.save_partial_digest(chat_id, SINCE, SINCE + 4 * HOUR_MS, "0-4 заново", 3) # Повтор того же отрезка заменяет конспект
+    stored = dm.get_partial_digests(chat_id, SINCE)
+    assert [p['notes'] for p in stored] == ["0-4 заново", "4-8"] and stored[1]['image_count'] == 2
+    assert [p['notes'] for p in jobs._contiguous_partials(stored, SINCE)] == ["0-4 заново", "4-8"]
+    assert dm.purge_partial_digests(SINCE + 5 * HOUR_MS) >= 1
+    assert [p['notes'] for p in dm.get_partial_digests(chat_id, SINCE)] == ["4-8"]
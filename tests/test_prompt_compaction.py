@@ -0,0 +1,61 @@
+# tests/test_prompt_compaction.py
+# Компактизация и выборка лога промпта (prompt_builder._compact_entries / _sample_entries).
+import pytest
+
+import prompt_builder as pb
+
+T0 = 1_714_550_400_000 # 2024-05-01 08:00 UTC
+MIN = 60_000
+PNG = b"\x89PNG\r\n\x1a\n" + b"0" * 32
+
+def _msg(mid: int, user: int, minute: int, content: str = "", msg_type: str = 'text', **extra):
+    return {'message_id': mid, 'user_id': user, 'username': f"user{user}", 'timestamp': T0 + minute * MIN, 'type': msg_type, 'content': content, **extra}
+
+@pytest.mark.parametrize("text, low", [
+    ("ок", True), ("Ага!", True), ("ахахах", True), ("))) !!!", True), ("  ", True), ("+++", True),
+    ("ок, завтра в 10", False), ("lolipop", False), ("релиз", False), ("х" * 30, False),
+])
+def test_is_low_info(text, low):
+    assert pb._is_low_info({'content': text}) is low
+
+def test_author_runs_media_counters_and_dropped_replies():
+    messages = [
+        _msg(1, 1, 0, "Собираемся в пятницу"), _msg(2, 1, 1, "ок"), _msg(3, 1, 2, "😂", 'sticker'), _msg(4, 1, 3, "😂", 'sticker'),
+        _msg(5, 1, 4, msg_type='voice'),
+        _msg(6, 2, 5, "ага"), # Серия из одной пустой реплики отбрасывается целиком
+        _msg(7, 1, 30, "А кто бронирует?"), # Пауза больше _RUN_GAP_MS - новая строка
+    ]
+    entries, stats = pb._compact_entries(messages, {})
+    assert stats['messages'] == 7 and stats['dropped'] == 2 and stats['tokens'] > 0
+    assert len(entries) == 2 and all(isinstance(e, str) for e in entries)
+    assert entries[0] == '[11:00 MSK] *user1*: написал(а): "Собираемся в пятницу"; отправил(а): стикеры ×2 (😂), голосовые ×1\n'
+    assert entries[1] == pb.format_log_entry(messages[-1]) # Одиночное сообщение - обычная строка
+
+def test_photo_with_image_data_splits_runs_and_keeps_numbering():
+    photo = _msg(2, 1, 1, "закат", 'photo', file_unique_id="u1")
+    messages = [_msg(1, 1, 0, "Смотрите"), photo, _msg(3, 1, 2, "красиво же")]
+    entries, _ = pb._compact_entries(messages, {"u1": PNG})
+    assert entries[1] is photo and len(entries) == 3
+    parts, last_image = pb.build_log_parts(messages, {"u1": PNG}, image_offset=4)
+    assert last_image == 5 and "[IMAGE 5]" in parts[1] and parts[2]['data'] == PNG
+
+def test_sample_entries_respects_budget_and_marks_gaps():
+    entries = [f"[10:{i:02d} MSK] *user{i % 5}*: написал(а): \"{'сообщение номер ' * 5}{i}\"\n" for i in range(60)]
+    photo = _msg(99, 1, 30, msg_type='photo', file_unique_id="u1")
+    entries.insert(30, photo)
+    assert pb._sample_entries(entries, 10**6) is entries # В бюджете - без изменений
+    budget = pb.estimate_tokens("".join(e for e in entries if isinstance(e, str))) // 3
+    sampled = pb._sample_entries(entries, budget)
+    texts = [e for e in sampled if isinstance(e, str) and not e.startswith("(…")]
+    gaps = [e for e in sampled if isinstance(e, str) and e.startswith("(…")]
+    assert photo in sampled # Фото с данными не выбрасываются
+    assert 0 < len(texts) < 60 and gaps
+    assert len(texts) + sum(int(g.split(": ")[1].split(" ")[0]) for g in gaps) == 60
+    assert sum(pb.estimate_tokens(e) for e in texts + gaps) <= budget
+    kept = [int(e.split("\"")[1].rsplit(" ", 1)[1]) for e in texts]
+    assert kept[0] < 10 and kept[-1] > 45 # Выборка равномерна по всему дню
+
+def test_compaction_streams_iterators():
+    messages = (_msg(i, i % 2, i, f"реплика {i}") for i in range(10)) # Генератор: проходится один раз
+    entries, stats = pb._compact_entries(pb.in_time_order(messages), {})
+    assert stats['messages'] == 10 and len(entries) == 10
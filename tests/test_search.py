@@ -0,0 +1,47 @@
+# tests/test_search.py
+import datetime
+import time
+
+import pytest
+import pytz
+
+import data_manager as dm
+
+def test_search_terms_words_and_phrases():
+    assert dm.search_terms('кошка "серый кот" и') == [(['кошка'], True), (['серый', 'кот'], False), (['и'], False)]
+    assert dm.search_terms('') == [] and dm.search_terms(None) == []
+    assert dm.search_terms('"  "') == [] # Пустая фраза не дает терма
+
+def test_build_fts_query_escapes_user_syntax():
+    assert dm.build_fts_query('кошка "серый кот"') == '"кошка"* AND "серый кот"'
+    assert dm.build_fts_query('ab') == '"ab"' # Короткие слова - без префикса
+    # Операторы и служебные символы FTS5 пользователя не проходят в выражение
+    assert dm.build_fts_query('NEAR(a b) OR content:x*') == '"NEAR"* AND "a" AND "b" AND "OR" AND "content"* AND "x"'
+    assert dm.build_fts_query('*** --- ()') is None
+
+def test_snippet_to_html_escapes_text_and_marks_matches():
+    start, end = dm._SNIPPET_MARKS
+    assert dm.snippet_to_html(f"<b>x</b> {start}кошка{end} & co") == "&lt;b&gt;x&lt;/b&gt; <b>кошка</b> &amp; co"
+    assert dm.snippet_to_html(None) == ""
+
+def test_parse_search_args_period_units():
+    bot_handlers = pytest.importorskip("bot_handlers")
+    now = datetime.datetime(2024, 5, 10, 12, 0, tzinfo=pytz.utc)
+    assert bot_handlers._parse_search_args(["7d", "кошка"], now) == (now - datetime.timedelta(days=7), "кошка")
+    assert bot_handlers._parse_search_args(["3Д", "кошка"], now) == (now - datetime.timedelta(days=3), "кошка")
+    assert bot_handlers._parse_search_args(["12h", "серый", "кот"], now) == (now - datetime.timedelta(hours=12), "серый кот")
+    assert bot_handlers._parse_search_args(["6ч", "кошка"], now) == (now - datetime.timedelta(hours=6), "кошка")
+    assert bot_handlers._parse_search_args(["2024-05-01", "кошка"], now) == (datetime.datetime(2024, 5, 1, tzinfo=pytz.utc), "кошка")
+    assert bot_handlers._parse_search_args(["7d"], now) == (None, "7d") # Единственный аргумент - это запрос
+
+def test_search_messages_scoped_to_chat(sqlite_db):
+    if not dm._fts_available: pytest.skip("SQLite собран без FTS5")
+    now_ms = int(time.time() * 1000)
+    for chat_id in (-2001, -2002):
+        dm.add_message(chat_id, {'message_id': 1, 'user_id': 1, 'username': 'u', 'timestamp': now_ms - 3_600_000, 'type': 'text', 'content': 'Серая кошка спит'})
+        dm.add_message(chat_id, {'message_id': 2, 'user_id': 1, 'username': 'u', 'timestamp': now_ms, 'type': 'text', 'content': 'кошки <везде>'})
+    dm.flush_message_buffer()
+    assert sorted(r['message_id'] for r in dm.search_messages(-2001, 'кошк')) == [1, 2]
+    assert [r['message_id'] for r in dm.search_messages(-2001, 'кошк', since=now_ms - 60_000)] == [2]
+    assert '&lt;везде&gt;' in dm.search_messages(-2002, '"кошки"')[0]['snippet']
+    assert dm.search_messages(-2001, '"серая собака"') == []
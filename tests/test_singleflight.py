@@ -0,0 +1,88 @@
+# tests/test_singleflight.py
+# pytest-asyncio не требуется: каждый сценарий выполняется своим asyncio.run.
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import singleflight
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    monkeypatch.setattr(singleflight, "_inflight", {})
+    monkeypatch.setattr(singleflight, "_results", {})
+    monkeypatch.setattr(singleflight, "_stats", {'started': 0, 'joined': 0, 'cache_hits': 0})
+
+def _counted(calls: list, result="ok", delay: float = 0.05, error: bool = False):
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error: raise RuntimeError("boom")
+        return result
+    return func
+
+def test_concurrent_callers_share_one_computation():
+    calls = []
+    async def scenario():
+        return await asyncio.gather(*(singleflight.run("k", _counted(calls), ttl=0) for _ in range(5)))
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert all(value == "ok" for value, _ in results)
+    assert singleflight.get_stats() == {'started': 1, 'joined': 4, 'cache_hits': 0, 'inflight': 0, 'cached': 0}
+
+def test_ttl_cache_and_cache_if(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(singleflight, "time", SimpleNamespace(monotonic=lambda: now[0])) # Часы event loop не трогаем
+    calls = []
+    async def scenario():
+        first = await singleflight.run("k", _counted(calls, delay=0), ttl=30)
+        now[0] += 10; cached = await singleflight.run("k", _counted(calls, delay=0), ttl=30)
+        now[0] += 30; expired = await singleflight.run("k", _counted(calls, delay=0), ttl=30)
+        rejected = [await singleflight.run("bad", _counted(calls, result="", delay=0), cache_if=bool) for _ in range(2)]
+        return first, cached, expired, rejected
+    first, cached, expired, rejected = asyncio.run(scenario())
+    assert (first, cached, expired) == (("ok", False), ("ok", True), ("ok", False))
+    assert rejected == [("", False), ("", False)] # Неудачный результат не кэшируется
+    assert len(calls) == 4
+
+def test_errors_propagate_to_all_waiters_and_are_not_cached():
+    calls = []
+    async def scenario():
+        results = await asyncio.gather(*(singleflight.run("k", _counted(calls, error=True)) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        return await singleflight.run("k", _counted(calls))
+    assert asyncio.run(scenario()) == ("ok", False)
+    assert len(calls) == 2
+
+def test_cancelled_waiter_does_not_cancel_shared_computation():
+    calls = []
+    async def scenario():
+        first = asyncio.ensure_future(singleflight.run("k", _counted(calls, delay=0.1)))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(singleflight.run("k", _counted(calls)))
+        await asyncio.sleep(0.01)
+        first.cancel() # Пользователь ушел (таймаут обработчика) - второй ждет дальше
+        with pytest.raises(asyncio.CancelledError): await first
+        return await second
+    assert asyncio.run(scenario()) == ("ok", True)
+    assert len(calls) == 1
+
+def test_progress_fans_out_to_joined_callers():
+    import utils
+    class Editor: # Вместо ThrottledMessageEditor: запоминает правки статуса
+        def __init__(self): self.updates = []; self.statuses = []
+        async def update(self, text): self.updates.append(text)
+        async def show(self, text, parse_mode=None): self.statuses.append(text)
+    editors = [Editor() for _ in range(3)]
+    async def caller(editor):
+        with utils.ProgressFanout.attach("k", editor) as progress:
+            async def produce():
+                await asyncio.sleep(0.01) # Остальные успевают присоединиться
+                await progress.show("ждем ИИ"); await progress.update("текст")
+                return "ok"
+            return await singleflight.run("k", produce, ttl=0)
+    async def scenario(): return await asyncio.gather(*(caller(e) for e in editors))
+    assert [shared for _, shared in asyncio.run(scenario())] == [False, True, True]
+    assert all(e.statuses == ["ждем ИИ"] and e.updates == ["текст"] for e in editors)
+    assert utils._progress_fanouts == {}
@@ -0,0 +1,81 @@
+# tests/test_storage_lifecycle.py
+# Жизненный цикл сообщений в SQLite на временном файле: запись -> сводки -> архив -> очистка -> статистика.
+import time
+
+import pytest
+
+_DAY_MS = 86_400_000
+
+@pytest.fixture
+def dm(sqlite_db, monkeypatch):
+    sqlite_db.start_rollup_backfill() # На пустой БД сводки сразу готовы; иначе ждем фоновый поток
+    if sqlite_db._rollup_thread: sqlite_db._rollup_thread.join(timeout=10)
+    assert sqlite_db._rollups_ready
+    return sqlite_db
+
+def _fill_chat(dm, chat_id: int, now_ms: int) -> int:
+    """27 сообщений за 30 дней (7 фото), часть старше горячего окна в 14 дней. Возвращает since для статистики."""
+    for i in range(27):
+        dm.add_message(chat_id, {'message_id': i + 1, 'user_id': 100 + i % 3, 'username': f"user{i % 3}",
+                                 'timestamp': now_ms - (30 - i) * _DAY_MS + 3_600_000, 'type': 'photo' if i % 4 == 0 else 'text',
+                                 'content': f"сообщение {i}", 'file_id': f"f{i}" if i % 4 == 0 else None})
+    dm.flush_message_buffer()
+    return now_ms - 40 * _DAY_MS
+
+def _archived_rows(dm, chat_id: int) -> int:
+    return dm._execute_query("SELECT COALESCE(SUM(rows), 0) FROM archive_segments WHERE chat_id = ?", (chat_id,), fetch_one=True)[0]
+
+def test_rollup_stats_survive_archive_and_rebuild(dm):
+    chat_id = -1001
+    now_ms = int(time.time() * 1000)
+    since = _fill_chat(dm, chat_id, now_ms)
+    assert dm.get_chat_stats(chat_id, since)['total_messages'] == 27
+
+    dm.archive_old_messages(after_days=14) # Проход по всем чатам временной БД
+    archived = _archived_rows(dm, chat_id)
+    assert archived >= 14 and dm._archive_has_segments
+    assert dm._execute_query("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,), fetch_one=True)[0] == 27 - archived
+    stats = dm.get_chat_stats(chat_id, since)
+    assert (stats['total_messages'], stats['photos']) == (27, 7)
+    assert [m['message_id'] for m in dm.get_messages_for_chat(chat_id)] == list(range(1, 28))
+    window = dm.get_messages_for_chat_since(chat_id, now_ms - 20 * _DAY_MS, now_ms - 10 * _DAY_MS)
+    assert [m['message_id'] for m in window] == list(range(11, 21)) # Граница архива внутри окна
+
+    dm.rebuild_chat_rollup(chat_id) # Ремонт сводки учитывает архивные дни
+    stats = dm.get_chat_stats(chat_id, since)
+    assert (stats['total_messages'], stats['photos'], stats['active_users']) == (27, 7, 3)
+
+def test_clear_removes_rollups_and_archive(dm):
+    chat_id = -1002
+    now_ms = int(time.time() * 1000)
+    since = _fill_chat(dm, chat_id, now_ms)
+    dm.archive_old_messages(after_days=14)
+    assert _archived_rows(dm, chat_id) > 0
+
+    dm.clear_messages_for_chat(chat_id)
+    stats = dm.get_chat_stats(chat_id, since)
+    assert (stats['total_messages'], stats['photos']) == (0, 0)
+    assert dm.get_messages_for_chat(chat_id) == []
+    assert _archived_rows(dm, chat_id) == 0
+    assert dm._execute_query("SELECT COUNT(*) FROM chat_activity_daily WHERE chat_id = ?", (chat_id,), fetch_one=True)[0] == 0
+
+def test_range_reads_before_timestamp_ms_migration(sqlite_db, monkeypatch):
+    dm = sqlite_db; chat_id = -1003
+    now_ms = int(time.time() * 1000)
+    for i in range(3): dm.add_message(chat_id, {'message_id': i + 1, 'user_id': 1, 'username': 'u', 'timestamp': now_ms - (3 - i) * 3_600_000, 'type': 'text', 'content': f"m{i}"})
+    dm.flush_message_buffer()
+    dm._execute_query("UPDATE messages SET timestamp_ms = NULL WHERE chat_id = ?", (chat_id,)) # Строки старой версии: только TEXT timestamp
+    monkeypatch.setattr(dm, "_timestamp_ms_ready", False)
+
+    since = now_ms - 2 * 3_600_000 - 60_000
+    def check():
+        messages = dm.get_messages_for_chat_since(chat_id, since)
+        assert [(m['message_id'], m['timestamp']) for m in messages] == [(2, now_ms - 2 * 3_600_000), (3, now_ms - 3_600_000)]
+        assert dm.count_messages_since(chat_id, since) == 2
+        assert [m['message_id'] for m in dm.get_messages_for_chat_last_n(chat_id, 1)] == [3]
+    check()
+
+    dm._timestamp_ms_backfill_loop()
+    assert dm._timestamp_ms_ready
+    assert dm._execute_query("SELECT COUNT(*) FROM messages WHERE chat_id = ? AND timestamp_ms IS NULL", (chat_id,), fetch_one=True)[0] == 0
+    check()
@@ -2,17 +2,21 @@
 import logging
 import asyncio
 import traceback
-from typing import Dict, List, Any, Optional
+import time
+import contextlib
+from typing import Dict, Hashable, Iterator, List, Any, Optional
 
 # --- ИСПРАВЛЕНИЕ: Добавляем импорт Bot ---
 from telegram import Bot
 # -----------------------------------------
 
 from telegram.ext import ContextTypes
-from telegram.error import TelegramError, NetworkError
+from telegram.error import TelegramError, NetworkError, BadRequest, RetryAfter
 from telegram.constants import ParseMode
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type, before_sleep_log
-from config import BOT_OWNER_ID
+import image_cache
+import image_processing
+from config import BOT_OWNER_ID, STREAM_EDIT_INTERVAL_SEC, STREAM_EDIT_MIN_CHARS
 
 logger = logging.getLogger(__name__)
 retry_log = logging.getLogger(__name__ + '.retry') # Отдельный логгер для retries
@@ -176,7 +180,7 @@ async def download_images(
     if not photo_messages:
         return images_data
 
-    photo_messages.sort(key=lambda x: x.get('timestamp', ''))
+    photo_messages.sort(key=lambda x: x.get('timestamp') or 0)
     logger.info(
         f"[Chat {chat_id}] Found {len(photo_messages)} photos. "
         f"Downloading up to {max_photos}..."
@@ -185,31 +189,41 @@ async def download_images(
     tasks = []
     unique_ids_to_download = []
     processed_unique_ids = set()
+    cache_hits = 0
 
     for msg in photo_messages:
-        if len(unique_ids_to_download) >= max_photos:
+        if len(processed_unique_ids) >= max_photos:
             break
         file_unique_id = msg.get('file_unique_id')
         file_id = msg.get('file_id')
         if file_unique_id and file_id and file_unique_id not in processed_unique_ids:
+            processed_unique_ids.add(file_unique_id)
+            cached = await image_cache.get(file_unique_id) # Тот же файл уже скачивался - без сети
+            if cached is not None:
+                images_data[file_unique_id] = cached; cache_hits += 1
+                continue
             # Передаем context в функцию скачивания
             tasks.append(asyncio.create_task(download_single_image(context, file_id, chat_id)))
             unique_ids_to_download.append(file_unique_id)
-            processed_unique_ids.add(file_unique_id)
 
+    if cache_hits: logger.info(f"[Chat {chat_id}] {cache_hits} photos taken from image cache.")
     if not tasks:
         return images_data
 
     logger.debug(f"[Chat {chat_id}] Waiting for {len(tasks)} download tasks...")
     results = await asyncio.gather(*tasks, return_exceptions=True)
 
+    # Уменьшаем/перекодируем свежескачанные фото; в кэш кладем уже обработанные байты
+    downloaded = {unique_id: result for unique_id, result in zip(unique_ids_to_download, results) if isinstance(result, bytes)}
+    downloaded, _ = await image_processing.preprocess_images(downloaded, log_prefix=f"[Chat {chat_id}]")
+
     successful_downloads = 0
     for i, unique_id in enumerate(unique_ids_to_download):
         result = results[i]
         if isinstance(result, bytes):
-            images_data[unique_id] = result
+            images_data[unique_id] = await image_cache.put(unique_id, downloaded[unique_id])
             successful_downloads += 1
-            logger.debug(f"[Chat {chat_id}] Photo {unique_id} ({len(result)} bytes) processed.")
+            logger.debug(f"[Chat {chat_id}] Photo {unique_id} ({len(result)} -> {len(images_data[unique_id])} bytes) processed.")
         elif isinstance(result, Exception):
             logger.error(
                 f"[Chat {chat_id}] Final download error for photo unique_id={unique_id}: "
@@ -222,4 +236,67 @@ async def download_images(
         f"[Chat {chat_id}] Successfully downloaded {successful_downloads}/"
         f"{len(unique_ids_to_download)} requested photos."
     )
-    return images_data
\ No newline at end of file
+    return images_data
+
+# --- Прогрессивное редактирование статуса при стриминге ---
+class ThrottledMessageEditor:
+    """
+    Показывает текст генерации по мере поступления, редактируя одно сообщение
+    не чаще STREAM_EDIT_INTERVAL_SEC (лимиты Telegram на edit) и не ради пары символов.
+    Превью отправляется простым текстом: незавершенный Markdown сломал бы разбор.
+    """
+    PREVIEW_LIMIT = 4000 # Запас до 4096 под курсор
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int):
+        self.bot = bot; self.chat_id = chat_id; self.message_id = message_id
+        self._next_edit_at = 0.0; self._last_len = 0; self._disabled = False; self.edits = 0
+
+    async def update(self, text: str):
+        now = time.monotonic()
+        if self._disabled or now < self._next_edit_at or len(text) - self._last_len < STREAM_EDIT_MIN_CHARS: return
+        preview = text if len(text) <= self.PREVIEW_LIMIT else "…" + text[-self.PREVIEW_LIMIT:]
+        self._next_edit_at = now + STREAM_EDIT_INTERVAL_SEC; self._last_len = len(text)
+        try:
+            await self.bot.edit_message_text(preview + " ▌", chat_id=self.chat_id, message_id=self.message_id, parse_mode=None)
+            self.edits += 1
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+            self._next_edit_at = time.monotonic() + retry_after
+            logger.info(f"Stream edit c={self.chat_id}: flood control, пауза {retry_after:.0f}s.")
+        except BadRequest as e:
+            if "not modified" not in str(e).lower(): logger.warning(f"Stream edit c={self.chat_id} отключен: {e}"); self._disabled = True
+        except TelegramError as e: logger.warning(f"Stream edit c={self.chat_id} error: {e}")
+
+    async def show(self, text: str, parse_mode: Optional[str] = ParseMode.HTML):
+        """Разовый статус ("скачиваю фото", "жду ИИ") - сразу, без троттлинга стриминга."""
+        try: await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, parse_mode=parse_mode)
+        except TelegramError as e: logger.debug(f"Status edit c={self.chat_id} error: {e}")
+
+# --- Прогресс одного вычисления для всех, кто его ждет (single-flight) ---
+_progress_fanouts: Dict[Hashable, "ProgressFanout"] = {}
+
+class ProgressFanout:
+    """
+    Раздает статус и текст генерации статусным сообщениям всех участников,
+    которые ждут одно и то же вычисление singleflight.run: иначе у присоединившихся
+    статус так и висит на "генерирую...". Ключ - тот же, что у singleflight.run.
+    """
+    def __init__(self):
+        self.editors: List[ThrottledMessageEditor] = []
+
+    @classmethod
+    @contextlib.contextmanager
+    def attach(cls, key: Hashable, editor: Optional[ThrottledMessageEditor]) -> Iterator["ProgressFanout"]:
+        """Подписывает editor на прогресс вычисления key на время ожидания результата."""
+        fanout = _progress_fanouts.setdefault(key, cls())
+        if editor: fanout.editors.append(editor)
+        try: yield fanout
+        finally:
+            if editor: fanout.editors.remove(editor)
+            if not fanout.editors and _progress_fanouts.get(key) is fanout: del _progress_fanouts[key]
+
+    async def update(self, text: str):
+        for editor in list(self.editors): await editor.update(text)
+
+    async def show(self, text: str, parse_mode: Optional[str] = ParseMode.HTML):
+        for editor in list(self.editors): await editor.show(text, parse_mode)